@@ -1,8 +1,9 @@
 import pytest
+import io
 import os
-from lexer import Lexer, Token
+from lexer import Lexer, Token, SourceToken, TokenBuffer, iter_tokens
 import parser
-from interpreter import Interpreter
+from interpreter import Interpreter, NodeVisitor
 
 
 ##################################
@@ -129,3 +130,1591 @@ def test_parser_print(file_id=1):
 
 
 
+##################################
+# LEXER ENGINES
+##################################
+
+def lex_all(text, engine):
+    lexer = Lexer(text, engine=engine)
+    tokens = []
+    while True:
+        token = lexer.get_next_token()
+        tokens.append((token.type, token.value))
+        if token.type == 'EOF':
+            return tokens
+
+
+LEXER_SAMPLES = [
+    'a: int = 32; if (a > 2) { print("Yayy"); } else { print(":("); }',
+    'variable: int = 3 * 3 - 6;\nvar: int = 70;\n/*\nI am a\nmultiline comment\n*/\nif (variable < var) {}',
+    'a: str = ""; b: bool = True; c: bool = False; if (a == b) {}',
+    '/* one */ /* two */ x   /* at the end */',
+    'print(a);/*/ b */ c',
+]
+
+
+@pytest.mark.parametrize('text', LEXER_SAMPLES + [get_example(1), get_example(2)])
+def test_regex_engine_matches_char_engine(text):
+    assert lex_all(text, 'regex') == lex_all(text, 'char')
+
+
+@pytest.mark.parametrize('engine', Lexer.engines)
+@pytest.mark.parametrize('text', ['a /* never closed', 'print("never closed', 'a $ b'])
+def test_lexer_errors(engine, text):
+    with pytest.raises(Exception):
+        lex_all(text, engine)
+
+
+@pytest.mark.parametrize('engine', Lexer.engines)
+def test_token_values_are_sliced_lazily(engine):
+    text = 'a: str = "' + 'x' * 10000 + '"; b: int = 123;'
+    lexer = Lexer(text, engine=engine)
+    tokens = [lexer.get_next_token() for _ in range(11)]
+
+    string = tokens[4]
+    assert isinstance(string, SourceToken)
+    assert (string.start, string.end) == (10, 10010)
+    assert string.value == 'x' * 10000
+
+    number = tokens[10]
+    assert isinstance(number, SourceToken)
+    assert number.value == 123
+
+
+@pytest.mark.parametrize('engine', Lexer.engines)
+def test_names_are_interned(engine):
+    text = ''.join(['longvariablename', ' longvariablename'])
+    lexer = Lexer(text, engine=engine)
+    first = lexer.get_next_token()
+    second = lexer.get_next_token()
+    assert first.value == second.value
+    assert first.value is second.value
+
+
+##################################
+# STREAMING
+##################################
+
+def stream_all(source, **kwargs):
+    return [(token.type, token.value) for token in iter_tokens(source, **kwargs)]
+
+
+@pytest.mark.parametrize('text', LEXER_SAMPLES + [get_example(1), get_example(2)])
+def test_stream_matches_lexer(text, tmp_path):
+    expected = lex_all(text, 'char')
+
+    path = tmp_path / 'script.txt'
+    path.write_text(text)
+    assert stream_all(str(path)) == expected
+
+    # Tiny chunks so that tokens, comments and
+    # strings get split between reads
+    for chunk_size in (1, 2, 3, 7):
+        assert stream_all(io.StringIO(text), chunk_size=chunk_size) == expected
+        assert stream_all(io.BytesIO(text.encode()), chunk_size=chunk_size) == expected
+
+
+def test_stream_empty_file(tmp_path):
+    path = tmp_path / 'empty.txt'
+    path.write_text('')
+    assert stream_all(str(path)) == [('EOF', None)]
+
+
+@pytest.mark.parametrize('text', ['a /* never closed', 'print("never closed', 'a $ b'])
+def test_stream_errors(text):
+    with pytest.raises(Exception):
+        stream_all(io.StringIO(text), chunk_size=4)
+
+
+def test_parser_consumes_token_iterator(tmp_path):
+    path = tmp_path / 'script.txt'
+    path.write_text(get_example(1))
+    tree = parser.Parser(iter_tokens(str(path))).parse()
+
+    assert isinstance(tree.children[0], parser.Print)
+    assert tree.children[0].expr.value == 'Hello world'
+
+
+##################################
+# TOKEN BUFFER
+##################################
+
+@pytest.mark.parametrize('text', LEXER_SAMPLES + [get_example(1), get_example(2)])
+def test_token_buffer_matches_lexer(text):
+    buffer = TokenBuffer.from_text(text)
+    tokens = [(buffer.kind(i), buffer.value(i)) for i in range(len(buffer))]
+    assert tokens + [('EOF', None)] == lex_all(text, 'regex')
+
+    streamed = TokenBuffer.from_tokens(iter_tokens(io.StringIO(text)))
+    assert list(streamed.kinds) == list(buffer.kinds)
+    assert list(streamed.starts) == list(buffer.starts)
+    assert streamed.values == buffer.values
+
+
+def test_token_buffer_shares_values():
+    buffer = TokenBuffer.from_text('a: int = 1; b: bool = True; a: int = 1;')
+    assert len(buffer) == 18
+    assert buffer.value_ids[0] == buffer.value_ids[12]
+    # True and 1 are equal in Python but must stay apart
+    assert len(buffer.values) == 9
+    assert buffer.value(16) is not True and buffer.kind(16) == 'INTEGER'
+    assert buffer.value(10) is True and buffer.kind(10) == 'BOOL'
+    assert buffer.token(2).start == 3 and buffer.token(2).end == 6
+
+
+def test_parser_reads_token_buffer():
+    text = 'a: int = 3 * 3 - 6; if (a > 2) { print("Yayy"); }'
+    tree = parser.Parser(TokenBuffer.from_text(text)).parse()
+    assign, ifstatement = tree.children[:2]
+    assert isinstance(assign.value, parser.BinOp)
+    assert assign.value.op.type == 'MINUS'
+    assert ifstatement.block.children[0].expr.value == 'Yayy'
+
+
+def test_ast_nodes_have_no_dict():
+    tree = get_ast('a: int = -3 * 2; if (a > 2) { print("Yayy"); } else { print(a); }')
+    nodes = [tree]
+    while nodes:
+        node = nodes.pop()
+        assert not hasattr(node, '__dict__')
+        for name in type(node).__slots__:
+            child = getattr(node, name)
+            if isinstance(child, parser.AST):
+                nodes.append(child)
+            elif isinstance(child, list):
+                nodes.extend(child)
+
+    binop = tree.children[0].value
+    assert binop.token is binop.op
+
+
+##################################
+# ARENA
+##################################
+
+# Nested tuples with everything the nodes hold,
+# so two trees can be compared
+def dump(node):
+    if isinstance(node, list):
+        return [dump(item) for item in node]
+    if isinstance(node, Token):
+        return ('Token', node.type, node.value)
+    if not isinstance(node, parser.AST):
+        return node
+    slots = getattr(node, 'node_class', type(node)).__slots__
+    return (type(node).__name__,) + tuple(
+        (name, dump(getattr(node, name))) for name in slots
+    )
+
+
+ARENA_SAMPLES = [
+    'a: int = 3 * 3 - 6; b: int = -a + 2 / 1; c: str = "x"; print(b);',
+    'a: int = 32; if (a > 2) { print("Yayy"); } else { print(":("); }',
+    'if (True) { d: bool = False; }',
+    get_example(1),
+    get_example(3),
+]
+
+
+@pytest.mark.parametrize('text', ARENA_SAMPLES)
+def test_arena_round_trip(text):
+    tree = get_ast(text)
+    arena = get_parser(text).parse_arena()
+    assert dump(arena.root) == dump(tree)
+    assert dump(arena.to_tree()) == dump(tree)
+
+
+def test_interpreter_walks_arena(capsys):
+    text = ARENA_SAMPLES[0] + ARENA_SAMPLES[1]
+    Interpreter(get_ast(text)).interpret()
+    from_tree = capsys.readouterr().out
+
+    Interpreter(get_parser(text).parse_arena().root).interpret()
+    assert capsys.readouterr().out == from_tree == '-1.0\nYayy\n'
+
+
+##################################
+# NODE VISITOR
+##################################
+
+class CountingVisitor(NodeVisitor):
+    def visit_BinOp(self, node):
+        return 'binop'
+
+    def visit_Number(self, node):
+        return 'number'
+
+
+class OverridingVisitor(CountingVisitor):
+    def visit_Number(self, node):
+        return 'override'
+
+
+class IntAddForTest(parser.BinOp):
+    __slots__ = ()
+
+
+def test_visit_dispatch_is_cached_per_class():
+    number = parser.Number(Token('INTEGER', 1))
+    binop = parser.BinOp(number, Token('PLUS', '+'), number)
+
+    visitor = CountingVisitor()
+    assert visitor.visit(number) == 'number'
+    assert visitor.visit(binop) == 'binop'
+    assert parser.Number in CountingVisitor._visit_handlers
+
+    # Subclasses keep their own handlers
+    assert OverridingVisitor().visit(number) == 'override'
+    assert visitor.visit(number) == 'number'
+
+    # Node subclasses use the handler of their base class
+    assert visitor.visit(IntAddForTest(number, binop.op, number)) == 'binop'
+
+    with pytest.raises(Exception, match='No visit_Empty method'):
+        visitor.visit(parser.Empty())
+
+
+##################################
+# ENGINE CONFORMANCE
+##################################
+#
+# Every engine has to give the same output as the
+# tree walking Interpreter for these programs
+
+CONFORMANCE_PROGRAMS = [
+    ('print("Hello world");', 'Hello world\n'),
+    ('a: str = "Hi!"; print(a);', 'Hi!\n'),
+    ('print(True); print(False);', 'True\nFalse\n'),
+    ('a: int = 3 * 3 - 6; print(a); print(a / 2); print(-a + 1);', '3\n1.5\n-2\n'),
+    ('a: int = 7; b: int = +a * -2 - 1; print(b);', '-15\n'),
+    ('a: str = "ab"; b: int = 3; print(a * b); print(a + a);', 'ababab\nabab\n'),
+    ('a: int = 32; if (a > 2) { print("Yayy"); } else { print(":("); }', 'Yayy\n'),
+    ('a: int = 1; if (a > 2) { print("Yayy"); } else { print(":("); }', ':(\n'),
+    ('if (3 < 4) { print("lt"); } if (4 == 4) { print("eq"); }', 'lt\neq\n'),
+    ('a: int = 1; if (a == 2) { print("eq"); } else { if (False) { print("x"); } else { print("n"); } }', 'n\n'),
+    ('if (True) { a: int = 5; } print(a);', '5\n'),
+    ('a: bool = True; print(a); a = False; print(a);', 'True\nFalse\n'),
+    ('/* comment */ print(1 + 2 * 3); print(10 / 4);', '7\n2.5\n'),
+    ('print(1);;;print(2);', '1\n2\n'),
+    ('None: int = 1; def: int = 2; print(None + def);', '3\n'),
+    ('n: int = 3; while (n > 0) { print(n); n = n - 1; }', '3\n2\n1\n'),
+    ('t: int = 0; for (i: int = 0; i < 5; i = i + 2) { t = t + i; } print(t); print(i);', '6\n6\n'),
+    ('while (False) { print(1); } print(2);', '2\n'),
+]
+
+ENGINE_NAMES = ['tree', 'closure', 'vm', 'python']
+
+
+def run_engine(engine, text):
+    from interpreter import get_engine
+    interpreter = get_engine(engine)(get_ast(text))
+    interpreter.interpret()
+    return interpreter
+
+
+@pytest.mark.parametrize('engine', ENGINE_NAMES)
+@pytest.mark.parametrize('text, expected', CONFORMANCE_PROGRAMS)
+def test_engine_conformance(engine, text, expected, capsys):
+    run_engine(engine, text)
+    assert capsys.readouterr().out == expected
+
+
+@pytest.mark.parametrize('engine', ENGINE_NAMES)
+def test_engine_undefined_variable(engine, capsys):
+    with pytest.raises(NameError, match='Variable "b" is not defined'):
+        run_engine(engine, 'print(1); print(b);')
+    assert capsys.readouterr().out == '1\n'
+
+
+@pytest.mark.parametrize('engine', ENGINE_NAMES)
+def test_engine_division_by_zero(engine):
+    with pytest.raises(ZeroDivisionError):
+        run_engine(engine, 'a: int = 1 / 0;')
+
+
+##################################
+# BYTECODE
+##################################
+
+def test_bytecode_disassemble():
+    from bytecode import Compiler, disassemble
+    code = Compiler().compile(get_ast(
+        'a: int = 3 * 3; if (a > 2) { print("Yayy"); } else { print(a); }'
+    ))
+    assert disassemble(code).splitlines() == [
+        '    0 LOAD_CONST         0 (3)',
+        '    1 LOAD_CONST         0 (3)',
+        '    2 BINARY_MUL',
+        '    3 STORE_NAME         0 (a)',
+        '    4 LOAD_NAME          0 (a)',
+        '    5 LOAD_CONST         1 (2)',
+        '    6 COMPARE_GT',
+        '    7 POP_JUMP_IF_FALSE  -> 11',
+        '    8 LOAD_CONST         2 (\'Yayy\')',
+        '    9 PRINT',
+        '   10 JUMP               -> 13',
+        '   11 LOAD_NAME          0 (a)',
+        '   12 PRINT',
+    ]
+
+
+##################################
+# TRANSPILER
+##################################
+
+def test_python_source():
+    from transpiler import python_source
+    tree = get_ast('a: int = 3 * 3; if (a > 2) { print("Yayy"); } else { }')
+    assert python_source(tree).splitlines() == [
+        'v_a = 3 * 3',
+        'if v_a > 2:',
+        "    print('Yayy')",
+        'else:',
+        '    pass',
+    ]
+
+
+##################################
+# OPTIMIZER
+##################################
+
+def optimize(text):
+    from optimizer import ConstantFolder
+    folder = ConstantFolder()
+    tree = folder.optimize(get_ast(text))
+    return tree, folder.removed
+
+
+def test_constant_folding():
+    tree, removed = optimize('a: int = 3 * 3 - 6; b: int = -4 / 2; c: bool = True;')
+    a, b, c = tree.children[:3]
+    assert isinstance(a.value, parser.Number) and a.value.value == 3
+    assert isinstance(b.value, parser.Value) and b.value.value == -2.0
+    assert c.value.value is True
+    # 5 + 4 nodes became 2
+    assert removed == 7
+
+
+def test_folding_keeps_runtime_errors_and_variables():
+    tree, removed = optimize('a: int = 1 / 0; b: int = a + 2 * 3;')
+    a, b = tree.children[:2]
+    assert isinstance(a.value, parser.BinOp)
+    assert isinstance(b.value, parser.BinOp)
+    assert b.value.right.value == 6
+    assert removed == 2
+
+
+def test_dead_branch_elimination():
+    tree, removed = optimize(
+        'if (True) { print(1); } '
+        'if (3 > 4) { print(2); } else { print(3); print(4); } '
+        'if (1 == 2) { print(5); } '
+        'a: int = 1; if (a > 0) { print(6); }'
+    )
+    kinds = [type(child).__name__ for child in tree.children]
+    assert kinds == ['Print', 'Print', 'Print', 'Assign', 'IfStatement', 'Empty']
+    assert [child.expr.value for child in tree.children[:3]] == [1, 3, 4]
+    # if (True) -> 4, if (3 > 4) -> 2 + 8, if (1 == 2) -> 2 + 6
+    assert removed == 22
+
+
+def test_folding_skips_long_strings(monkeypatch):
+    import optimizer
+    folded = []
+    fold = optimizer.ConstantFolder.fold
+
+    def recording_fold(self, node, compute):
+        folded.append(node)
+        return fold(self, node, compute)
+
+    monkeypatch.setattr(optimizer.ConstantFolder, 'fold', recording_fold)
+    # "ab" * 10^18 would not fit in memory if it was made
+    size = optimizer.MAX_FOLDED_STRING // 2 + 1
+    tree, removed = optimize(
+        'a: str = 1000000000000000000 * "ab"; b: str = (2 * "a") * 1000000000000000000;'
+        'c: str = 3 * (2 * "ab"); d: str = (1 * "{0}") + (1 * "{0}");'.format('x' * size)
+    )
+    a, b, c, d = [child.value for child in tree.children[:4]]
+    assert isinstance(a, parser.BinOp) and isinstance(b, parser.BinOp)
+    assert b.left.value == 'aa'
+    assert c.value == 'ab' * 6
+    assert isinstance(d, parser.BinOp) and d.left.value == 'x' * size
+    # The long strings were never made
+    assert a not in folded and b not in folded and d not in folded
+
+
+@pytest.mark.parametrize('engine', ENGINE_NAMES)
+@pytest.mark.parametrize('text, expected', CONFORMANCE_PROGRAMS)
+def test_optimized_conformance(engine, text, expected, capsys):
+    from interpreter import get_engine
+    tree, _ = optimize(text)
+    get_engine(engine)(tree).interpret()
+    assert capsys.readouterr().out == expected
+
+
+##################################
+# FRAME SLOTS
+##################################
+
+def analyse(text):
+    from semantic_analizer import SemanticAnalyser
+    tree = get_ast(text)
+    SemanticAnalyser().visit(tree)
+    return tree
+
+
+def test_analyser_assigns_slots():
+    tree = analyse('a: int = 1; b: int = a + 2; if (True) { c: str = "x"; }')
+    assert tree.frame_names == ('a', 'b', 'c')
+
+    a, b, ifstatement = [
+        child for child in tree.children if not isinstance(child, parser.Empty)
+    ]
+    assert a.name.slot == 0
+    assert b.name.slot == 1
+    assert b.value.left.slot == 0
+    assert ifstatement.block.children[0].name.slot == 2
+
+
+def test_interpreter_uses_frame_slots(capsys):
+    interpreter = Interpreter(analyse('a: int = 2; b: int = a * 3; print(b);'))
+    interpreter.interpret()
+    assert capsys.readouterr().out == '6\n'
+    assert interpreter.GLOBAL_SCOPE == {}
+    assert interpreter.frame == [2, 6]
+    assert interpreter.variables() == {'a': 2, 'b': 6}
+
+
+def test_unassigned_slot_is_undefined():
+    interpreter = Interpreter(analyse('if (False) { a: int = 1; } print(a);'))
+    with pytest.raises(NameError, match='Variable "a" is not defined'):
+        interpreter.interpret()
+
+
+def test_falsy_values_are_defined(capsys):
+    text = 'a: int = 0; b: str = ""; c: bool = False; print(a); print(b); print(c);'
+    Interpreter(analyse(text)).interpret()
+    Interpreter(get_ast(text)).interpret()
+    assert capsys.readouterr().out == '0\n\nFalse\n' * 2
+
+
+def test_arena_keeps_slots():
+    from arena import Arena
+    tree = analyse('a: int = 1; print(a);')
+    assert dump(Arena.from_tree(tree).to_tree()) == dump(tree)
+    assert Arena.from_tree(tree).root.frame_names == ('a',)
+
+
+##################################
+# TYPE ANALYSIS
+##################################
+
+def test_expression_types():
+    tree = analyse(
+        'a: int = 1; b: float = a / 2; x: str = "x"; c: str = x * a;'
+        'e: float = -b + a; if (c == x) { print(a); }'
+    )
+    assigns = [
+        child for child in tree.children if isinstance(child, parser.Assign)
+    ]
+    assert [assign.value.expr_type.name for assign in assigns] == [
+        'int', 'float', 'str', 'str', 'float'
+    ]
+    assert assigns[1].value.left.expr_type.name == 'int'
+    assert assigns[1].name.expr_type.name == 'float'
+    assert tree.children[-2].value.expr_type.name == 'bool'
+
+
+@pytest.mark.parametrize('text', [
+    'a: int = "x";',
+    'a: int = 1 / 2;',
+    'x: str = "x"; a: str = 1 + x;',
+    'x: str = "x"; a: int = -x;',
+    'x: str = "x"; if (x < 1) { print(x); }',
+    'a: bool = True; b: int = a + 1;',
+    'print(b);',
+    'a: int = 1; a: int = 2;',
+])
+def test_type_errors(text):
+    from semantic_analizer import SemanticAnalyser
+    with pytest.raises(Exception, match='TypeError|DeclarationError'):
+        SemanticAnalyser().visit(get_ast(text))
+
+
+def test_analysis_does_not_compute_values():
+    # Running this would build a string of 10^18 characters
+    tree = analyse(
+        'a: str = "ab"; b: str = a * 1000000000 * 1000000000; print(b);'
+    )
+    assert tree.children[1].value.expr_type.name == 'str'
+
+
+def test_folded_constants_keep_types():
+    from optimizer import ConstantFolder
+    tree = ConstantFolder().optimize(analyse('a: float = 1 + 2 / 4;'))
+    assert tree.children[0].value.value == 1.5
+    assert tree.children[0].value.expr_type.name == 'float'
+
+
+##################################
+# SPECIALIZER
+##################################
+
+def specialize(text):
+    from specializer import Specializer
+    return Specializer().specialize(analyse(text))
+
+
+def test_specialized_variants():
+    tree = specialize(
+        'a: int = 1 + 2 * 3 - 4; b: float = a / 2 + 1; c: str = "x";'
+        'd: str = c + c * a; if (a < b) { print(a); } if (c == d) { print(c); }'
+    )
+    a, b, c, d, if_num, if_str = [
+        child for child in tree.children if not isinstance(child, parser.Empty)
+    ]
+    assert type(a.value).__name__ == 'IntSub'
+    assert type(a.value.left).__name__ == 'IntAdd'
+    assert type(a.value.left.right).__name__ == 'IntMul'
+    assert type(b.value).__name__ == 'FloatAdd'
+    assert type(b.value.left).__name__ == 'NumDiv'
+    assert type(d.value).__name__ == 'StrConcat'
+    assert type(d.value.right).__name__ == 'StrRepeat'
+    assert type(if_num.value).__name__ == 'NumLess'
+    assert type(if_str.value).__name__ == 'StrEqual'
+    assert isinstance(d.value, parser.BinOp)
+    assert d.value.expr_type.name == 'str'
+
+
+def test_unanalysed_tree_stays_generic():
+    from specializer import Specializer
+    tree = Specializer().specialize(get_ast('a: int = 1 + 2;'))
+    assert type(tree.children[0].value) is parser.BinOp
+
+
+def test_specializer_rejects_mismatched_types():
+    from specializer import Specializer
+    tree = analyse('a: int = 1; x: str = "x"; b: str = x + x;')
+    int_type = tree.children[0].value.expr_type
+    # str + int, which the analyser would have refused
+    tree.children[2].value.right.expr_type = int_type
+    with pytest.raises(Exception, match='TypeError'):
+        Specializer().specialize(tree)
+
+
+@pytest.mark.parametrize('engine', ENGINE_NAMES)
+def test_specialized_conformance(engine, capsys):
+    from interpreter import get_engine
+    text = (
+        'a: int = 7; b: float = a / 2; s: str = "ab";'
+        'if (a > 3) { print(a * 2 - 1); print(b + a); print(s * 2 + s); }'
+        'if (s == s) { print(True); } else { print(False); }'
+    )
+    get_engine(engine)(specialize(text)).interpret()
+    assert capsys.readouterr().out == '13\n10.5\nababab\nTrue\n'
+
+
+##################################
+# QUICKENING
+##################################
+
+def test_quickening_after_stable_types(capsys):
+    from interpreter import QUICKEN_AFTER
+    tree = get_ast('print(a + b); if (a < b) { print(1); }')
+    interpreter = Interpreter(tree)
+    interpreter.GLOBAL_SCOPE.update(a=1, b=2)
+
+    for _ in range(QUICKEN_AFTER - 1):
+        interpreter.interpret()
+    assert interpreter.quickened == 0
+
+    interpreter.interpret()
+    assert interpreter.quickened == 2
+    binop = tree.children[0].expr
+    assert binop.quick == (int, int, int.__add__)
+    assert tree.children[1].value.quick == (int, int, int.__lt__)
+
+    interpreter.interpret()
+    assert capsys.readouterr().out == '3\n1\n' * (QUICKEN_AFTER + 1)
+
+
+def test_deopt_on_type_change(capsys):
+    from interpreter import QUICKEN_AFTER
+    tree = get_ast('print(a + b);')
+    interpreter = Interpreter(tree)
+    interpreter.GLOBAL_SCOPE.update(a=1, b=2)
+    for _ in range(QUICKEN_AFTER):
+        interpreter.interpret()
+    assert interpreter.quickened == 1
+
+    interpreter.GLOBAL_SCOPE.update(a=1.5)
+    interpreter.interpret()
+    assert interpreter.deopts == 1
+    assert tree.children[0].expr.quick is None
+    assert capsys.readouterr().out.splitlines()[-1] == '3.5'
+
+    # Stable again with the new types
+    for _ in range(QUICKEN_AFTER - 1):
+        interpreter.interpret()
+    assert interpreter.quickened == 2
+    assert tree.children[0].expr.quick[:2] == (float, int)
+
+
+def test_mixed_types_never_quicken(capsys):
+    tree = get_ast('print(a + b);')
+    interpreter = Interpreter(tree)
+    for value in (1, 1.5, 2, 2.5, 3, 3.5, 4, 4.5):
+        interpreter.GLOBAL_SCOPE.update(a=value, b=1)
+        interpreter.interpret()
+    assert interpreter.quickened == 0
+    assert capsys.readouterr().out.split() == [
+        '2', '2.5', '3', '3.5', '4', '4.5', '5', '5.5'
+    ]
+
+
+##################################
+# FUNCTIONS
+##################################
+
+FUNCTION_PROGRAM = '''
+function fact(n: int): int {
+    if (n < 2) { return 1; }
+    return n * fact(n - 1);
+}
+function greet(name: str, times: int) {
+    print(name * times);
+}
+g: int = 10;
+function addg(x: int): int {
+    y: int = x + g;
+    return y;
+}
+print(fact(10));
+greet("ab", 3);
+print((addg(5) + 2) * 3);
+'''
+
+
+def run_analysed(text, **kwargs):
+    interpreter = Interpreter(analyse(text), **kwargs)
+    interpreter.interpret()
+    return interpreter
+
+
+def test_parse_calls_and_returns():
+    tree = get_ast('function f(a: int, b: str): int { return a; } print(f(1, "x"));')
+    function = tree.children[0]
+    assert function.return_type.value == 'int'
+    assert [param.var_node.value for param in function.params] == ['a', 'b']
+    assert isinstance(function.block_node.children[0], parser.Return)
+
+    call = tree.children[1].expr
+    assert isinstance(call, parser.FuncCall)
+    assert call.func_name == 'f'
+    assert [type(arg).__name__ for arg in call.args] == ['Number', 'Value']
+
+
+def test_parenthesized_expressions():
+    assert dump(get_ast('a: int = (1 + 2) * 3;').children[0].value) == dump(
+        parser.BinOp(
+            parser.BinOp(
+                parser.Number(Token('INTEGER', 1)),
+                Token('PLUS', '+'),
+                parser.Number(Token('INTEGER', 2))
+            ),
+            Token('MULT', '*'),
+            parser.Number(Token('INTEGER', 3))
+        )
+    )
+
+
+def test_function_calls(capsys):
+    interpreter = run_analysed(FUNCTION_PROGRAM)
+    assert capsys.readouterr().out == '3628800\nababab\n51\n'
+    # Locals of the calls stay in their frames
+    assert interpreter.variables() == {'g': 10}
+    assert interpreter.call_stack == []
+
+
+def test_frames_are_reused(capsys):
+    interpreter = run_analysed(
+        'function f(n: int): int { a: int = n * 2; return a; }'
+        'print(f(1)); print(f(2)); print(f(3) + f(4));'
+    )
+    assert capsys.readouterr().out == '2\n4\n14\n'
+    assert interpreter.frames.allocated == 1
+
+
+def test_deep_recursion_and_max_depth(capsys):
+    text = (
+        'function deep(n: int): int {'
+        '    if (n < 1) { return 0; }'
+        '    return 1 + deep(n - 1);'
+        '}'
+        'print(deep({}));'
+    )
+    run_analysed(text.replace('{}', '3000'), max_depth=5000)
+    assert capsys.readouterr().out == '3000\n'
+
+    with pytest.raises(RecursionError, match='Maximum call depth of 100'):
+        run_analysed(text.replace('{}', '3000'), max_depth=100)
+
+
+@pytest.mark.parametrize('text', [
+    'function f(a: int) { print(a); } f("x");',
+    'function f(a: int) { print(a); } f(1, 2);',
+    'function f(a: int) { print(a); } print(f(1));',
+    'function f(): int { return "x"; }',
+    'function f(): int { return; }',
+    'function f() { return 1; }',
+    'return 1;',
+    'f(1);',
+    'function f() { function g() { print(1); } }',
+])
+def test_function_errors(text):
+    from semantic_analizer import SemanticAnalyser
+    with pytest.raises(Exception, match='Error'):
+        SemanticAnalyser().visit(get_ast(text))
+
+
+@pytest.mark.parametrize('text', [
+    'function f(n: int): int { if (n < 2) { return 1; } } print(f(5) + 1);',
+    'function f(n: int): int { if (n < 2) { return 1; } else { print(n); } }',
+    'function f(n: int): int { while (n > 0) { return n; } }',
+    'function f(n: int): int { print(n); }',
+])
+def test_typed_function_has_to_return(text):
+    from semantic_analizer import SemanticAnalyser
+    with pytest.raises(Exception, match='Missing return value'):
+        SemanticAnalyser().visit(get_ast(text))
+
+
+def test_typed_function_returning_in_both_branches(capsys):
+    run_analysed(
+        'function f(n: int): int {'
+        '    if (n < 2) { return 1; } else { if (n > 4) { return 3; } else { return 2; } }'
+        '}'
+        'print(f(5) + 1);'
+    )
+    assert capsys.readouterr().out == '4\n'
+
+
+def test_typed_function_with_code_after_return(capsys):
+    run_analysed('function f(n: int): int { return n; print(n); } print(f(2));')
+    assert capsys.readouterr().out == '2\n'
+
+
+ENGINE_FUNCTION_PROGRAMS = [
+    FUNCTION_PROGRAM,
+    # Globals assigned in functions, calls as statements, early returns
+    'g: int = 1;'
+    'function bump(n: int) { g = g + n; if (n > 0) { bump(n - 1); return; } print(g); }'
+    'bump(3); print(g);',
+    # A local with the name of a global
+    'a: int = 5; function f(x: int): int { a: int = x * 2; return a; } print(f(a)); print(a);',
+    'function deep(n: int): int { if (n < 1) { return 0; } return 1 + deep(n - 1); } print(deep(500));',
+    'function done(n: int, label: str): str { x: str = label * n; return x; }'
+    'function count(n: int): str { if (n == 0) { return done(2, "e"); } return count(n - 1); }'
+    'print(count(5000)); print(done(1, "x") + count(1));',
+]
+
+
+@pytest.mark.parametrize('engine', ENGINE_NAMES)
+@pytest.mark.parametrize('optimized', [False, True])
+@pytest.mark.parametrize('text', ENGINE_FUNCTION_PROGRAMS)
+def test_engine_function_calls(engine, optimized, text):
+    from interpreter import get_engine, optimize as optimize_tree
+    tree = analyse(text)
+    if optimized:
+        tree = optimize_tree(tree)[0]
+    lines = []
+    interpreter = get_engine(engine)(tree, output=lines)
+    interpreter.interpret()
+    assert lines == run_analysed_lines(text)
+    # Locals of the calls don't end up in the global variables
+    assert interpreter.variables() == run_analysed(text, output=[]).variables()
+
+
+@pytest.mark.parametrize('engine', ENGINE_NAMES)
+def test_engine_function_errors(engine):
+    from interpreter import get_engine
+    with pytest.raises(NameError, match='Function "f" is not defined'):
+        get_engine(engine)(analyse(
+            'if (False) { function f() { print(1); } } f();'
+        ), output=[]).interpret()
+    with pytest.raises(NameError, match='Variable "a" is not defined'):
+        get_engine(engine)(analyse(
+            'function f() { if (False) { a: int = 1; } print(a); } f();'
+        ), output=[]).interpret()
+    with pytest.raises(RecursionError):
+        get_engine(engine)(analyse(
+            'function f(n: int): int { return 1 + f(n + 1); } print(f(0));'
+        ), output=[]).interpret()
+
+
+@pytest.mark.parametrize('engine', ['closure', 'vm', 'python'])
+def test_engine_functions_need_analysed_tree(engine):
+    with pytest.raises(Exception, match='SemanticAnalyser'):
+        run_engine(engine, 'function f() { print(1); } f();')
+
+
+def test_disassemble_functions():
+    from bytecode import Compiler, disassemble
+    text = disassemble(Compiler().compile(analyse(COUNTDOWN + 'print(count(3, 0));')))
+    assert 'MAKE_FUNCTION      0 (<function count>)' in text
+    assert '\ncount(n, acc):\n' in text
+    assert 'TAIL_CALL          2 (count)' in text
+
+
+##################################
+# PURE FUNCTIONS
+##################################
+
+def test_reassignment(capsys):
+    tree = analyse('a: int = 1; a = a + 1; print(a);')
+    assert tree.children[1].type is None
+    Interpreter(tree).interpret()
+    assert capsys.readouterr().out == '2\n'
+
+    from semantic_analizer import SemanticAnalyser
+    with pytest.raises(Exception, match='TypeError'):
+        SemanticAnalyser().visit(get_ast('a: int = 1; a = "x";'))
+    with pytest.raises(Exception, match='DeclarationError'):
+        SemanticAnalyser().visit(get_ast('a = 1;'))
+
+
+@pytest.mark.parametrize('declaration, pure', [
+    ('function f(n: int): int { a: int = n * 2; return a; }', True),
+    ('function f(n: int): int { if (n < 1) { return 0; } return f(n - 1); }', True),
+    ('function f(n: int): int { print(n); return n; }', False),
+    ('g: int = 1; function f(n: int): int { return n + g; }', False),
+    ('g: int = 1; function f(n: int): int { g = n; return n; }', False),
+    ('function p() { print(1); } function f(n: int): int { p(); return n; }', False),
+    ('function p(n: int): int { return n; } function f(n: int): int { return p(n); }', True),
+])
+def test_purity(declaration, pure):
+    tree = analyse(declaration)
+    functions = [
+        child for child in tree.children if isinstance(child, parser.FuncDecl)
+    ]
+    assert functions[-1].is_pure is pure
+
+
+def test_pure_calls_are_memoized(capsys):
+    interpreter = run_analysed(
+        'function fib(n: int): int {'
+        '    if (n < 2) { return n; }'
+        '    return fib(n - 1) + fib(n - 2);'
+        '}'
+        'print(fib(80));'
+    )
+    assert capsys.readouterr().out == '23416728348467685\n'
+    assert interpreter.memo_stats() == {
+        'fib': {'hits': 78, 'misses': 81, 'size': 81}
+    }
+
+
+def test_memo_lru_eviction(capsys):
+    text = (
+        'function sq(n: int): int { return n * n; }'
+        'print(sq(1)); print(sq(2)); print(sq(1)); print(sq(3)); print(sq(2));'
+    )
+    interpreter = run_analysed(text, memo_size=2)
+    assert capsys.readouterr().out == '1\n4\n1\n9\n4\n'
+    # sq(2) was the least recently used when sq(3) came in
+    assert interpreter.memo_stats()['sq'] == {'hits': 1, 'misses': 4, 'size': 2}
+    assert list(interpreter.memo['sq'].results) == [(3,), (2,)]
+
+    assert run_analysed(text, memo_size=0).memo_stats() == {}
+
+
+def test_impure_calls_are_not_memoized(capsys):
+    interpreter = run_analysed(
+        'function f(n: int): int { print(n); return n; } f(1); f(1);'
+    )
+    assert capsys.readouterr().out == '1\n1\n'
+    assert interpreter.memo_stats() == {}
+
+
+##################################
+# TAIL CALLS
+##################################
+
+COUNTDOWN = '''
+function count(n: int, acc: int): int {
+    if (n < 1) { return acc; }
+    return count(n - 1, acc + 2);
+}
+'''
+
+
+def test_tail_calls_are_marked():
+    tree = analyse(COUNTDOWN + 'function f(n: int): int { return count(n, 0) + 1; }')
+    count, f = [
+        child for child in tree.children if isinstance(child, parser.FuncDecl)
+    ]
+    base, tail = count.block_node.children[0].block.children[0], count.block_node.children[1]
+    assert base.tail_call is False
+    assert tail.tail_call is True
+    assert f.block_node.children[0].tail_call is False
+
+
+def test_tail_recursion_runs_in_constant_depth(capsys):
+    # Far deeper than max_depth allows for regular calls
+    interpreter = run_analysed(COUNTDOWN + 'print(count(20000, 0));', max_depth=10)
+    assert capsys.readouterr().out == '40000\n'
+    assert interpreter.frames.allocated == 1
+    assert interpreter.call_stack == []
+
+
+def test_tail_calls_between_functions(capsys):
+    interpreter = run_analysed(
+        'function done(n: int, label: str): str { x: str = label * n; return x; }'
+        'function count(n: int): str {'
+        '    if (n == 0) { return done(2, "e"); }'
+        '    return count(n - 1);'
+        '}'
+        'function check(n: int): bool {'
+        '    if (count(n) == "ee") { return True; }'
+        '    return False;'
+        '}'
+        'print(count(5000)); if (check(3)) { print("yes"); }',
+        max_depth=10
+    )
+    assert capsys.readouterr().out == 'ee\nyes\n'
+    # One frame for count, one for done (a different size),
+    # and one more for the call to count inside check
+    assert interpreter.frames.allocated == 3
+
+
+##################################
+# LOOPS
+##################################
+
+def loops(tree):
+    return [
+        node for node in walk(tree)
+        if isinstance(node, (parser.ForLoop, parser.WhileLoop))
+    ]
+
+
+def walk(node):
+    from semantic_analizer import walk
+    return walk(node)
+
+
+@pytest.mark.parametrize('text, counted', [
+    ('for (i: int = 0; i < 10; i = i + 1) { print(i); }', True),
+    ('n: int = 5; for (i: int = n; i > 0 - n; i = i - 2) { print(i); }', True),
+    ('for (i: int = 0; i < 10; i = i + 1) { i = i + 1; }', False),
+    ('n: int = 5; for (i: int = 0; i < n; i = i + 1) { n = n - 1; }', False),
+    ('for (i: int = 0; i < 10; i = i - 1) { print(i); }', False),
+    ('for (i: int = 0; i == 10; i = i + 1) { print(i); }', False),
+    ('for (i: int = 0; i < 10; i = i * 2) { print(i); }', False),
+    ('a: int = 0; for (i: int = 0; i < 10; i = a + 1) { print(i); }', False),
+    ('for (i: int = 0; i < i * 0 + 3; i = i + 1) { print(i); }', False),
+    ('for (i: int = 0; i < i + 5; i = i + 1) { print(i); }', False),
+    ('function f(): int { return 3; } for (i: int = 0; i < f(); i = i + 1) { print(i); }', False),
+    ('function g() { print(1); } for (i: int = 0; i < 3; i = i + 1) { g(); }', False),
+    ('function g(): int { for (i: int = 0; i < 3; i = i + 1) { print(i); } return 0; }', True),
+    ('function p(n: int): int { return n; } for (i: int = 0; i < 3; i = i + 1) { print(p(i)); }', True),
+])
+def test_counted_loop_detection(text, counted):
+    [loop] = loops(analyse(text))
+    assert loop.counted is counted
+
+
+@pytest.mark.parametrize('text', [
+    't: int = 0; for (i: int = 0; i < 10; i = i + 3) { t = t + i; } print(t); print(i);',
+    'for (i: int = 10; i > 0 - 7; i = i - 4) { print(i); } print(i);',
+    'for (i: int = 5; i < 0; i = i + 1) { print(i); } print(i);',
+    'for (i: int = 0; i < 3; i = i + 1) { for (j: int = 0; j < i; j = j + 1) { print(i * j); } }',
+    'function sum(n: int): int { t: int = 0; for (i: int = 0; i < n; i = i + 1) { t = t + i; } return t; } print(sum(100));',
+])
+def test_counted_loops_match_generic_loops(text, capsys):
+    tree = analyse(text)
+    assert all(loop.counted for loop in loops(tree) if isinstance(loop, parser.ForLoop))
+    Interpreter(tree).interpret()
+    counted = capsys.readouterr().out
+
+    for loop in loops(tree):
+        loop.counted = False
+    Interpreter(tree).interpret()
+    assert capsys.readouterr().out == counted
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('for (i: int = 0; i < i * 0 + 3; i = i + 1) { print(i); }', '0\n1\n2\n'),
+    # The end moves with i, a range() would stop at 10
+    ('for (i: int = 0; i < 10 - i; i = i + 1) { print(i); }', '0\n1\n2\n3\n4\n'),
+])
+@pytest.mark.parametrize('optimized', [True, False])
+def test_loop_end_reading_loop_variable(text, expected, optimized, capsys):
+    tree = specialize(text) if optimized else analyse(text)
+    Interpreter(tree).interpret()
+    assert capsys.readouterr().out == expected
+
+    for loop in loops(tree):
+        loop.counted = False
+    Interpreter(tree).interpret()
+    assert capsys.readouterr().out == expected
+
+
+def test_while_loop_in_function(capsys):
+    # Declarations in the block run on every iteration
+    run_analysed(
+        'function countdown(n: int): int {'
+        '    steps: int = 0;'
+        '    while (n > 1) {'
+        '        next: int = n - 1;'
+        '        steps = steps + 1;'
+        '        n = next;'
+        '    }'
+        '    return steps;'
+        '}'
+        'print(countdown(6));'
+    )
+    assert capsys.readouterr().out == '5\n'
+
+
+def test_loops_round_trip_through_arena():
+    from arena import Arena
+    tree = analyse('n: int = 3; while (n > 0) { n = n - 1; } for (i: int = 0; i < n; i = i + 1) { print(i); }')
+    assert dump(Arena.from_tree(tree).to_tree()) == dump(tree)
+
+
+##################################
+# OUTPUT
+##################################
+
+OUTPUT_PROGRAM = 'a: int = 1; print(a); print("two"); print(a * 3);'
+
+
+@pytest.mark.parametrize('engine', ENGINE_NAMES)
+def test_engine_output_into_list(engine):
+    from interpreter import get_engine
+    lines = []
+    get_engine(engine)(get_ast(OUTPUT_PROGRAM), output=lines).interpret()
+    assert lines == ['1', 'two', '3']
+
+
+@pytest.mark.parametrize('engine', ENGINE_NAMES)
+def test_engine_output_into_stream(engine, capsys):
+    from interpreter import get_engine
+    stream = io.StringIO()
+    get_engine(engine)(get_ast(OUTPUT_PROGRAM), output=stream).interpret()
+    assert stream.getvalue() == '1\ntwo\n3\n'
+    assert capsys.readouterr().out == ''
+
+
+def test_buffered_output_flushes_on_size():
+    from output import BufferedOutput
+    stream = io.StringIO()
+    output = BufferedOutput(stream, flush_size=6)
+    output.print_value('ab')
+    output.print_value(1)
+    assert stream.getvalue() == ''
+    output.print_value('c')
+    assert stream.getvalue() == 'ab\n1\nc\n'
+    output.print_value('d')
+    output.flush()
+    assert stream.getvalue() == 'ab\n1\nc\nd\n'
+
+
+def test_output_is_flushed_when_program_fails():
+    stream = io.StringIO()
+    with pytest.raises(NameError):
+        Interpreter(get_ast('print(1); print(b);'), output=stream).interpret()
+    assert stream.getvalue() == '1\n'
+
+
+def test_unsupported_output():
+    from output import get_output
+    with pytest.raises(TypeError):
+        get_output(42)
+
+
+##################################
+# COMPILE CACHE
+##################################
+
+CACHED_PROGRAM = 'function sq(n: int): int { return n * n; } a: int = 3; print(sq(a));'
+
+
+def test_cache_round_trip(tmp_path):
+    from cache import CompileCache
+    cache = CompileCache(str(tmp_path))
+    assert cache.load(CACHED_PROGRAM) is None
+
+    tree = analyse(CACHED_PROGRAM)
+    assert cache.store(CACHED_PROGRAM, tree)
+    loaded = cache.load(CACHED_PROGRAM)
+    # Types are copies of the symbols, compared by their repr
+    assert repr(dump(loaded)) == repr(dump(tree))
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    lines = []
+    Interpreter(loaded, output=lines).interpret()
+    assert lines == ['9']
+
+
+def test_cache_is_keyed_by_source(tmp_path):
+    from cache import CompileCache
+    cache = CompileCache(str(tmp_path))
+    cache.store(CACHED_PROGRAM, analyse(CACHED_PROGRAM))
+    assert cache.load(CACHED_PROGRAM.replace('3', '4')) is None
+    assert cache.key(CACHED_PROGRAM) == cache.key(CACHED_PROGRAM.encode())
+
+
+def test_cache_drops_damaged_files(tmp_path):
+    from cache import CompileCache
+    cache = CompileCache(str(tmp_path))
+    cache.store(CACHED_PROGRAM, analyse(CACHED_PROGRAM))
+    path = cache.path(cache.key(CACHED_PROGRAM))
+    with open(path, 'r+b') as cache_file:
+        cache_file.truncate(10)
+
+    assert cache.load(CACHED_PROGRAM) is None
+    assert not os.path.exists(path)
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    from cache import CompileCache
+    cache = CompileCache(str(tmp_path))
+    programs = ['a: int = {};'.format(n) for n in range(3)]
+    for age, program in enumerate(programs):
+        cache.store(program, analyse(program))
+        os.utime(cache.path(cache.key(program)), (100 - age, 100 - age))
+    cache.max_bytes = cache.size() - 1
+    cache.evict()
+
+    # The first program was used last
+    assert [cache.load(program) is not None for program in programs] == [True, True, False]
+    # No temporary files are left behind
+    assert all(name.endswith('.tree') for name in os.listdir(str(tmp_path)))
+
+
+def test_main_uses_cache(tmp_path, monkeypatch, capsys):
+    from interpreter import main
+    source = tmp_path / 'program.txt'
+    source.write_text(CACHED_PROGRAM)
+    cache_dir = str(tmp_path / 'cache')
+    monkeypatch.setattr(
+        'sys.argv',
+        ['interpreter.py', str(source), '--cache-dir', cache_dir, '--stats']
+    )
+
+    main()
+    first = capsys.readouterr()
+    main()
+    second = capsys.readouterr()
+    assert first.out == second.out == '9\n'
+    assert 'Cache miss' in first.err
+    assert 'Cache hit' in second.err
+
+
+def test_load_program_parses_the_cached_bytes(tmp_path, monkeypatch):
+    # With a cache, the tree comes from the bytes that were hashed,
+    # the file isn't read a second time
+    import interpreter
+    from cache import CompileCache
+    source = tmp_path / 'program.txt'
+    source.write_text(CACHED_PROGRAM)
+    cache = CompileCache(str(tmp_path / 'cache'))
+
+    streamed = interpreter.iter_tokens
+
+    def iter_tokens(source, *args, **kwargs):
+        if isinstance(source, (str, bytes, os.PathLike)):
+            raise AssertionError('The file was read again')
+        return streamed(source, *args, **kwargs)
+
+    monkeypatch.setattr(interpreter, 'iter_tokens', iter_tokens)
+    tree = interpreter.load_program(str(source), cache)
+    assert repr(dump(tree)) == repr(dump(cache.load(CACHED_PROGRAM)))
+
+
+def test_load_program_empty_file_with_cache(tmp_path):
+    from cache import CompileCache
+    from interpreter import load_program
+    source = tmp_path / 'empty.txt'
+    source.write_text('')
+    cache = CompileCache(str(tmp_path / 'cache'))
+
+    for _ in range(2):
+        lines = []
+        Interpreter(load_program(str(source), cache), output=lines).interpret()
+        assert lines == []
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+##################################
+# SERIALIZER
+##################################
+
+SERIALIZER_SAMPLES = ARENA_SAMPLES[1:] + [
+    FUNCTION_PROGRAM,
+    COUNTDOWN,
+    'x: float = 5 / 2; print(x); big: int = 123456789012345678901234567890; s: str = "café \\u263a"; print(s);',
+    't: int = 0; for (i: int = 0; i < 4; i = i + 1) { t = t + i; } while (t > 0) { t = t - 5; } print(t);',
+]
+
+
+@pytest.mark.parametrize('text', SERIALIZER_SAMPLES)
+def test_serializer_round_trip(text):
+    from serializer import dumps, loads
+    tree = analyse(text)
+    loaded = loads(dumps(tree))
+    # Types are new symbols, compared by their repr
+    assert repr(dump(loaded)) == repr(dump(tree))
+
+    expected = []
+    Interpreter(analyse(text), output=expected).interpret()
+    lines = []
+    Interpreter(loaded, output=lines).interpret()
+    assert lines == expected
+
+
+def test_serializer_shares_types():
+    from serializer import dumps, loads
+    tree = loads(dumps(analyse('a: int = 1; b: int = a + 2;')))
+    first, second, _ = tree.children
+    assert second.value.expr_type is first.value.expr_type
+    assert second.value.expr_type.name == 'int'
+
+
+@pytest.mark.parametrize('damage', [
+    lambda data: b'XXXX' + data[4:],
+    lambda data: data[:4] + b'\x63\x00' + data[6:],
+    lambda data: data[:-3],
+    lambda data: data + b'\x00',
+    lambda data: data[:len(data) // 2],
+])
+def test_serializer_rejects_damaged_data(damage):
+    from serializer import SerializationError, dumps, loads
+    data = dumps(analyse(FUNCTION_PROGRAM))
+    with pytest.raises(SerializationError):
+        loads(damage(data))
+
+
+def test_main_runs_compiled_program(tmp_path, monkeypatch, capsys):
+    from interpreter import main
+    source = tmp_path / 'program.txt'
+    source.write_text(FUNCTION_PROGRAM)
+    compiled = str(tmp_path / 'program.ltli')
+
+    monkeypatch.setattr('sys.argv', ['interpreter.py', str(source), '--compile-to', compiled])
+    main()
+    assert capsys.readouterr().out == ''
+
+    monkeypatch.setattr('sys.argv', ['interpreter.py', compiled])
+    main()
+    from_compiled = capsys.readouterr().out
+    monkeypatch.setattr('sys.argv', ['interpreter.py', str(source)])
+    main()
+    assert from_compiled == capsys.readouterr().out != ''
+
+
+def test_load_program_source_starting_like_magic(tmp_path):
+    # The magic can't be mistaken for the start of a source file
+    from interpreter import load_program
+    source = tmp_path / 'program.txt'
+    source.write_text('LTLIa: int = 3; print(LTLIa);')
+    lines = []
+    Interpreter(load_program(str(source)), output=lines).interpret()
+    assert lines == ['3']
+
+
+##################################
+# BATCH RUNNER
+##################################
+
+def test_find_scripts(tmp_path):
+    from batch import find_scripts
+    (tmp_path / 'sub').mkdir()
+    for name in ['a.txt', 'b.txt', 'sub/c.txt', 'notes.md']:
+        (tmp_path / name).write_text('print(1);')
+    root = str(tmp_path)
+
+    assert find_scripts([root]) == [
+        os.path.join(root, 'a.txt'),
+        os.path.join(root, 'b.txt'),
+        os.path.join(root, 'sub', 'c.txt'),
+    ]
+    # Repeats are dropped, patterns are expanded
+    assert find_scripts([os.path.join(root, 'b.txt'), os.path.join(root, '*.md'), root])[:2] == [
+        os.path.join(root, 'b.txt'),
+        os.path.join(root, 'notes.md'),
+    ]
+    assert find_scripts([os.path.join(root, 'missing*')]) == []
+
+
+def test_run_script_summaries(tmp_path):
+    from batch import run_script
+    good = tmp_path / 'good.txt'
+    good.write_text(FUNCTION_PROGRAM)
+    bad = tmp_path / 'bad.txt'
+    bad.write_text('print(1); a: int = 0; print(2 / a);')
+
+    summary = run_script(str(good))
+    assert summary['ok'] and summary['error'] is None
+    assert summary['output'] == '\n'.join(run_analysed_lines(FUNCTION_PROGRAM)) + '\n'
+
+    summary = run_script(str(bad), engine='vm', optimized=False)
+    assert not summary['ok']
+    assert summary['output'] == '1\n'
+    assert summary['error_type'] == 'ZeroDivisionError'
+
+    bad.write_text('print(1); print(b);')
+    summary = run_script(str(bad))
+    assert (summary['output'], summary['error_type']) == ('', 'Exception')
+    assert summary['error'].startswith('DeclarationError')
+
+    summary = run_script(str(tmp_path / 'missing.txt'))
+    assert summary['error_type'] == 'FileNotFoundError'
+
+
+def run_analysed_lines(text):
+    lines = []
+    run_analysed(text, output=lines)
+    return lines
+
+
+def test_run_batch_in_worker_processes(tmp_path):
+    from batch import run_batch
+    scripts = []
+    for n in range(6):
+        script = tmp_path / 'script{}.txt'.format(n)
+        script.write_text('a: int = {}; print(a * 2);'.format(n))
+        scripts.append(str(script))
+
+    summaries = run_batch(scripts, workers=2)
+    assert [summary['path'] for summary in summaries] == scripts
+    assert [summary['output'] for summary in summaries] == [
+        '{}\n'.format(n * 2) for n in range(6)
+    ]
+
+
+def test_batch_main_json_with_failing_script(tmp_path, monkeypatch, capsys):
+    import json
+    from batch import main
+    (tmp_path / 'good.txt').write_text('print(1);')
+    (tmp_path / 'bad.txt').write_text('a: int = ;')
+    monkeypatch.setattr(
+        'sys.argv',
+        ['batch.py', '--json', '--workers', '2', str(tmp_path)]
+    )
+
+    with pytest.raises(SystemExit) as exc_info:
+        main()
+    assert exc_info.value.code == 1
+    # Nothing but the JSON is printed
+    summaries = json.loads(capsys.readouterr().out)
+    assert [summary['ok'] for summary in summaries] == [False, True]
+    assert 'token on error' in summaries[0]['output']
+    assert summaries[1]['output'] == '1\n'
+
+
+##################################
+# PROGRAM
+##################################
+
+RULE_PROGRAM = '''
+function sq(n: int): int { return n * n; }
+score: int = sq(age) + 3 * income;
+risky: bool = False;
+if (score > 1000) { risky = True; }
+'''
+
+RULE_INPUTS = {'age': 'int', 'income': 'int'}
+
+
+def test_program_runs_with_new_bindings():
+    from program import Program
+    program = Program(RULE_PROGRAM, inputs=RULE_INPUTS)
+    assert program.run({'age': 30, 'income': 200}) == {
+        'age': 30, 'income': 200, 'score': 1500, 'risky': True,
+    }
+    # Nothing is left over from the first run
+    assert program.run({'age': 2, 'income': 1}) == {
+        'age': 2, 'income': 1, 'score': 7, 'risky': False,
+    }
+
+
+def test_program_inputs_take_first_slots():
+    from program import Program
+    program = Program('total: float = price * count;', inputs={'price': 'float', 'count': 'int'})
+    assert program.tree.frame_names == ('price', 'count', 'total')
+    assert program.run({'price': 2, 'count': 3}) == {'price': 2.0, 'count': 3, 'total': 6.0}
+
+
+@pytest.mark.parametrize('engine', ['closure', 'vm', 'python'])
+def test_program_on_other_engines(engine):
+    from program import Program
+    lines = []
+    program = Program(
+        'doubled: int = n * 2; print(doubled);',
+        inputs={'n': 'int'}, engine=engine, output=lines
+    )
+    assert [program.run({'n': n})['doubled'] for n in range(3)] == [0, 2, 4]
+    assert lines == ['0', '2', '4']
+
+
+@pytest.mark.parametrize('bindings, message', [
+    ({'age': 1}, 'Missing input "income"'),
+    ({'age': 1, 'income': 2, 'other': 3}, 'Unknown input "other"'),
+    ({'age': '1', 'income': 2}, 'Input "age" has to be int, not str'),
+    ({'age': True, 'income': 2}, 'Input "age" has to be int, not bool'),
+])
+def test_program_checks_bindings(bindings, message):
+    from program import Program
+    program = Program(RULE_PROGRAM, inputs=RULE_INPUTS)
+    with pytest.raises(TypeError, match=message):
+        program.run(bindings)
+
+
+@pytest.mark.parametrize('text, inputs', [
+    ('a: int = b + 1;', {'a': 'int'}),
+    ('a: str = b;', {'b': 'int'}),
+    ('a: int = 1;', {'a': 'int'}),
+])
+def test_program_analyses_inputs(text, inputs):
+    from program import Program
+    with pytest.raises(Exception):
+        Program(text, inputs=inputs)
+
+
+def test_program_rejects_unknown_input_type():
+    from program import Program
+    with pytest.raises(ValueError):
+        Program('a: int = 1;', inputs={'b': 'list'})
+
+
+##################################
+# VECTORIZED
+##################################
+
+VECTOR_PROGRAMS = [
+    RULE_PROGRAM,
+    # Functions that return early run row by row
+    'function fact(n: int): int { if (n < 2) { return 1; } return n * fact(n - 1); }'
+    'function cap(n: int): int { if (n > 20) { return 20; } return n; }'
+    'f: int = 0; if (age < 50) { f = fact(cap(age)); } g: int = fact(3);',
+    'function half(n: int): float { h: float = n / 2; if (h > 10) { h = h - 1; } return h; }'
+    'function label(n: int): str { if (n > 40) { return "high"; } return "low"; }'
+    'h: float = half(income) + half(2); l: str = label(age) + label(income);',
+    'function pick(a: int, b: int): int { r: int = a; if (b > a) { r = b; } return r; }'
+    'function nothing(n: int) { x: int = n; }'
+    'm: int = 0; nothing(age); if (age > 10) { m = pick(age, income); }',
+    'half: float = income / 2; neg: int = -age; big: bool = False; if (half > 100) { big = True; }',
+    'label: str = "low"; if (age > 40) { label = "high"; extra: int = age - 40; } else { label = label + "!"; }',
+    'n: int = age; steps: int = 0; while (n > 10) { n = n - 7; steps = steps + 1; }',
+    't: int = 0; for (i: int = 0; i < age; i = i + 5) { t = t + i; }',
+    'x: int = 0; if (age > 10) { if (income > 50) { x = 2; } else { x = 1; } }',
+    'fixed: int = 3; if (fixed > 1) { fixed = fixed * income; }',
+]
+
+
+@pytest.mark.parametrize('text', VECTOR_PROGRAMS)
+def test_vectorized_matches_interpreter(text):
+    numpy = pytest.importorskip('numpy')
+    from program import Program
+    program = Program(text, inputs=RULE_INPUTS)
+    ages = [0, 5, 11, 40, 41, 77]
+    incomes = [0, 51, 50, 300, 1000, 7]
+
+    columns = program.run_columns({
+        'age': numpy.array(ages), 'income': numpy.array(incomes),
+    })
+    for row, (age, income) in enumerate(zip(ages, incomes)):
+        expected = program.run({'age': age, 'income': income})
+        for name, value in expected.items():
+            assert columns[name][row] == value
+        assert len(columns[name]) == len(ages)
+
+
+def test_vectorized_column_types():
+    numpy = pytest.importorskip('numpy')
+    from program import Program
+    program = Program(
+        'a: int = n; b: float = n / 2; c: str = n * "x"; d: bool = False; if (n > 1) { d = True; }',
+        inputs={'n': 'int'}
+    )
+    columns = program.run_columns({'n': [1, 2]})
+    assert [columns[name].dtype for name in 'nabcd'] == [
+        numpy.int64, numpy.int64, numpy.float64, object, bool
+    ]
+    assert list(columns['c']) == ['x', 'xx']
+
+    # One value for all rows
+    columns = program.run_columns({'n': 3}, rows=2)
+    assert list(columns['a']) == [3, 3]
+
+
+def test_vectorized_division_by_zero():
+    pytest.importorskip('numpy')
+    from program import Program
+    program = Program('r: float = 0 / 1; if (d > 0) { r = 10 / d; }', inputs={'d': 'int'})
+    assert list(program.run_columns({'d': [0, 4]})['r']) == [0.0, 2.5]
+
+    program = Program('r: float = 10 / d;', inputs={'d': 'int'})
+    with pytest.raises(ZeroDivisionError):
+        program.run_columns({'d': [0, 4]})
+
+
+@pytest.mark.parametrize('columns, error', [
+    ({'n': ['a', 'b']}, TypeError),
+    ({'n': [1.5]}, TypeError),
+    ({'m': [1]}, TypeError),
+    ({}, TypeError),
+])
+def test_vectorized_checks_columns(columns, error):
+    pytest.importorskip('numpy')
+    from program import Program
+    program = Program('a: int = n;', inputs={'n': 'int'})
+    with pytest.raises(error):
+        program.run_columns(columns)
+
+
+def test_vectorized_column_lengths():
+    pytest.importorskip('numpy')
+    from program import Program
+    program = Program('a: int = n + m;', inputs={'n': 'int', 'm': 'int'})
+    with pytest.raises(ValueError):
+        program.run_columns({'n': [1, 2], 'm': [1, 2, 3]})
+
+
+@pytest.mark.parametrize('text', [
+    'a: int = n; print(n);',
+    'a: int = n; function f(): int { print(1); return 1; }',
+    'a: int = n; function f(): int { return n; } b: int = f();',
+])
+def test_vectorized_unsupported(text):
+    pytest.importorskip('numpy')
+    from program import Program
+    from vectorized import VectorInterpreter
+    program = Program(text, inputs={'n': 'int'})
+    # Refused before anything runs
+    with pytest.raises(NotImplementedError):
+        VectorInterpreter(program.tree)
+    with pytest.raises(NotImplementedError):
+        program.run_columns({'n': [1, 2]})
+
+
+def test_vectorized_function_max_depth():
+    pytest.importorskip('numpy')
+    from program import Program
+    program = Program(
+        # Not a tail call, those run in constant depth
+        'function f(n: int): int { return 1 + f(n + 1); } a: int = f(n);',
+        inputs={'n': 'int'}
+    )
+    with pytest.raises(RecursionError):
+        program.run_columns({'n': [1, 2]})
+
+
+def test_vectorized_needs_numpy(monkeypatch):
+    import vectorized
+    monkeypatch.setattr(vectorized, 'numpy', None)
+    with pytest.raises(ImportError):
+        vectorized.VectorInterpreter(analyse('a: int = 1;'))
@@ -0,0 +1,634 @@
+import gc
+from array import array
+
+import parser
+from interpreter import NodeVisitor
+from lexer import Token, types
+
+##############################################
+# AST Arena
+##############################################
+#
+# A flat alternative to the tree of parser nodes.
+# Every node is one row in a few parallel arrays:
+#   kinds  - which node it is (index into NODE_KINDS)
+#   a, b, c - operands, meaning depends on the kind
+#   expr_types - const of the node's expr_type (-1 if it has none)
+# Operands are indices of other nodes, of values in the
+# constant pool (consts) or of lists in the lists array.
+# A list is stored as its length followed by the items.
+# -1 stands for a missing operand (like an if without else).
+#
+#   Number       a=const
+#   Value        a=const
+#   Var          a=const (name)  b=const (token type)
+#                c=const ((slot, is_global))
+#   BinOp        a=left  b=const (op type)  c=right
+#   Comparison   a=left  b=const (op type)  c=right
+#   UnaryOp      a=const (op type)  b=expr
+#   Block        a=list (children)  b=const (frame names)
+#   Assign       a=name  b=value  c=const (type)
+#   Print        a=expr
+#   IfStatement  a=value  b=block  c=elseblock
+#   Param        a=var_node  b=type_node
+#   FuncDecl     a=const ((name, is_pure))  b=list (params)  c=block_node
+#                expr_types=const (return type)
+#   Empty
+#   FuncCall     a=const (name)  b=list (args)
+#   Return       a=expr  b=tail_call
+#   WhileLoop    a=value  b=block
+#   ForLoop      a=list (init, value, step, block)  b=counted
+
+NODE_KINDS = (
+    'Number', 'Value', 'Var', 'BinOp', 'Comparison', 'UnaryOp', 'Block',
+    'Assign', 'Print', 'IfStatement', 'Param', 'FuncDecl', 'Empty',
+    'FuncCall', 'Return', 'WhileLoop', 'ForLoop',
+)
+KIND = {name: index for index, name in enumerate(NODE_KINDS)}
+
+# Value of an operator token, from its type
+OP_VALUES = {token_type: value for value, token_type in types.items()}
+OP_VALUES['DBLEQUAL'] = '=='
+
+
+class Arena(object):
+    def __init__(self):
+        self.kinds = array('B')
+        self.a = array('i')
+        self.b = array('i')
+        self.c = array('i')
+        self.expr_types = array('i')
+        self.lists = array('i')
+        self.consts = []
+        self.root_index = -1
+
+        self._const_index = {}
+        # One shared Token per operator type
+        self._op_tokens = {}
+
+    @classmethod
+    def from_tree(cls, tree):
+        arena = cls()
+        arena.root_index = ArenaBuilder(arena).visit(tree)
+        return arena
+
+    def add(self, kind, a=-1, b=-1, c=-1, expr_type=None):
+        self.kinds.append(KIND[kind])
+        self.a.append(a)
+        self.b.append(b)
+        self.c.append(c)
+        self.expr_types.append(
+            -1 if expr_type is None else self.const(expr_type)
+        )
+        return len(self.kinds) - 1
+
+    def add_list(self, items):
+        start = len(self.lists)
+        self.lists.append(len(items))
+        self.lists.extend(items)
+        return start
+
+    def const(self, value):
+        # Keyed with the type so True and 1 stay apart
+        key = (type(value), value)
+        index = self._const_index.get(key)
+        if index is None:
+            index = self._const_index[key] = len(self.consts)
+            self.consts.append(value)
+        return index
+
+    def get_list(self, start):
+        count = self.lists[start]
+        return self.lists[start + 1:start + 1 + count]
+
+    def op_token(self, const_index):
+        token_type = self.consts[const_index]
+        token = self._op_tokens.get(token_type)
+        if token is None:
+            token = Token(token_type, OP_VALUES.get(token_type))
+            self._op_tokens[token_type] = token
+        return token
+
+    def node(self, index):
+        # View of the node at index, which the NodeVisitor
+        # subclasses can walk like a parser node
+        if index == -1:
+            return None
+        return VIEWS[self.kinds[index]](self, index)
+
+    @property
+    def root(self):
+        return self.node(self.root_index)
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def nbytes(self):
+        # Memory used by the arrays
+        return sum(
+            column.itemsize * len(column)
+            for column in (
+                self.kinds, self.a, self.b, self.c,
+                self.expr_types, self.lists
+            )
+        )
+
+    def to_tree(self):
+        # Builds regular parser nodes back from the arena. Children
+        # come before their parents (see ArenaBuilder), so one pass
+        # in index order has every child ready for its parent
+        if self.root_index == -1:
+            return None
+
+        consts = self.consts
+        nodes = []
+        append = nodes.append
+        # None of the new nodes are garbage, the
+        # cyclic GC would only slow the loop down
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for kind, a, b, c, expr_type in zip(
+                self.kinds, self.a, self.b, self.c, self.expr_types
+            ):
+                append(BUILDERS[kind](
+                    self, nodes, a, b, c,
+                    None if expr_type == -1 else consts[expr_type]
+                ))
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+        return nodes[self.root_index]
+
+
+class ArenaBuilder(NodeVisitor):
+    # Flattens a tree into an Arena. Children are added
+    # before their parents, so the root is the last node
+    def __init__(self, arena):
+        self.arena = arena
+
+    def visit_optional(self, node):
+        if node is None:
+            return -1
+        return self.visit(node)
+
+    def visit_Number(self, node):
+        return self.arena.add(
+            'Number',
+            self.arena.const(node.value),
+            expr_type=node.expr_type
+        )
+
+    def visit_Value(self, node):
+        return self.arena.add(
+            'Value',
+            self.arena.const(node.value),
+            expr_type=node.expr_type
+        )
+
+    def visit_Var(self, node):
+        return self.arena.add(
+            'Var',
+            self.arena.const(node.value),
+            self.arena.const(node.token.type),
+            -1 if node.slot is None else self.arena.const(
+                (node.slot, node.is_global)
+            ),
+            node.expr_type
+        )
+
+    def visit_BinOp(self, node):
+        return self.arena.add(
+            'BinOp',
+            self.visit(node.left),
+            self.arena.const(node.op.type),
+            self.visit(node.right),
+            node.expr_type
+        )
+
+    def visit_Comparison(self, node):
+        return self.arena.add(
+            'Comparison',
+            self.visit(node.left),
+            self.arena.const(node.op.type),
+            self.visit(node.right),
+            node.expr_type
+        )
+
+    def visit_UnaryOp(self, node):
+        return self.arena.add(
+            'UnaryOp',
+            self.arena.const(node.op.type),
+            self.visit(node.expr),
+            expr_type=node.expr_type
+        )
+
+    def visit_Block(self, node):
+        children = [self.visit(child) for child in node.children]
+        if node.frame_names is None:
+            frame_names = -1
+        else:
+            frame_names = self.arena.const(node.frame_names)
+        return self.arena.add(
+            'Block',
+            self.arena.add_list(children),
+            frame_names
+        )
+
+    def visit_Assign(self, node):
+        if node.type is None:
+            var_type = -1
+        else:
+            var_type = self.arena.const(node.type.value)
+
+        return self.arena.add(
+            'Assign',
+            self.visit(node.name),
+            self.visit(node.value),
+            var_type
+        )
+
+    def visit_Print(self, node):
+        return self.arena.add('Print', self.visit_optional(node.expr))
+
+    def visit_IfStatement(self, node):
+        return self.arena.add(
+            'IfStatement',
+            self.visit(node.value),
+            self.visit(node.block),
+            self.visit_optional(node.elseblock)
+        )
+
+    def visit_Param(self, node):
+        return self.arena.add(
+            'Param',
+            self.visit(node.var_node),
+            self.visit(node.type_node)
+        )
+
+    def visit_FuncDecl(self, node):
+        params = [self.visit(param) for param in node.params]
+        return self.arena.add(
+            'FuncDecl',
+            self.arena.const((node.func_name, node.is_pure)),
+            self.arena.add_list(params),
+            self.visit(node.block_node),
+            None if node.return_type is None else node.return_type.value
+        )
+
+    def visit_FuncCall(self, node):
+        args = [self.visit(arg) for arg in node.args]
+        return self.arena.add(
+            'FuncCall',
+            self.arena.const(node.func_name),
+            self.arena.add_list(args),
+            expr_type=node.expr_type
+        )
+
+    def visit_WhileLoop(self, node):
+        return self.arena.add(
+            'WhileLoop',
+            self.visit(node.value),
+            self.visit(node.block)
+        )
+
+    def visit_ForLoop(self, node):
+        parts = [
+            self.visit(node.init),
+            self.visit(node.value),
+            self.visit(node.step),
+            self.visit(node.block),
+        ]
+        return self.arena.add(
+            'ForLoop',
+            self.arena.add_list(parts),
+            int(node.counted)
+        )
+
+    def visit_Return(self, node):
+        return self.arena.add(
+            'Return',
+            self.visit_optional(node.expr),
+            int(node.tail_call)
+        )
+
+    def visit_Empty(self, node):
+        return self.arena.add('Empty')
+
+
+##############################################
+# Views
+##############################################
+#
+# A view is a small (arena, index) object that reads the
+# node's attributes out of the arena when they are asked for.
+# Each view class subclasses the parser node it stands for and
+# has the same name, so visit_<Name> dispatch and isinstance
+# checks in the visitors work on views unchanged.
+
+
+class ArenaNode(object):
+    __slots__ = ()
+
+
+def _view_init(self, arena, index):
+    self.arena = arena
+    self.index = index
+
+
+def _child(column):
+    def get(self):
+        return self.arena.node(getattr(self.arena, column)[self.index])
+    return property(get)
+
+
+def _const(column):
+    def get(self):
+        index = getattr(self.arena, column)[self.index]
+        if index == -1:
+            return None
+        return self.arena.consts[index]
+    return property(get)
+
+
+def _list_item(column, position):
+    def get(self):
+        arena = self.arena
+        start = getattr(arena, column)[self.index]
+        # The list's length comes before the items
+        return arena.node(arena.lists[start + 1 + position])
+    return property(get)
+
+
+def _flag(column):
+    def get(self):
+        return bool(getattr(self.arena, column)[self.index])
+    return property(get)
+
+
+def _func_name(self):
+    return self.arena.consts[self.arena.a[self.index]][0]
+
+
+def _func_is_pure(self):
+    return self.arena.consts[self.arena.a[self.index]][1]
+
+
+def _var_slot(self):
+    index = self.arena.c[self.index]
+    if index == -1:
+        return None
+    return self.arena.consts[index][0]
+
+
+def _var_is_global(self):
+    index = self.arena.c[self.index]
+    if index == -1:
+        return True
+    return self.arena.consts[index][1]
+
+
+# Views are made again every time a node is read, so
+# they can't keep the Interpreter's type feedback
+_no_feedback = property(lambda self: None, lambda self, value: None)
+
+
+def _op(column):
+    def get(self):
+        return self.arena.op_token(getattr(self.arena, column)[self.index])
+    return property(get)
+
+
+def _children(column):
+    def get(self):
+        arena = self.arena
+        start = getattr(arena, column)[self.index]
+        return [arena.node(index) for index in arena.get_list(start)]
+    return property(get)
+
+
+def _type_token(column):
+    def get(self):
+        index = getattr(self.arena, column)[self.index]
+        if index == -1:
+            return None
+        return Token('TYPE', self.arena.consts[index])
+    return property(get)
+
+
+def _var_token(self):
+    return Token(self.arena.consts[self.arena.b[self.index]], self.value)
+
+
+def _view(node_class, **fields):
+    namespace = dict(fields)
+    namespace['__slots__'] = ('arena', 'index')
+    namespace['__init__'] = _view_init
+    namespace['node_class'] = node_class
+    return type(node_class.__name__, (ArenaNode, node_class), namespace)
+
+
+Number = _view(
+    parser.Number,
+    value=_const('a'), expr_type=_const('expr_types')
+)
+Value = _view(
+    parser.Value,
+    value=_const('a'), expr_type=_const('expr_types')
+)
+Var = _view(
+    parser.Var,
+    value=_const('a'), token=property(_var_token),
+    slot=property(_var_slot), is_global=property(_var_is_global),
+    expr_type=_const('expr_types')
+)
+BinOp = _view(
+    parser.BinOp,
+    left=_child('a'), op=_op('b'), right=_child('c'),
+    expr_type=_const('expr_types'),
+    quick=_no_feedback, warmup=_no_feedback
+)
+Comparison = _view(
+    parser.Comparison,
+    left=_child('a'), op=_op('b'), right=_child('c'),
+    expr_type=_const('expr_types'),
+    quick=_no_feedback, warmup=_no_feedback
+)
+UnaryOp = _view(
+    parser.UnaryOp,
+    op=_op('a'), expr=_child('b'), expr_type=_const('expr_types')
+)
+Block = _view(
+    parser.Block,
+    children=_children('a'), frame_names=_const('b')
+)
+Assign = _view(
+    parser.Assign,
+    name=_child('a'), value=_child('b'), type=_type_token('c')
+)
+Print = _view(parser.Print, expr=_child('a'))
+IfStatement = _view(
+    parser.IfStatement,
+    value=_child('a'), block=_child('b'), elseblock=_child('c')
+)
+Param = _view(parser.Param, var_node=_child('a'), type_node=_child('b'))
+FuncDecl = _view(
+    parser.FuncDecl,
+    func_name=property(_func_name), params=_children('b'),
+    block_node=_child('c'), return_type=_type_token('expr_types'),
+    is_pure=property(_func_is_pure)
+)
+Empty = _view(parser.Empty)
+FuncCall = _view(
+    parser.FuncCall,
+    func_name=_const('a'), args=_children('b'),
+    expr_type=_const('expr_types')
+)
+Return = _view(parser.Return, expr=_child('a'), tail_call=_flag('b'))
+WhileLoop = _view(parser.WhileLoop, value=_child('a'), block=_child('b'))
+ForLoop = _view(
+    parser.ForLoop,
+    init=_list_item('a', 0), value=_list_item('a', 1),
+    step=_list_item('a', 2), block=_list_item('a', 3),
+    counted=_flag('b')
+)
+
+# View class for every kind, in NODE_KINDS order
+VIEWS = tuple(globals()[name] for name in NODE_KINDS)
+
+
+##############################################
+# Builders
+##############################################
+#
+# Make the parser node of one row for Arena.to_tree().
+# nodes holds the nodes of all the rows before it.
+# They are called as builder(arena, nodes, a, b, c, expr_type)
+
+
+def _optional(nodes, index):
+    if index == -1:
+        return None
+    return nodes[index]
+
+
+def _type_value(arena, index):
+    if index == -1:
+        return None
+    return Token('TYPE', arena.consts[index])
+
+
+def _build_number(arena, nodes, a, b, c, expr_type):
+    # Number() takes a token, the value is set directly
+    node = parser.Number.__new__(parser.Number)
+    node.value = arena.consts[a]
+    node.expr_type = expr_type
+    return node
+
+
+def _build_value(arena, nodes, a, b, c, expr_type):
+    node = parser.Value(arena.consts[a])
+    node.expr_type = expr_type
+    return node
+
+
+def _build_var(arena, nodes, a, b, c, expr_type):
+    consts = arena.consts
+    node = parser.Var(Token(consts[b], consts[a]))
+    if c != -1:
+        node.slot, node.is_global = consts[c]
+    node.expr_type = expr_type
+    return node
+
+
+def _build_binop(arena, nodes, a, b, c, expr_type):
+    node = parser.BinOp(nodes[a], arena.op_token(b), nodes[c])
+    node.expr_type = expr_type
+    return node
+
+
+def _build_comparison(arena, nodes, a, b, c, expr_type):
+    node = parser.Comparison(nodes[a], arena.op_token(b), nodes[c])
+    node.expr_type = expr_type
+    return node
+
+
+def _build_unaryop(arena, nodes, a, b, c, expr_type):
+    node = parser.UnaryOp(arena.op_token(a), nodes[b])
+    node.expr_type = expr_type
+    return node
+
+
+def _build_block(arena, nodes, a, b, c, expr_type):
+    node = parser.Block()
+    node.children = [nodes[index] for index in arena.get_list(a)]
+    if b != -1:
+        node.frame_names = arena.consts[b]
+    return node
+
+
+def _build_assign(arena, nodes, a, b, c, expr_type):
+    return parser.Assign(nodes[a], nodes[b], _type_value(arena, c))
+
+
+def _build_print(arena, nodes, a, b, c, expr_type):
+    return parser.Print(_optional(nodes, a))
+
+
+def _build_if(arena, nodes, a, b, c, expr_type):
+    return parser.IfStatement(nodes[a], nodes[b], _optional(nodes, c))
+
+
+def _build_param(arena, nodes, a, b, c, expr_type):
+    return parser.Param(nodes[a], nodes[b])
+
+
+def _build_funcdecl(arena, nodes, a, b, c, expr_type):
+    # The return type is stored as the name of the type
+    name, is_pure = arena.consts[a]
+    node = parser.FuncDecl(
+        name,
+        [nodes[index] for index in arena.get_list(b)],
+        nodes[c],
+        None if expr_type is None else Token('TYPE', expr_type)
+    )
+    node.is_pure = is_pure
+    return node
+
+
+def _build_empty(arena, nodes, a, b, c, expr_type):
+    return parser.Empty()
+
+
+def _build_funccall(arena, nodes, a, b, c, expr_type):
+    node = parser.FuncCall(
+        arena.consts[a], [nodes[index] for index in arena.get_list(b)]
+    )
+    node.expr_type = expr_type
+    return node
+
+
+def _build_return(arena, nodes, a, b, c, expr_type):
+    node = parser.Return(_optional(nodes, a))
+    node.tail_call = bool(b)
+    return node
+
+
+def _build_while(arena, nodes, a, b, c, expr_type):
+    return parser.WhileLoop(nodes[a], nodes[b])
+
+
+def _build_for(arena, nodes, a, b, c, expr_type):
+    init, value, step, block = arena.get_list(a)
+    node = parser.ForLoop(nodes[init], nodes[value], nodes[step], nodes[block])
+    node.counted = bool(b)
+    return node
+
+
+# Builder for every kind, in NODE_KINDS order
+BUILDERS = (
+    _build_number, _build_value, _build_var, _build_binop,
+    _build_comparison, _build_unaryop, _build_block, _build_assign,
+    _build_print, _build_if, _build_param, _build_funcdecl, _build_empty,
+    _build_funccall, _build_return, _build_while, _build_for,
+)
@@ -0,0 +1,190 @@
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from interpreter import ENGINES, get_engine, load_program, optimize
+
+##############################################
+# Batch Runner
+##############################################
+#
+# Runs many programs with one pool of worker processes, so every
+# program doesn't pay for starting Python and importing the
+# interpreter. Workers take programs until there are none left.
+#
+# Every program gets a summary (see run_script) with what it
+# printed, the error it stopped with and how long it took.
+
+# Files taken from a directory
+SCRIPT_PATTERN = '*.txt'
+
+
+def find_scripts(paths, pattern=SCRIPT_PATTERN):
+    # Files, directories (searched recursively for pattern)
+    # and glob patterns, to a list of files without repeats
+    scripts = []
+    seen = set()
+    for path in paths:
+        if os.path.isdir(path):
+            found = glob.glob(
+                os.path.join(glob.escape(path), '**', pattern),
+                recursive=True
+            )
+        elif os.path.exists(path):
+            found = [path]
+        else:
+            found = glob.glob(path, recursive=True)
+        for script in sorted(found):
+            if os.path.isfile(script) and script not in seen:
+                seen.add(script)
+                scripts.append(script)
+    return scripts
+
+
+def run_script(path, engine='tree', optimized=True, cache_dir=None):
+    # Runs one program and returns its summary ->
+    #   path, ok, output (everything it printed, also when it failed),
+    #   error (None or the message), error_type,
+    #   compile_seconds and run_seconds
+    summary = {
+        'path': path,
+        'ok': False,
+        'output': '',
+        'error': None,
+        'error_type': None,
+        'compile_seconds': 0.0,
+        'run_seconds': 0.0,
+    }
+
+    cache = None
+    if cache_dir is not None:
+        from cache import CompileCache
+        cache = CompileCache(cache_dir)
+
+    output = io.StringIO()
+    started = time.perf_counter()
+    # What the front end prints (like the Parser's diagnostics) goes
+    # into the summary too, not to the stdout of the worker
+    with contextlib.redirect_stdout(output):
+        try:
+            tree = load_program(path, cache)
+            if optimized:
+                tree = optimize(tree)[0]
+            compiled = time.perf_counter()
+            summary['compile_seconds'] = compiled - started
+
+            get_engine(engine)(tree, output=output).interpret()
+            summary['run_seconds'] = time.perf_counter() - compiled
+            summary['ok'] = True
+        except Exception as exc:
+            summary['error'] = str(exc)
+            summary['error_type'] = type(exc).__name__
+    summary['output'] = output.getvalue()
+    return summary
+
+
+def run_batch(scripts, workers=None, engine='tree', optimized=True,
+              cache_dir=None):
+    # Summaries of all the scripts, in the order of scripts.
+    # workers=None uses a process for every CPU
+    count = len(scripts)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    # Scripts are sent to the workers a few at a time, which
+    # costs less than one message per script for many small ones
+    chunksize = max(1, count // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(
+            run_script,
+            scripts,
+            [engine] * count,
+            [optimized] * count,
+            [cache_dir] * count,
+            chunksize=chunksize
+        ))
+
+
+def report(summaries, file=None):
+    # One line per script, then what failed scripts said
+    if file is None:
+        file = sys.stdout
+    for summary in summaries:
+        print('{:<6} {:>9.4f} s {:>9.4f} s  {}'.format(
+            'ok' if summary['ok'] else 'FAILED',
+            summary['compile_seconds'],
+            summary['run_seconds'],
+            summary['path']
+        ), file=file)
+
+    failed = [summary for summary in summaries if not summary['ok']]
+    for summary in failed:
+        print('\n{}: {}: {}'.format(
+            summary['path'], summary['error_type'], summary['error']
+        ), file=file)
+    print(
+        '\n{} scripts, {} failed'.format(len(summaries), len(failed)),
+        file=file
+    )
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Runs many programs')
+    arg_parser.add_argument(
+        'paths',
+        nargs='+',
+        help='files, directories or glob patterns'
+    )
+    arg_parser.add_argument('--engine', choices=ENGINES, default='tree')
+    arg_parser.add_argument(
+        '--workers',
+        type=int,
+        help='number of worker processes (default: one per CPU)'
+    )
+    arg_parser.add_argument(
+        '--pattern',
+        default=SCRIPT_PATTERN,
+        help='files to take from directories'
+    )
+    arg_parser.add_argument(
+        '--no-optimize',
+        action='store_true',
+        help='run the programs without the optimizer passes'
+    )
+    arg_parser.add_argument(
+        '--cache-dir',
+        help='keep analysed programs in this directory and reuse them'
+    )
+    arg_parser.add_argument(
+        '--json',
+        action='store_true',
+        help='print the summaries as JSON'
+    )
+    args = arg_parser.parse_args()
+
+    scripts = find_scripts(args.paths, args.pattern)
+    summaries = run_batch(
+        scripts,
+        workers=args.workers,
+        engine=args.engine,
+        optimized=not args.no_optimize,
+        cache_dir=args.cache_dir,
+    )
+
+    if args.json:
+        json.dump(summaries, sys.stdout, indent=2)
+        print()
+    else:
+        report(summaries)
+
+    if not all(summary['ok'] for summary in summaries):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+import argparse
+import gc
+import io
+import os
+import time
+import tracemalloc
+
+from interpreter import ENGINES, Interpreter, NodeVisitor, get_engine
+from lexer import Lexer, TokenBuffer
+import parser
+from parser import Parser
+from semantic_analizer import SemanticAnalyser
+
+##############################################
+# Benchmarks
+##############################################
+#
+# python bench.py <benchmark> [--lines N]
+#
+# Every benchmark runs on a generated script
+# with N copies of SAMPLE_LINES
+
+
+SAMPLE_LINES = [
+    'variable{n}: int = 3 * 3 - 6;',
+    'other{n}: float = 70 + 12 / 4;',
+    '/* comment number {n} */',
+    'text{n}: str = "Whatever number {n}";',
+    'if (variable{n} < other{n}) {{',
+    '    print("Whatever1");',
+    '}} else {{',
+    '    print(text{n});',
+    '}}',
+]
+
+
+def generate_program(lines):
+    # Names can only use letters, so the
+    # copy number is spelled with letters too
+    program = []
+    for n in range(lines):
+        suffix = ''.join(chr(ord('a') + int(digit)) for digit in str(n))
+        for line in SAMPLE_LINES:
+            program.append(line.format(n=suffix))
+    return '\n'.join(program) + '\n'
+
+
+def measure(function, *args):
+    # Returns (result, seconds, bytes still allocated by the result)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return result, seconds, retained
+
+
+def report(title, rows):
+    print(title)
+    for name, seconds, memory in rows:
+        print('  {:<28} {:>10.4f} s {:>14,} bytes'.format(name, seconds, memory))
+
+
+def token_list(text):
+    lexer = Lexer(text, engine='regex')
+    tokens = []
+    while True:
+        token = lexer.get_next_token()
+        tokens.append(token)
+        if token.type == 'EOF':
+            return tokens
+
+
+def bench_tokens(text):
+    # Token objects vs the array backed TokenBuffer:
+    # memory held by a whole file's tokens and the time
+    # it takes to build them and to parse from them
+    tokens, list_time, list_memory = measure(token_list, text)
+    buffer, buffer_time, buffer_memory = measure(TokenBuffer.from_text, text)
+
+    start = time.perf_counter()
+    Parser(iter(tokens)).parse()
+    list_parse = time.perf_counter() - start
+
+    start = time.perf_counter()
+    Parser(buffer).parse()
+    buffer_parse = time.perf_counter() - start
+
+    report('{:,} tokens'.format(len(buffer)), [
+        ('Token list (build)', list_time, list_memory),
+        ('TokenBuffer (build)', buffer_time, buffer_memory),
+        ('Token list (parse)', list_parse, 0),
+        ('TokenBuffer (parse)', buffer_parse, 0),
+    ])
+
+
+def ast_memory_report(text):
+    # Bytes held by the parsed tree, per source line
+    # and per line of parser.py that allocated them
+    lexer = Lexer(text, engine='regex')
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tree = Parser(lexer).parse()
+    del lexer
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    parser_file = os.path.abspath(parser.__file__)
+    stats = [
+        stat for stat in after.compare_to(before, 'lineno')
+        if stat.size_diff > 0
+    ]
+    total = sum(stat.size_diff for stat in stats)
+    by_line = [
+        stat for stat in stats
+        if stat.traceback[0].filename == parser_file
+    ]
+    return tree, total, by_line
+
+
+def bench_ast(text):
+    source_lines = text.count('\n')
+    tree, total, by_line = ast_memory_report(text)
+
+    print('{:,} source lines, {:,} AST bytes, {:.1f} bytes per line'.format(
+        source_lines, total, total / source_lines
+    ))
+    for stat in by_line[:10]:
+        frame = stat.traceback[0]
+        print('  parser.py:{:<5} {:>12,} bytes {:>10,} blocks'.format(
+            frame.lineno, stat.size_diff, stat.count_diff
+        ))
+
+    def parse_arena():
+        return Parser(Lexer(text, engine='regex')).parse_arena()
+
+    arena, seconds, retained = measure(parse_arena)
+    print('Arena: {:,} nodes, {:,} bytes, {:.1f} bytes per line'.format(
+        len(arena), retained, retained / source_lines
+    ))
+
+
+# Walks the whole tree and does nothing else,
+# so the time is all dispatch
+class Walker(NodeVisitor):
+    def visit_Block(self, node):
+        for child in node.children:
+            self.visit(child)
+
+    def visit_Assign(self, node):
+        self.visit(node.value)
+
+    def visit_IfStatement(self, node):
+        self.visit(node.value)
+        self.visit(node.block)
+        if node.elseblock is not None:
+            self.visit(node.elseblock)
+
+    def visit_BinOp(self, node):
+        self.visit(node.left)
+        self.visit(node.right)
+
+    visit_Comparison = visit_BinOp
+
+    def visit_UnaryOp(self, node):
+        self.visit(node.expr)
+
+    def visit_Print(self, node):
+        self.visit(node.expr)
+
+    def visit_Number(self, node):
+        pass
+
+    visit_Var = visit_Value = visit_Empty = visit_Number
+
+
+# The same walk with the old getattr based dispatch
+class GetattrWalker(Walker):
+    def visit(self, node):
+        method_name = 'visit_' + type(node).__name__
+        visitor = getattr(self, method_name, self.generic_visit)
+        return visitor(node)
+
+
+class CountingWalker(Walker):
+    def __init__(self):
+        self.visits = 0
+
+    def visit(self, node):
+        self.visits += 1
+        return Walker.visit(self, node)
+
+
+def bench_dispatch(text):
+    tree = Parser(Lexer(text, engine='regex')).parse()
+    counter = CountingWalker()
+    counter.visit(tree)
+
+    print('{:,} visits per walk'.format(counter.visits))
+    for walker in (GetattrWalker(), Walker()):
+        best = min(
+            measure_time(walker.visit, tree)
+            for _ in range(5)
+        )
+        print('  {:<28} {:>10.4f} s {:>10.1f} ns per visit'.format(
+            type(walker).__name__, best, best / counter.visits * 1e9
+        ))
+
+
+def measure_time(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def analysed_tree(text):
+    tree = Parser(Lexer(text, engine='regex')).parse()
+    SemanticAnalyser().visit(tree)
+    return tree
+
+
+def bench_analysis(text):
+    # The analyser only works with types, so the
+    # time per node doesn't depend on the values
+    tree = Parser(Lexer(text, engine='regex')).parse()
+    counter = CountingWalker()
+    counter.visit(tree)
+
+    seconds = measure_time(SemanticAnalyser().visit, tree)
+    print('{:,} nodes analysed in {:.4f} s, {:.1f} ns per node'.format(
+        counter.visits, seconds, seconds / counter.visits * 1e9
+    ))
+
+
+def bench_engines(text):
+    # Time to run the same tree with every engine.
+    # Output goes to a buffer, so printing costs the same for all
+    tree = analysed_tree(text)
+
+    # The first run includes compiling for the
+    # engines that compile, the later ones don't
+    print('  {:<16} {:>12} {:>12}'.format('engine', 'first run', 'best run'))
+    for name in ENGINES:
+        interpreter = get_engine(name)(tree, output=io.StringIO())
+        times = []
+        for _ in range(5):
+            times.append(measure_time(interpreter.interpret))
+        print('  {:<16} {:>10.4f} s {:>10.4f} s'.format(
+            name, times[0], min(times[1:])
+        ))
+
+
+def bench_loops(text):
+    # A counted for loop run by range() against the same loop
+    # going through the condition and the step every iteration.
+    # One iteration per line of the generated program
+    iterations = text.count('\n')
+    tree = analysed_tree(
+        't: int = 0;'
+        'for (i: int = 0; i < {}; i = i + 1) {{ t = t + i; }}'.format(iterations)
+    )
+    loop = tree.children[1]
+
+    for counted in (False, True):
+        loop.counted = counted
+        seconds = measure_time(Interpreter(tree).interpret)
+        print('  {:<16} {:>10.4f} s {:>10.1f} ns per iteration'.format(
+            'counted' if counted else 'generic',
+            seconds, seconds / iterations * 1e9
+        ))
+
+
+BENCHMARKS = {
+    'tokens': bench_tokens,
+    'ast': bench_ast,
+    'dispatch': bench_dispatch,
+    'analysis': bench_analysis,
+    'engines': bench_engines,
+    'loops': bench_loops,
+}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Interpreter benchmarks')
+    arg_parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    arg_parser.add_argument('--lines', type=int, default=2000)
+    args = arg_parser.parse_args()
+
+    BENCHMARKS[args.benchmark](generate_program(args.lines))
+
+
+if __name__ == '__main__':
+    main()
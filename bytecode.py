@@ -0,0 +1,485 @@
+import gc
+from array import array
+
+from interpreter import MAX_CALL_DEPTH, NodeVisitor
+from output import get_output
+from parser import FuncCall
+
+##############################################
+# Bytecode
+##############################################
+#
+# Third execution engine. The tree is compiled into a flat list
+# of instructions, which a stack based virtual machine runs in a
+# single loop, without recursion or attribute lookups on nodes.
+#
+# Every instruction is two ints -> opcode and argument.
+# The argument is an index into Code.consts or Code.names,
+# or an instruction index for jumps (0 when unused).
+#
+# Every function gets a Code of its own, kept in a Function in
+# the consts of the code that declares it. A call pushes the frame
+# of the caller onto the VM's call stack and runs the function's
+# code with a new scope, RETURN_VALUE goes back to the caller.
+# Inside functions, LOAD_NAME and STORE_NAME use the scope of the
+# call and LOAD_GLOBAL and STORE_GLOBAL the global one.
+
+OPCODES = (
+    'LOAD_CONST',      # push consts[arg]
+    'LOAD_NAME',       # push the variable names[arg]
+    'STORE_NAME',      # pop into the variable names[arg]
+    'BINARY_ADD',
+    'BINARY_SUB',
+    'BINARY_MUL',
+    'BINARY_DIV',
+    'COMPARE_LT',
+    'COMPARE_GT',
+    'COMPARE_EQ',
+    'UNARY_POS',
+    'UNARY_NEG',
+    'PRINT',           # pop and print
+    'JUMP',            # continue at instruction arg
+    'POP_JUMP_IF_FALSE',  # pop, continue at instruction arg if false
+    'LOAD_GLOBAL',     # push the global variable names[arg]
+    'STORE_GLOBAL',    # pop into the global variable names[arg]
+    'POP_TOP',         # pop and drop
+    'MAKE_FUNCTION',   # declare the Function consts[arg]
+    'CALL_FUNCTION',   # pop the arguments, call the function names[arg]
+    'TAIL_CALL',       # like CALL_FUNCTION, in place of the running call
+    'RETURN_VALUE',    # pop, return it to the caller
+)
+
+(
+    LOAD_CONST, LOAD_NAME, STORE_NAME,
+    BINARY_ADD, BINARY_SUB, BINARY_MUL, BINARY_DIV,
+    COMPARE_LT, COMPARE_GT, COMPARE_EQ,
+    UNARY_POS, UNARY_NEG,
+    PRINT, JUMP, POP_JUMP_IF_FALSE,
+    LOAD_GLOBAL, STORE_GLOBAL, POP_TOP,
+    MAKE_FUNCTION, CALL_FUNCTION, TAIL_CALL, RETURN_VALUE,
+) = range(len(OPCODES))
+
+# Opcodes whose argument is an index into consts/names/instructions
+CONST_OPS = (LOAD_CONST, MAKE_FUNCTION)
+NAME_OPS = (
+    LOAD_NAME, STORE_NAME, LOAD_GLOBAL, STORE_GLOBAL,
+    CALL_FUNCTION, TAIL_CALL,
+)
+JUMP_OPS = (JUMP, POP_JUMP_IF_FALSE)
+
+BINARY_OPS = {
+    'PLUS': BINARY_ADD,
+    'MINUS': BINARY_SUB,
+    'MULT': BINARY_MUL,
+    'DIV': BINARY_DIV,
+}
+
+COMPARE_OPS = {
+    'LSTHAN': COMPARE_LT,
+    'GRTHAN': COMPARE_GT,
+    'DBLEQUAL': COMPARE_EQ,
+}
+
+UNARY_OPS = {
+    'PLUS': UNARY_POS,
+    'MINUS': UNARY_NEG,
+}
+
+
+class Code(object):
+    def __init__(self):
+        # Pairs of (opcode, argument)
+        self.instructions = array('i')
+        self.consts = []
+        self.names = []
+
+        self._const_index = {}
+        self._name_index = {}
+
+    def __len__(self):
+        # Number of instructions
+        return len(self.instructions) // 2
+
+    def emit(self, opcode, arg=0):
+        # Returns the index of the new instruction
+        instructions = self.instructions
+        instructions.append(opcode)
+        instructions.append(arg)
+        return (len(instructions) >> 1) - 1
+
+    def pairs(self):
+        # Instructions as a list of (opcode, argument) tuples,
+        # the form that the VM loop reads fastest
+        flat = self.instructions.tolist()
+        return list(zip(flat[::2], flat[1::2]))
+
+    def patch(self, index, arg):
+        # Sets the argument of an already emitted instruction
+        self.instructions[index * 2 + 1] = arg
+
+    def const(self, value):
+        # Keyed with the type so True and 1 stay apart
+        key = (type(value), value)
+        index = self._const_index.get(key)
+        if index is None:
+            index = self._const_index[key] = len(self.consts)
+            self.consts.append(value)
+        return index
+
+    def name(self, name):
+        index = self._name_index.get(name)
+        if index is None:
+            index = self._name_index[name] = len(self.names)
+            self.names.append(name)
+        return index
+
+
+class Function(object):
+    # A compiled function declaration
+    def __init__(self, name, params, code):
+        self.name = name
+        # Names of the parameters, in order
+        self.params = params
+        self.code = code
+
+    def __repr__(self):
+        return '<function {}>'.format(self.name)
+
+
+class Compiler(NodeVisitor):
+    def __init__(self):
+        self.code = Code()
+        # Whether the code being compiled is a function's
+        self.in_function = False
+
+    def compile(self, tree):
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            self.visit(tree)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+        return self.code
+
+    def visit_Number(self, node):
+        self.code.emit(LOAD_CONST, self.code.const(node.value))
+
+    def visit_Value(self, node):
+        self.code.emit(LOAD_CONST, self.code.const(node.value))
+
+    def visit_Var(self, node):
+        if self.in_function and node.is_global:
+            opcode = LOAD_GLOBAL
+        else:
+            opcode = LOAD_NAME
+        self.code.emit(opcode, self.code.name(node.value))
+
+    def visit_BinOp(self, node):
+        self.visit(node.left)
+        self.visit(node.right)
+        self.code.emit(BINARY_OPS[node.op.type])
+
+    def visit_Comparison(self, node):
+        self.visit(node.left)
+        self.visit(node.right)
+        self.code.emit(COMPARE_OPS[node.op.type])
+
+    def visit_UnaryOp(self, node):
+        self.visit(node.expr)
+        self.code.emit(UNARY_OPS[node.op.type])
+
+    def visit_Block(self, node):
+        for child in node.children:
+            self.visit(child)
+            # The result of a call made as a statement isn't used
+            if isinstance(child, FuncCall):
+                self.code.emit(POP_TOP)
+
+    def visit_Empty(self, node):
+        pass
+
+    def visit_Assign(self, node):
+        self.visit(node.value)
+        if self.in_function and node.name.is_global:
+            opcode = STORE_GLOBAL
+        else:
+            opcode = STORE_NAME
+        self.code.emit(opcode, self.code.name(node.name.value))
+
+    def visit_Print(self, node):
+        self.visit(node.expr)
+        self.code.emit(PRINT)
+
+    def visit_IfStatement(self, node):
+        self.visit(node.value)
+        jump_to_else = self.code.emit(POP_JUMP_IF_FALSE)
+        self.visit(node.block)
+
+        if node.elseblock is None:
+            self.code.patch(jump_to_else, len(self.code))
+            return
+
+        jump_to_end = self.code.emit(JUMP)
+        self.code.patch(jump_to_else, len(self.code))
+        self.visit(node.elseblock)
+        self.code.patch(jump_to_end, len(self.code))
+
+    def visit_WhileLoop(self, node):
+        self.loop(node.value, node.block)
+
+    def visit_ForLoop(self, node):
+        self.visit(node.init)
+        self.loop(node.value, node.block, node.step)
+
+    def loop(self, test, block, step=None):
+        #   start: test
+        #          POP_JUMP_IF_FALSE end
+        #          block, step
+        #          JUMP start
+        #   end:
+        start = len(self.code)
+        self.visit(test)
+        jump_to_end = self.code.emit(POP_JUMP_IF_FALSE)
+        self.visit(block)
+        if step is not None:
+            self.visit(step)
+        self.code.emit(JUMP, start)
+        self.code.patch(jump_to_end, len(self.code))
+
+    def visit_FuncDecl(self, node):
+        if node.block_node.frame_names is None:
+            raise Exception(
+                'Function calls need a tree that went through the SemanticAnalyser'
+            )
+
+        outer_code = self.code
+        outer = self.in_function
+        self.code = Code()
+        self.in_function = True
+        try:
+            self.visit(node.block_node)
+            # Functions that get to the end return nothing
+            self.code.emit(LOAD_CONST, self.code.const(None))
+            self.code.emit(RETURN_VALUE)
+            function = Function(
+                node.func_name,
+                tuple(param.var_node.value for param in node.params),
+                self.code
+            )
+        finally:
+            self.code = outer_code
+            self.in_function = outer
+
+        self.code.emit(MAKE_FUNCTION, self.code.const(function))
+
+    def visit_FuncCall(self, node, opcode=CALL_FUNCTION):
+        # Arguments are pushed in order, the last one on top
+        for arg in node.args:
+            self.visit(arg)
+        self.code.emit(opcode, self.code.name(node.func_name))
+
+    def visit_Return(self, node):
+        if node.expr is None:
+            self.code.emit(LOAD_CONST, self.code.const(None))
+        elif node.tail_call:
+            self.visit_FuncCall(node.expr, TAIL_CALL)
+            return
+        else:
+            self.visit(node.expr)
+        self.code.emit(RETURN_VALUE)
+
+
+class VM(object):
+    def __init__(self, output=None, max_depth=MAX_CALL_DEPTH):
+        self.GLOBAL_SCOPE = {}
+        self.output = get_output(output)
+        # (Function, its instructions) by name,
+        # added when the declaration runs
+        self.functions = {}
+        self.max_depth = max_depth
+
+    def run(self, code):
+        instructions = code.pairs()
+        consts = code.consts
+        names = code.names
+        global_scope = scope = self.GLOBAL_SCOPE
+        functions = self.functions
+        max_depth = self.max_depth
+        print_value = self.output.print_value
+
+        stack = []
+        push = stack.append
+        pop = stack.pop
+
+        # What the callers go on with when the calls return ->
+        # (instructions, consts, names, scope, pc)
+        frames = []
+
+        # Index of the next instruction
+        pc = 0
+        end = len(instructions)
+
+        while pc < end:
+            opcode, arg = instructions[pc]
+            pc += 1
+
+            # Most common instructions first
+            if opcode == LOAD_CONST:
+                push(consts[arg])
+            elif opcode == LOAD_NAME:
+                value = scope.get(names[arg])
+                if value is None:
+                    raise NameError(
+                        'Variable "{}" is not defined'.format(names[arg])
+                    )
+                push(value)
+            elif opcode == STORE_NAME:
+                scope[names[arg]] = pop()
+            elif opcode == PRINT:
+                print_value(pop())
+            elif opcode == BINARY_ADD:
+                right = pop()
+                stack[-1] += right
+            elif opcode == BINARY_SUB:
+                right = pop()
+                stack[-1] -= right
+            elif opcode == BINARY_MUL:
+                right = pop()
+                stack[-1] *= right
+            elif opcode == BINARY_DIV:
+                right = pop()
+                stack[-1] /= right
+            elif opcode == POP_JUMP_IF_FALSE:
+                if not pop():
+                    pc = arg
+            elif opcode == JUMP:
+                pc = arg
+            elif opcode == COMPARE_LT:
+                right = pop()
+                stack[-1] = stack[-1] < right
+            elif opcode == COMPARE_GT:
+                right = pop()
+                stack[-1] = stack[-1] > right
+            elif opcode == COMPARE_EQ:
+                right = pop()
+                stack[-1] = stack[-1] == right
+            elif opcode == UNARY_NEG:
+                stack[-1] = -stack[-1]
+            elif opcode == UNARY_POS:
+                stack[-1] = +stack[-1]
+            elif opcode == LOAD_GLOBAL:
+                value = global_scope.get(names[arg])
+                if value is None:
+                    raise NameError(
+                        'Variable "{}" is not defined'.format(names[arg])
+                    )
+                push(value)
+            elif opcode == STORE_GLOBAL:
+                global_scope[names[arg]] = pop()
+            elif opcode == POP_TOP:
+                pop()
+            elif opcode == CALL_FUNCTION or opcode == TAIL_CALL:
+                function = functions.get(names[arg])
+                if function is None:
+                    raise NameError(
+                        'Function "{}" is not defined'.format(names[arg])
+                    )
+                function, function_instructions = function
+
+                # The parameters are the top of the stack
+                params = function.params
+                if params:
+                    args = stack[-len(params):]
+                    del stack[-len(params):]
+                    call_scope = dict(zip(params, args))
+                else:
+                    call_scope = {}
+
+                # A tail call replaces the running call,
+                # so the call stack doesn't grow
+                if opcode == CALL_FUNCTION:
+                    if len(frames) >= max_depth:
+                        raise RecursionError(
+                            'Maximum call depth of {} exceeded in "{}"'.format(
+                                max_depth, function.name
+                            )
+                        )
+                    frames.append((instructions, consts, names, scope, pc))
+
+                instructions = function_instructions
+                consts = function.code.consts
+                names = function.code.names
+                scope = call_scope
+                pc = 0
+                end = len(instructions)
+            elif opcode == RETURN_VALUE:
+                # The return value stays on the stack for the caller
+                instructions, consts, names, scope, pc = frames.pop()
+                end = len(instructions)
+            elif opcode == MAKE_FUNCTION:
+                function = consts[arg]
+                functions[function.name] = (function, function.code.pairs())
+            else:
+                raise Exception('Unknown opcode {}'.format(opcode))
+
+
+def disassemble(code):
+    # One line per instruction ->
+    #   index  OPCODE  argument (what it points to)
+    # followed by the code of the functions it declares
+    lines = []
+    for index in range(len(code)):
+        opcode = code.instructions[index * 2]
+        arg = code.instructions[index * 2 + 1]
+
+        if opcode in CONST_OPS:
+            detail = '{} ({!r})'.format(arg, code.consts[arg])
+        elif opcode in NAME_OPS:
+            detail = '{} ({})'.format(arg, code.names[arg])
+        elif opcode in JUMP_OPS:
+            detail = '-> {}'.format(arg)
+        else:
+            detail = ''
+
+        lines.append('{:>5} {:<18} {}'.format(
+            index, OPCODES[opcode], detail
+        ).rstrip())
+
+    for value in code.consts:
+        if isinstance(value, Function):
+            lines.append('')
+            lines.append('{}({}):'.format(value.name, ', '.join(value.params)))
+            lines.append(disassemble(value.code))
+    return '\n'.join(lines)
+
+
+class VMInterpreter(object):
+    # Same interface as interpreter.Interpreter
+    def __init__(self, tree, output=None):
+        self.tree = tree
+        self.vm = VM(output)
+        self.GLOBAL_SCOPE = self.vm.GLOBAL_SCOPE
+        self.output = self.vm.output
+        self.code = None
+
+    def reset(self, bindings=None):
+        # Forgets the variables of the last run and sets the ones
+        # in bindings (name -> value). The compiled code is kept
+        self.GLOBAL_SCOPE.clear()
+        if bindings:
+            self.GLOBAL_SCOPE.update(bindings)
+
+    def variables(self):
+        return dict(self.GLOBAL_SCOPE)
+
+    def interpret(self):
+        if self.tree is None:
+            return None
+
+        if self.code is None:
+            self.code = Compiler().compile(self.tree)
+        try:
+            self.vm.run(self.code)
+        finally:
+            self.output.flush()
@@ -0,0 +1,169 @@
+import hashlib
+import os
+import tempfile
+
+import arena
+import lexer
+import parser
+import semantic_analizer
+import serializer
+import symtab_builder
+
+##############################################
+# Compile Cache
+##############################################
+#
+# Keeps the trees that went through the SemanticAnalyser in a
+# directory, so running an unchanged program again can skip the
+# Lexer, Parser and SemanticAnalyser.
+#
+# A file is named after the sha256 of the source and of the
+# front end that made the tree -> FORMAT_VERSION and the code of
+# the modules in FRONT_END. Changing either one gives new names,
+# so stale trees are never loaded, they just get evicted.
+# The trees are stored in the format of the serializer.
+#
+# Files are written to a temporary file first and moved in place
+# with os.replace(), so a reader sees the whole file or none.
+
+# Bumped when the layout of the cache files changes
+FORMAT_VERSION = 2
+
+FRONT_END = (
+    arena, lexer, parser, semantic_analizer, serializer, symtab_builder
+)
+
+SUFFIX = '.tree'
+
+# Bytes the cache files may use together before the
+# least recently used ones are removed
+MAX_CACHE_BYTES = 64 * 1024 * 1024
+
+_front_end_hash = None
+
+
+def front_end_hash():
+    # Hash of the code of the front end, computed once
+    global _front_end_hash
+    if _front_end_hash is None:
+        digest = hashlib.sha256(str(FORMAT_VERSION).encode())
+        for module in FRONT_END:
+            with open(module.__file__, 'rb') as source_file:
+                digest.update(source_file.read())
+        _front_end_hash = digest.digest()
+    return _front_end_hash
+
+
+class CompileCache(object):
+    def __init__(self, directory, max_bytes=MAX_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, source):
+        if isinstance(source, str):
+            source = source.encode('utf-8')
+        digest = hashlib.sha256(front_end_hash())
+        digest.update(source)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def load(self, source):
+        # The analysed tree of source, None if it isn't cached
+        path = self.path(self.key(source))
+        try:
+            with open(path, 'rb') as cache_file:
+                tree = self.decode(cache_file.read())
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception:
+            # Written by something else or damaged, made again on store
+            self.misses += 1
+            self.remove(path)
+            return None
+
+        # Loading counts as a use for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return tree
+
+    def store(self, source, tree):
+        # Returns False if the tree couldn't be stored
+        try:
+            data = self.encode(tree)
+        except RecursionError:
+            # Too deeply nested to flatten, it just isn't cached
+            return False
+
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(
+            dir=self.directory, suffix=SUFFIX + '.tmp'
+        )
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                temp_file.write(data)
+            os.replace(temp_path, self.path(self.key(source)))
+        except BaseException:
+            self.remove(temp_path)
+            raise
+
+        self.evict()
+        return True
+
+    def encode(self, tree):
+        return serializer.dumps(tree)
+
+    def decode(self, data):
+        return serializer.loads(data)
+
+    def entries(self):
+        # (last use, size, path) of every cache file
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return entries
+
+        for name in names:
+            if not name.endswith(SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # Removed by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        # Removes the least recently used files until
+        # the rest fit into max_bytes
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self.remove(path)
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            self.remove(path)
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,338 @@
+import gc
+import sys
+
+from interpreter import (
+    MAX_CALL_DEPTH, PYTHON_FRAMES_PER_CALL, NodeVisitor, ReturnValue, TailCall
+)
+from output import get_output
+from parser import Empty
+
+##############################################
+# Closure Compiler
+##############################################
+#
+# Second execution engine. Instead of walking the tree every
+# time it runs, the tree is compiled once into nested Python
+# closures. Every closure takes the scope (a dict of variables)
+# and the decisions that the Interpreter makes on every visit,
+# like which operator a BinOp is, are made at compile time.
+#
+# The scope of a function call is a new dict with its parameters
+# and local variables. Closures in a function reach the global
+# variables through the global scope the compiler was made with.
+# return and tail calls raise ReturnValue and TailCall, like
+# in the Interpreter.
+
+
+class Function(object):
+    # A compiled function declaration
+    def __init__(self, name, params, body):
+        self.name = name
+        # Names of the parameters, in order
+        self.params = params
+        # Closure of the block, takes the scope of the call
+        self.body = body
+
+
+class ClosureCompiler(NodeVisitor):
+    def __init__(self, output=None, global_scope=None,
+                 max_depth=MAX_CALL_DEPTH):
+        # The print closures write to it
+        self.output = get_output(output)
+        # Scope of the global variables, for the closures in functions
+        self.global_scope = global_scope if global_scope is not None else {}
+        # Functions by name, added when the declaration runs
+        self.functions = {}
+        # Whether the closures being made are in a function
+        self.in_function = False
+        self.max_depth = max_depth
+        # Number of function calls running
+        self.depth = 0
+
+    def compile(self, tree):
+        # Compiling allocates a lot of function objects and none of
+        # them are garbage, so the cyclic GC would only slow it down
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return self.visit(tree)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+
+    def visit_Number(self, node):
+        value = node.value
+        return lambda scope: value
+
+    def visit_Value(self, node):
+        value = node.value
+        return lambda scope: value
+
+    def visit_BinOp(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        op = node.op.type
+
+        if op == 'PLUS':
+            return lambda scope: left(scope) + right(scope)
+        elif op == 'MINUS':
+            return lambda scope: left(scope) - right(scope)
+        elif op == 'MULT':
+            return lambda scope: left(scope) * right(scope)
+        elif op == 'DIV':
+            return lambda scope: left(scope) / right(scope)
+        raise Exception('Unknown operator {}'.format(op))
+
+    def visit_Comparison(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        op = node.op.type
+
+        if op == 'LSTHAN':
+            return lambda scope: left(scope) < right(scope)
+        elif op == 'GRTHAN':
+            return lambda scope: left(scope) > right(scope)
+        elif op == 'DBLEQUAL':
+            return lambda scope: left(scope) == right(scope)
+        raise Exception('Unknown operator {}'.format(op))
+
+    def visit_UnaryOp(self, node):
+        expr = self.visit(node.expr)
+        op = node.op.type
+
+        if op == 'PLUS':
+            return lambda scope: +expr(scope)
+        elif op == 'MINUS':
+            return lambda scope: -expr(scope)
+        raise Exception('Unknown operator {}'.format(op))
+
+    def visit_Block(self, node):
+        # Empty statements don't need to run at all
+        statements = tuple(
+            self.visit(child) for child in node.children
+            if not isinstance(child, Empty)
+        )
+
+        def block(scope):
+            for statement in statements:
+                statement(scope)
+
+        return block
+
+    def visit_Empty(self, node):
+        return lambda scope: None
+
+    def in_global_scope(self, node):
+        # Whether a Var in a function is a global variable
+        return self.in_function and node.is_global
+
+    def visit_Assign(self, node):
+        var_name = node.name.value
+        value = self.visit(node.value)
+
+        if self.in_global_scope(node.name):
+            global_scope = self.global_scope
+
+            def assign(scope):
+                global_scope[var_name] = value(scope)
+        else:
+            def assign(scope):
+                scope[var_name] = value(scope)
+
+        return assign
+
+    def visit_Var(self, node):
+        var_name = node.value
+
+        if self.in_global_scope(node):
+            global_scope = self.global_scope
+
+            def var(scope):
+                value = global_scope.get(var_name)
+                if value is None:
+                    raise NameError('Variable "{}" is not defined'.format(var_name))
+                return value
+        else:
+            def var(scope):
+                value = scope.get(var_name)
+                if value is None:
+                    raise NameError('Variable "{}" is not defined'.format(var_name))
+                return value
+
+        return var
+
+    def visit_Print(self, node):
+        expr = self.visit(node.expr)
+        print_value = self.output.print_value
+        return lambda scope: print_value(expr(scope))
+
+    def visit_IfStatement(self, node):
+        test = self.visit(node.value)
+        block = self.visit(node.block)
+
+        if node.elseblock is None:
+            def ifstatement(scope):
+                if test(scope):
+                    block(scope)
+        else:
+            elseblock = self.visit(node.elseblock)
+
+            def ifstatement(scope):
+                if test(scope):
+                    block(scope)
+                else:
+                    elseblock(scope)
+
+        return ifstatement
+
+    def visit_WhileLoop(self, node):
+        test = self.visit(node.value)
+        block = self.visit(node.block)
+
+        def whileloop(scope):
+            while test(scope):
+                block(scope)
+
+        return whileloop
+
+    def visit_ForLoop(self, node):
+        init = self.visit(node.init)
+        test = self.visit(node.value)
+        step = self.visit(node.step)
+        block = self.visit(node.block)
+
+        def forloop(scope):
+            init(scope)
+            while test(scope):
+                block(scope)
+                step(scope)
+
+        return forloop
+
+    def visit_FuncDecl(self, node):
+        if node.block_node.frame_names is None:
+            raise Exception(
+                'Function calls need a tree that went through the SemanticAnalyser'
+            )
+
+        outer = self.in_function
+        self.in_function = True
+        try:
+            body = self.visit(node.block_node)
+        finally:
+            self.in_function = outer
+
+        function = Function(
+            node.func_name,
+            tuple(param.var_node.value for param in node.params),
+            body
+        )
+        functions = self.functions
+
+        def funcdecl(scope):
+            functions[function.name] = function
+
+        return funcdecl
+
+    def compile_call(self, node):
+        # Closure that returns the Function and the
+        # arguments of a call, evaluated in the caller's scope
+        func_name = node.func_name
+        args = tuple(self.visit(arg) for arg in node.args)
+        functions = self.functions
+
+        def target(scope):
+            function = functions.get(func_name)
+            if function is None:
+                raise NameError(
+                    'Function "{}" is not defined'.format(func_name)
+                )
+            return function, [arg(scope) for arg in args]
+
+        return target
+
+    def visit_FuncCall(self, node):
+        target = self.compile_call(node)
+        call = self.call
+        return lambda scope: call(*target(scope))
+
+    def call(self, function, args):
+        if self.depth >= self.max_depth:
+            raise RecursionError(
+                'Maximum call depth of {} exceeded in "{}"'.format(
+                    self.max_depth, function.name
+                )
+            )
+
+        self.depth += 1
+        try:
+            # Every tail call goes around this loop once, in place
+            # of the call, so the depth doesn't grow
+            while True:
+                try:
+                    function.body(dict(zip(function.params, args)))
+                    return None
+                except ReturnValue as returned:
+                    return returned.value
+                except TailCall as tail:
+                    function = tail.function
+                    args = tail.args
+        finally:
+            self.depth -= 1
+
+    def visit_Return(self, node):
+        if node.expr is None:
+            def return_(scope):
+                raise ReturnValue(None)
+        elif node.tail_call:
+            target = self.compile_call(node.expr)
+
+            def return_(scope):
+                raise TailCall(*target(scope))
+        else:
+            expr = self.visit(node.expr)
+
+            def return_(scope):
+                raise ReturnValue(expr(scope))
+
+        return return_
+
+
+class ClosureInterpreter(object):
+    # Same interface as interpreter.Interpreter
+    def __init__(self, tree, output=None):
+        self.tree = tree
+        self.GLOBAL_SCOPE = {}
+        self.output = get_output(output)
+        self.program = None
+
+    def reset(self, bindings=None):
+        # Forgets the variables of the last run and sets the ones
+        # in bindings (name -> value). The compiled code is kept
+        self.GLOBAL_SCOPE.clear()
+        if bindings:
+            self.GLOBAL_SCOPE.update(bindings)
+
+    def variables(self):
+        return dict(self.GLOBAL_SCOPE)
+
+    def interpret(self):
+        if self.tree is None:
+            return None
+
+        if self.program is None:
+            self.program = ClosureCompiler(
+                self.output, self.GLOBAL_SCOPE
+            ).compile(self.tree)
+
+        # Every call of the program goes through a few closures,
+        # so Python has to allow enough frames for them
+        recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(
+            recursion_limit + MAX_CALL_DEPTH * PYTHON_FRAMES_PER_CALL
+        )
+        try:
+            self.program(self.GLOBAL_SCOPE)
+        finally:
+            sys.setrecursionlimit(recursion_limit)
+            self.output.flush()
@@ -1,5 +1,10 @@
+import argparse
+import io
+import operator
 import sys
-from lexer import Lexer
+from collections import OrderedDict
+from lexer import iter_tokens
+from output import get_output
 from parser import Parser
 
 ##############################################
@@ -8,29 +13,298 @@ from parser import Parser
 
 
 class NodeVisitor(object):
+    # Handler for every node class seen so far. Each
+    # visitor class gets its own dict (see __init_subclass__)
+    _visit_handlers = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super(NodeVisitor, cls).__init_subclass__(**kwargs)
+        cls._visit_handlers = {}
+
     def visit(self, node):
-        method_name = 'visit_' + type(node).__name__
-        visitor = getattr(self, method_name, self.generic_visit)
-        return visitor(node)
+        try:
+            handler = self._visit_handlers[node.__class__]
+        except KeyError:
+            handler = self.resolve_handler(node.__class__)
+        return handler(self, node)
+
+    @classmethod
+    def resolve_handler(cls, node_class):
+        # Looks up visit_<Name> for the node class or the closest
+        # of its base classes, once per (visitor, node) class pair
+        for klass in node_class.__mro__:
+            handler = getattr(cls, 'visit_' + klass.__name__, None)
+            if handler is not None:
+                break
+        else:
+            handler = cls.generic_visit
+
+        cls._visit_handlers[node_class] = handler
+        return handler
 
     def generic_visit(self, node):
         raise Exception('No visit_{} method'.format(type(node).__name__))
 
 
+# Value of a frame slot whose variable hasn't been assigned yet
+UNDEFINED = object()
+
+# Quickening -> a generic BinOp or Comparison that ran this many
+# times in a row with the same operand types gets a fast path,
+# the method of those types, behind a check of the types
+QUICKEN_AFTER = 4
+
+
+def _fast_operators(operators):
+    # (operator, left type, right type) -> function.
+    # The type's own method when both sides have the same type,
+    # the operator module otherwise (like int + float)
+    table = {}
+    value_types = (int, float, str, bool)
+    for op_type, name in operators.items():
+        for left in value_types:
+            for right in value_types:
+                function = getattr(operator, name)
+                if left is right:
+                    function = getattr(left, '__{}__'.format(name), function)
+                table[op_type, left, right] = function
+    return table
+
+
+FAST_BINOPS = _fast_operators({
+    'PLUS': 'add', 'MINUS': 'sub', 'MULT': 'mul', 'DIV': 'truediv',
+})
+FAST_COMPARISONS = _fast_operators({
+    'LSTHAN': 'lt', 'GRTHAN': 'gt', 'DBLEQUAL': 'eq',
+})
+
+# Calls deeper than this raise a RecursionError
+MAX_CALL_DEPTH = 1000
+
+# Python frames a single call of the program can take up,
+# used to raise Python's recursion limit to fit MAX_CALL_DEPTH
+PYTHON_FRAMES_PER_CALL = 40
+
+
+class ReturnValue(Exception):
+    # Raised by a return statement, caught by the call
+    def __init__(self, value):
+        self.value = value
+
+
+# Results kept per pure function, 0 turns memoization off
+MEMO_SIZE = 256
+
+
+class MemoCache(object):
+    # Results of a pure function by its arguments. Past maxsize
+    # the least recently used result is dropped
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, args):
+        # UNDEFINED if the result isn't cached
+        results = self.results
+        result = results.get(args, UNDEFINED)
+        if result is UNDEFINED:
+            self.misses += 1
+        else:
+            self.hits += 1
+            results.move_to_end(args)
+        return result
+
+    def put(self, args, result):
+        results = self.results
+        results[args] = result
+        if len(results) > self.maxsize:
+            results.popitem(last=False)
+
+
+class TailCall(Exception):
+    # Raised by return f(...); instead of calling f,
+    # the running call goes on with f and args
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+
+
+class FramePool(object):
+    # A frame is a list with a slot for every variable of a function.
+    # Frames that a call is done with are cleared and handed
+    # out again, instead of making a new list for every call
+    def __init__(self):
+        # Free frames by size
+        self._free = {}
+        # Cleared frame of every size to copy from
+        self._blank = {}
+        self.allocated = 0
+
+    def acquire(self, size):
+        free = self._free.get(size)
+        if free:
+            return free.pop()
+
+        self.allocated += 1
+        return [UNDEFINED] * size
+
+    def clear(self, frame):
+        size = len(frame)
+        blank = self._blank.get(size)
+        if blank is None:
+            blank = self._blank[size] = [UNDEFINED] * size
+        frame[:] = blank
+
+    def release(self, frame):
+        self.clear(frame)
+        self._free.setdefault(len(frame), []).append(frame)
+
+
 class Interpreter(NodeVisitor):
-    def __init__(self, tree):
+    def __init__(self, tree, max_depth=MAX_CALL_DEPTH, memo_size=MEMO_SIZE,
+                 output=None):
         self.tree = tree
+        # Where print writes to (see output.get_output)
+        self.output = get_output(output)
+        # Variables of trees that went through the SemanticAnalyser
+        # live in a list, one slot per variable (see Var.slot).
+        # Trees that didn't still use the dict
         self.GLOBAL_SCOPE = {}
+        frame_names = getattr(tree, 'frame_names', None) or ()
+        self.global_frame = [UNDEFINED] * len(frame_names)
+        # Frame of the running function call, the global one outside calls
+        self.frame = self.global_frame
+        # Slot of every global variable, by name
+        self.global_slots = {
+            name: slot for slot, name in enumerate(frame_names)
+        }
+
+        # FuncDecl nodes by name, added when the declaration runs
+        self.functions = {}
+        # Names of the functions being called, innermost last
+        self.call_stack = []
+        self.max_depth = max_depth
+        self.frames = FramePool()
+        # MemoCache of every pure function that was called
+        self.memo_size = memo_size
+        self.memo = {}
+        # Nodes that got a fast path and fast paths that were
+        # dropped because the operand types changed
+        self.quickened = 0
+        self.deopts = 0
+
+    def reset(self, bindings=None):
+        # Forgets the variables of the last run and sets the ones
+        # in bindings (name -> value). Functions and memoized results
+        # are kept, they don't depend on the global variables
+        self.GLOBAL_SCOPE = {}
+        self.global_frame = [UNDEFINED] * len(self.global_slots)
+        self.frame = self.global_frame
+        self.call_stack = []
+        if bindings:
+            for name, value in bindings.items():
+                slot = self.global_slots.get(name)
+                if slot is None:
+                    self.GLOBAL_SCOPE[name] = value
+                else:
+                    self.global_frame[slot] = value
+
+    def variables(self):
+        # All variables that have a value, by name
+        variables = dict(self.GLOBAL_SCOPE)
+        frame_names = getattr(self.tree, 'frame_names', None) or ()
+        for name, value in zip(frame_names, self.global_frame):
+            if value is not UNDEFINED:
+                variables[name] = value
+        return variables
     
     def visit_BinOp(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+
+        quick = node.quick
+        if quick is not None:
+            if type(left) is quick[0] and type(right) is quick[1]:
+                return quick[2](left, right)
+            self.deoptimize(node)
+
         if node.op.type == 'PLUS':
-            return self.visit(node.left) + self.visit(node.right)
+            result = left + right
         elif node.op.type == 'MINUS':
-            return self.visit(node.left) - self.visit(node.right)
+            result = left - right
         elif node.op.type == 'MULT':
-            return self.visit(node.left) * self.visit(node.right)
+            result = left * right
         elif node.op.type == 'DIV':
-            return self.visit(node.left) / self.visit(node.right)
+            result = left / right
+        else:
+            return None
+
+        self.observe(node, left, right, FAST_BINOPS)
+        return result
+
+    def observe(self, node, left, right, fast_operators):
+        # Counts the runs in a row with the same operand
+        # types and quickens the node once there are enough
+        left_type = type(left)
+        right_type = type(right)
+        warmup = node.warmup
+        if (
+            warmup is not None
+            and warmup[0] is left_type
+            and warmup[1] is right_type
+        ):
+            count = warmup[2] + 1
+        else:
+            count = 1
+
+        if count < QUICKEN_AFTER:
+            node.warmup = (left_type, right_type, count)
+            return
+
+        node.warmup = None
+        function = fast_operators.get((node.op.type, left_type, right_type))
+        if function is not None:
+            node.quick = (left_type, right_type, function)
+            self.quickened += 1
+
+    def deoptimize(self, node):
+        # The operand types changed, back to the generic path
+        node.quick = None
+        node.warmup = None
+        self.deopts += 1
+
+    # Typed variants from specializer.py. The operand
+    # types are known, so there's no operator to look at
+    def visit_IntAdd(self, node):
+        return self.visit(node.left) + self.visit(node.right)
+
+    def visit_IntSub(self, node):
+        return self.visit(node.left) - self.visit(node.right)
+
+    def visit_IntMul(self, node):
+        return self.visit(node.left) * self.visit(node.right)
+
+    visit_FloatAdd = visit_StrConcat = visit_IntAdd
+    visit_FloatSub = visit_IntSub
+    visit_FloatMul = visit_StrRepeat = visit_IntMul
+
+    def visit_NumDiv(self, node):
+        return self.visit(node.left) / self.visit(node.right)
+
+    def visit_NumLess(self, node):
+        return self.visit(node.left) < self.visit(node.right)
+
+    def visit_NumGreater(self, node):
+        return self.visit(node.left) > self.visit(node.right)
+
+    def visit_NumEqual(self, node):
+        return self.visit(node.left) == self.visit(node.right)
+
+    visit_StrLess = visit_NumLess
+    visit_StrGreater = visit_NumGreater
+    visit_StrEqual = visit_BoolEqual = visit_NumEqual
 
     def visit_IfStatement(self, node):
         # IfStatement has two attributes
@@ -46,14 +320,71 @@ class Interpreter(NodeVisitor):
             for child in node.elseblock.children:
                 self.visit(child)
 
+    def visit_WhileLoop(self, node):
+        children = node.block.children
+        while self.visit(node.value):
+            for child in children:
+                self.visit(child)
+
+    def visit_ForLoop(self, node):
+        if node.counted:
+            return self.counted_loop(node)
+
+        self.visit(node.init)
+        children = node.block.children
+        while self.visit(node.value):
+            for child in children:
+                self.visit(child)
+            self.visit(node.step)
+
+    def counted_loop(self, node):
+        # The SemanticAnalyser made sure the loop only counts
+        # from start to end, so a range() does the counting and
+        # the condition and the step never have to be visited.
+        # The variable is only written, for the block to read
+        var = node.init.name
+        start = self.visit(node.init.value)
+        end = self.visit(node.value.right)
+        change = node.step.value
+        step = change.right.value
+        if change.op.type == 'MINUS':
+            step = -step
+
+        frame = self.global_frame if var.is_global else self.frame
+        slot = var.slot
+        visit = self.visit
+        children = node.block.children
+
+        counter = range(start, end, step)
+        for value in counter:
+            frame[slot] = value
+            for child in children:
+                visit(child)
+
+        # Where the condition would have stopped the loop
+        frame[slot] = start + len(counter) * step
+
     def visit_Comparison(self, node):
         left = self.visit(node.left)
         right = self.visit(node.right)
 
+        quick = node.quick
+        if quick is not None:
+            if type(left) is quick[0] and type(right) is quick[1]:
+                return quick[2](left, right)
+            self.deoptimize(node)
+
         if node.op.type == 'LSTHAN':
-            return left < right
+            result = left < right
         elif node.op.type == 'GRTHAN':
-            return left > right
+            result = left > right
+        elif node.op.type == 'DBLEQUAL':
+            result = left == right
+        else:
+            return None
+
+        self.observe(node, left, right, FAST_COMPARISONS)
+        return result
 
     def visit_Number(self, node):
         return node.value
@@ -77,16 +408,27 @@ class Interpreter(NodeVisitor):
         pass
 
     def visit_Assign(self, node):
-        var_name = node.name.value
-        self.GLOBAL_SCOPE[var_name] = self.visit(node.value)
+        name = node.name
+        slot = name.slot
+        if slot is None:
+            self.GLOBAL_SCOPE[name.value] = self.visit(node.value)
+        elif name.is_global:
+            self.global_frame[slot] = self.visit(node.value)
+        else:
+            self.frame[slot] = self.visit(node.value)
 
     def visit_Var(self, node):
-        var_name = node.value
-        value = self.GLOBAL_SCOPE.get(var_name)
-        if value is None:
-            raise NameError('Variable "{}" is not defined'.format(var_name))
+        slot = node.slot
+        if slot is None:
+            value = self.GLOBAL_SCOPE.get(node.value, UNDEFINED)
+        elif node.is_global:
+            value = self.global_frame[slot]
         else:
-            return value
+            value = self.frame[slot]
+
+        if value is UNDEFINED:
+            raise NameError('Variable "{}" is not defined'.format(node.value))
+        return value
 
     # For values that are not stored
     # in variables
@@ -95,51 +437,289 @@ class Interpreter(NodeVisitor):
 
     def visit_Print(self, node):
         if node.expr is not None:
-            print(self.visit(node.expr))
+            self.output.print_value(self.visit(node.expr))
         else:
-            print(node.value)
+            self.output.print_value(node.value)
+
+    def visit_FuncDecl(self, node):
+        self.functions[node.func_name] = node
+
+    def visit_FuncCall(self, node):
+        function = self.functions.get(node.func_name)
+        if function is None:
+            raise NameError(
+                'Function "{}" is not defined'.format(node.func_name)
+            )
+
+        # Arguments are evaluated in the caller's frame
+        args = [self.visit(arg) for arg in node.args]
+
+        if not function.is_pure or not self.memo_size:
+            return self.call(function, args)
+
+        memo = self.memo.get(function.func_name)
+        if memo is None:
+            memo = self.memo[function.func_name] = MemoCache(self.memo_size)
+        args = tuple(args)
+        result = memo.get(args)
+        if result is UNDEFINED:
+            result = self.call(function, args)
+            memo.put(args, result)
+        return result
+
+    def call(self, function, args):
+        call_stack = self.call_stack
+        if len(call_stack) >= self.max_depth:
+            raise RecursionError(
+                'Maximum call depth of {} exceeded in "{}"'.format(
+                    self.max_depth, function.func_name
+                )
+            )
+
+        caller_frame = self.frame
+        frame = None
+        call_stack.append(function.func_name)
+        try:
+            # Every tail call goes around this loop once, in place
+            # of the call, so the depth and the frames don't grow
+            while True:
+                frame_names = function.block_node.frame_names
+                if frame_names is None:
+                    raise Exception(
+                        'Function calls need a tree that went through the SemanticAnalyser'
+                    )
+
+                # The parameters are the first slots of the frame.
+                # A tail call reuses the frame of the call it
+                # replaces when it has the same size
+                if frame is None:
+                    frame = self.frames.acquire(len(frame_names))
+                elif len(frame) == len(frame_names):
+                    self.frames.clear(frame)
+                else:
+                    self.frames.release(frame)
+                    frame = self.frames.acquire(len(frame_names))
+                frame[:len(args)] = args
+                self.frame = frame
+
+                try:
+                    for child in function.block_node.children:
+                        self.visit(child)
+                    return None
+                except ReturnValue as returned:
+                    return returned.value
+                except TailCall as tail:
+                    function = tail.function
+                    args = tail.args
+                    call_stack[-1] = function.func_name
+        finally:
+            call_stack.pop()
+            self.frame = caller_frame
+            if frame is not None:
+                self.frames.release(frame)
+
+    def memo_stats(self):
+        # {function name: {'hits': .., 'misses': .., 'size': ..}}
+        return {
+            name: {
+                'hits': memo.hits,
+                'misses': memo.misses,
+                'size': len(memo.results),
+            }
+            for name, memo in self.memo.items()
+        }
+
+    def visit_Return(self, node):
+        if node.expr is None:
+            raise ReturnValue(None)
+
+        if node.tail_call:
+            call = node.expr
+            function = self.functions.get(call.func_name)
+            if function is None:
+                raise NameError(
+                    'Function "{}" is not defined'.format(call.func_name)
+                )
+            # Arguments are evaluated before the frame is reused
+            raise TailCall(function, [self.visit(arg) for arg in call.args])
+
+        raise ReturnValue(self.visit(node.expr))
 
     def interpret(self):
         tree = self.tree
         if tree is None:
             return None
 
-        self.visit(tree)
+        # Every call of the program goes through a few visit
+        # methods, so Python has to allow enough frames for them
+        recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(
+            recursion_limit,
+            recursion_limit + self.max_depth * PYTHON_FRAMES_PER_CALL
+        ))
+        try:
+            self.visit(tree)
+        finally:
+            sys.setrecursionlimit(recursion_limit)
+            self.output.flush()
+
+
+# Execution engines that main() can run a program with
+ENGINES = ('tree', 'closure', 'vm', 'python')
+
+
+def get_engine(name):
+    if name == 'closure':
+        from closure_compiler import ClosureInterpreter
+        return ClosureInterpreter
+    if name == 'vm':
+        from bytecode import VMInterpreter
+        return VMInterpreter
+    if name == 'python':
+        from transpiler import TranspiledInterpreter
+        return TranspiledInterpreter
+    return Interpreter
+
+
+def load_program(file_path, cache=None):
+    # The analysed tree of a source file or of a file written
+    # with --compile-to. cache is a cache.CompileCache or None.
+    # Raises OSError if the file can't be read
+    from serializer import MAGIC, loads
+
+    source = None
+    with open(file_path, 'rb') as source_file:
+        compiled = source_file.read(len(MAGIC)) == MAGIC
+        if compiled or cache is not None:
+            source_file.seek(0)
+            source = source_file.read()
+
+    if compiled:
+        # It was analysed already
+        return loads(source)
+
+    if cache is not None:
+        tree = cache.load(source)
+        if tree is not None:
+            return tree
+
+    if source is not None:
+        # Tokens of the bytes the cache key is made of, so the
+        # stored tree is for them even if the file changed since
+        tokens = iter_tokens(io.BytesIO(source))
+    else:
+        # Tokens are streamed straight from the file
+        tokens = iter_tokens(file_path)
+    tree = Parser(tokens).parse()
+
+    from semantic_analizer import SemanticAnalyser
+    SemanticAnalyser().visit(tree)
+
+    if cache is not None:
+        cache.store(source, tree)
+    return tree
+
+
+def optimize(tree):
+    # Runs the optimizer passes over an analysed tree. Returns
+    # the new tree and the passes, which count what they did
+    from optimizer import ConstantFolder
+    from specializer import Specializer
+
+    folder = ConstantFolder()
+    specializer = Specializer()
+    tree = specializer.specialize(folder.optimize(tree))
+    return tree, folder, specializer
 
 
 def main():
-    file_path = sys.argv[1]
+    arg_parser = argparse.ArgumentParser(description='Runs a program')
+    arg_parser.add_argument('file_path')
+    arg_parser.add_argument('--engine', choices=ENGINES, default='tree')
+    arg_parser.add_argument(
+        '--disassemble',
+        action='store_true',
+        help='print the bytecode of the program instead of running it'
+    )
+    arg_parser.add_argument(
+        '--no-optimize',
+        action='store_true',
+        help='run the program without the optimizer passes'
+    )
+    arg_parser.add_argument(
+        '--stats',
+        action='store_true',
+        help='print what the optimizer passes did to stderr'
+    )
+    arg_parser.add_argument(
+        '--cache-dir',
+        help='keep analysed programs in this directory and reuse them'
+    )
+    arg_parser.add_argument(
+        '--compile-to',
+        metavar='PATH',
+        help='write the analysed program to PATH instead of running it'
+    )
+    args = arg_parser.parse_args()
+    file_path = args.file_path
+
+    cache = None
+    if args.cache_dir is not None:
+        from cache import CompileCache
+        cache = CompileCache(args.cache_dir)
+
     try:
-        f = open(file_path, 'r')
-        text = f.read()
-    except:
+        tree = load_program(file_path, cache)
+    except OSError:
         print('Something went wrong.')
+        return
 
-    """
-    lexer_check = Lexer(text)
-    while True:
-        token = lexer_check.get_next_token()
-        print(token)
-        if token.type == 'EOF':
-            break  
-    """  
-    
-    lexer = Lexer(text)
-    parser = Parser(lexer)
-    tree = parser.parse()
-    
-    from semantic_analizer import SemanticAnalyser
-    sem_analyzer = SemanticAnalyser()
+    if args.stats and cache is not None:
+        print(
+            'Cache {}'.format('hit' if cache.hits else 'miss'),
+            file=sys.stderr
+        )
 
-    try:
-        sem_analyzer.visit(tree)
-    except Exception as exc:
-        raise exc
+    if args.compile_to is not None:
+        from serializer import dumps
+        with open(args.compile_to, 'wb') as compiled_file:
+            compiled_file.write(dumps(tree))
         return
-    
 
-    interpreter = Interpreter(tree)
+    if not args.no_optimize:
+        tree, folder, specializer = optimize(tree)
+        if args.stats:
+            print(
+                'Optimizer removed {} nodes'.format(folder.removed),
+                file=sys.stderr
+            )
+            print(
+                'Specializer typed {} nodes'.format(specializer.specialized),
+                file=sys.stderr
+            )
+
+    if args.disassemble:
+        from bytecode import Compiler, disassemble
+        print(disassemble(Compiler().compile(tree)))
+        return
+
+    interpreter = get_engine(args.engine)(tree)
     interpreter.interpret() 
+
+    if args.stats and args.engine == 'tree':
+        print(
+            'Quickened {} nodes, {} deopts'.format(
+                interpreter.quickened, interpreter.deopts
+            ),
+            file=sys.stderr
+        )
+        for name, stats in sorted(interpreter.memo_stats().items()):
+            print(
+                'Memo {}: {hits} hits, {misses} misses, {size} cached'.format(
+                    name, **stats
+                ),
+                file=sys.stderr
+            )
     
 
 if __name__ == '__main__':
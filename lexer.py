@@ -1,3 +1,9 @@
+import mmap
+from array import array
+import os
+import re
+import sys
+
 # Types
 types = {
     '+': 'PLUS',
@@ -17,6 +23,7 @@ types = {
     '<': 'LSTHAN',
     'id': 'ID',
     ':': 'COLON',
+    ',': 'COMMA',
     'type_decl': 'TYPE',
     # Double equal is used for comparison
     # Single equal is used for assignment
@@ -29,18 +36,73 @@ reserved_names = {
     'if': 'IF',
     'str': 'TYPE',
     'int': 'TYPE',
+    'float': 'TYPE',
     'bool': 'TYPE',
     'True': 'BOOL',
     'False': 'BOOL',
     'function': 'FUNCDECL',
+    'while': 'WHILE',
+    'for': 'FOR',
     'return': 'RETURN'
 }
 
 
+# Whitespace and comments. A comment is closed
+# off by the first */ that comes after the opening /*
+_SKIP_SOURCE = r'\s*(?:/\*[^*]*\*+(?:[^/*][^*]*\*+)*/\s*)*'
+
+# Master pattern used by the 'regex' lexing engine. One match skips
+# the whitespace and comments in front of a token and matches the token.
+# Every token alternative is a named group so the kind of the
+# match can be read straight from Match.lastgroup
+_MASTER_SOURCE = _SKIP_SOURCE + r'''
+  (?:
+      (?P<NAME>[^\W\d_]+)  # Same as str.isalpha
+    | (?P<INTEGER>\d+)
+    | (?P<STRING>"[^"]*")
+    | (?P<DBLEQUAL>==)
+    | (?P<OPEN_COMMENT>/\*)  # Comment that is never closed off
+    | (?P<OPEN_STRING>")  # String that is never closed off
+    | (?P<SINGLE>[{single}])
+    | (?P<EOF>\Z)
+  )
+'''.format(
+    single=re.escape(''.join(key for key in types if len(key) == 1))
+)
+MASTER_PATTERN = re.compile(_MASTER_SOURCE, re.DOTALL | re.VERBOSE)
+SKIP_PATTERN = re.compile(_SKIP_SOURCE)
+
+# Same pattern for bytes and mmap buffers. In bytes mode
+# \s, \d and names only match ASCII characters
+MASTER_PATTERN_BYTES = re.compile(
+    _MASTER_SOURCE.encode('ascii'),
+    re.DOTALL | re.VERBOSE
+)
+
+# Match kinds that mean the source ends in the middle of a token
+_UNCLOSED = ('OPEN_COMMENT', 'OPEN_STRING')
+
+# How much of a file object is read at once when streaming
+CHUNK_SIZE = 64 * 1024
+
+# Every token kind as a small int, for the compact TokenBuffer.
+# KIND maps the name of a kind to its int and
+# TOKEN_KINDS maps the int back to the name
+TOKEN_KINDS = tuple(dict.fromkeys(
+    list(types.values())
+    + list(reserved_names.values())
+    + ['INTEGER', 'STRING', 'DBLEQUAL']
+))
+KIND = {name: index for index, name in enumerate(TOKEN_KINDS)}
+
+
 class Token(object):
-    def __init__(self, token_type, value):
+    def __init__(self, token_type, value, start=None, end=None):
         self.value = value
         self.type = token_type
+        # Position of the lexeme in the source text
+        self.start = start
+        self.end = end
 
     def __str__(self):
         return 'Token({type}, {value})'.format(
@@ -52,12 +114,51 @@ class Token(object):
         return self.__str__()
 
 
+# Marks a SourceToken value that wasn't sliced out yet
+_NOT_SLICED = object()
+
+
+# Token that only remembers where its lexeme is in the
+# source text. The value is sliced out (and converted to int
+# for INTEGER tokens) the first time somebody asks for it
+class SourceToken(Token):
+    def __init__(self, token_type, text, start, end):
+        self.type = token_type
+        self.text = text
+        self.start = start
+        self.end = end
+        self._value = _NOT_SLICED
+
+    @property
+    def value(self):
+        value = self._value
+        if value is _NOT_SLICED:
+            value = self.text[self.start:self.end]
+            if self.type == 'INTEGER':
+                value = int(value)
+            self._value = value
+        return value
+
+
 class Lexer(object):
-    def __init__(self, text):
+    # Lexing engines that can be selected
+    # with the engine argument
+    engines = ('char', 'regex')
+
+    def __init__(self, text, engine='char'):
+        if engine not in self.engines:
+            raise ValueError('Unknown lexing engine: {}'.format(engine))
+
+        self.engine = engine
         self.pos = 0
         self.text = text
         self.current_char = self.text[self.pos]
 
+        if engine == 'regex':
+            # Matching is done on the whole buffer,
+            # so skip the per character machinery
+            self.get_next_token = self.get_next_token_regex
+
     def get_next_token(self):
         if self.pos > len(self.text) - 1:
             return Token('EOF', None)
@@ -69,10 +170,14 @@ class Lexer(object):
             if self.current_char == None and self.pos > len(self.text) - 1:
                 return Token('EOF', None)
 
-
-        if self.current_char == '/' and self.peek() == '*':
+        # There can be multiple comments one after another
+        while self.current_char == '/' and self.peek() == '*':
             self.skip_comment()
 
+            # Comment can be the last thing in the file
+            if self.current_char is None:
+                return Token('EOF', None)
+
         if self.current_char.isdigit():
             token = self.integer()
             return token
@@ -90,19 +195,54 @@ class Lexer(object):
             next_char = self.peek()
 
             if next_char == '=':
-                token = Token('DBLEQUAL', '==')
+                token = Token('DBLEQUAL', '==', self.pos, self.pos + 2)
                 for _ in range(2):
                     self.advance()
                 return token
 
         if self.current_char in types:
-            token = Token(types[self.current_char], self.current_char)
+            token = Token(
+                types[self.current_char],
+                self.current_char,
+                self.pos,
+                self.pos + 1
+            )
             self.advance()
             return token
 
         print(self.current_char)
         self.error()
 
+    def get_next_token_regex(self):
+        # Same tokens as get_next_token, but each one
+        # is found with a single match of MASTER_PATTERN
+        text = self.text
+        m = MASTER_PATTERN.match(text, self.pos)
+        if m is None:
+            self.goto(SKIP_PATTERN.match(text, self.pos).end())
+            print(self.current_char)
+            self.error()
+
+        kind = m.lastgroup
+        start, end = m.span(kind)
+        self.pos = end
+
+        if kind == 'NAME':
+            return self.reserved_or_name(m.group(kind), start, end)
+        if kind == 'INTEGER':
+            return SourceToken('INTEGER', text, start, end)
+        if kind == 'SINGLE':
+            value = m.group(kind)
+            return Token(types[value], value, start, end)
+        if kind == 'STRING':
+            # Without the quotes
+            return SourceToken('STRING', text, start + 1, end - 1)
+        if kind == 'DBLEQUAL':
+            return Token('DBLEQUAL', '==', start, end)
+        if kind == 'EOF':
+            return Token('EOF', None)
+        self.error()
+
     def advance(self):
         # Moves to next position and sets
         # the next current character
@@ -131,30 +271,40 @@ class Lexer(object):
 
     def skip_comment(self):
         # Skip everything until comment is closed off
-        # With */
+        # With */ (which has to come after the opening /*)
+        self.advance()
         while True:
             self.advance()
+            if self.current_char is None:
+                # Comment was never closed off
+                self.error()
             if self.current_char == '*' and self.peek() == '/':
                 self.advance()
                 break
         
         if self.current_char == '/':
             self.advance()
-        if self.current_char.isspace():
+        if self.current_char is not None and self.current_char.isspace():
             self.skip_whitespace()
 
 
+    def goto(self, pos):
+        # Jumps to pos and sets the current character
+        self.pos = pos
+        if pos < len(self.text):
+            self.current_char = self.text[pos]
+        else:
+            self.current_char = None
+
     def integer(self):
         # Returns an INTEGER token
-        number = ''
-        while self.current_char.isdigit():
-            number += self.current_char
-            self.advance()   
+        text = self.text
+        start = end = self.pos
+        while end < len(text) and text[end].isdigit():
+            end += 1
 
-            if self.current_char == None:
-                break 
-
-        return Token('INTEGER', int(number))
+        self.goto(end)
+        return SourceToken('INTEGER', text, start, end)
 
     def string(self):
         # Returns a STRING token
@@ -163,29 +313,29 @@ class Lexer(object):
         else:
             self.error()
 
-        string = ''
-
-        while self.current_char != '"':
-            string += self.current_char
-            self.advance()
-            
-            if self.current_char == '"':
-                self.advance()
-                break
+        start = self.pos
+        end = self.text.find('"', start)
+        if end == -1:
+            # String was never closed off
+            self.error()
 
-        return Token('STRING', string)
+        # Continue after the closing "
+        self.goto(end + 1)
+        return SourceToken('STRING', self.text, start, end)
 
     def name(self):
         # This language only supports alphabetical 
         # variable names (for now)
-        name = ''
-        while self.current_char.isalpha():
-            name += self.current_char
-            self.advance()
+        text = self.text
+        start = end = self.pos
+        while end < len(text) and text[end].isalpha():
+            end += 1
 
-            if self.current_char == None:
-                break
+        self.goto(end)
+        return self.reserved_or_name(text[start:end], start, end)
 
+    @staticmethod
+    def reserved_or_name(name, start=None, end=None):
         # Check if it is one of the reserved words
         res_name_type = reserved_names.get(name)
         if res_name_type is not None:
@@ -193,13 +343,260 @@ class Lexer(object):
             # For booleans assign boolean value 
             # instead of string
             if name == 'True':
-                return Token(res_name_type, True)
+                return Token(res_name_type, True, start, end)
             if name == 'False':
-                return Token(res_name_type, False)
+                return Token(res_name_type, False, start, end)
 
-            return Token(res_name_type, name)
+            return Token(res_name_type, name, start, end)
 
-        return Token('NAME', name)
+        # Every occurrence of the same identifier
+        # shares one string object
+        return Token('NAME', sys.intern(name), start, end)
 
     def error(self):
         raise Exception('SyntaxError')
+
+
+# Lets the Parser pull tokens out of any
+# iterator of Tokens, like the one from iter_tokens
+class TokenStream(object):
+    def __init__(self, tokens):
+        self.tokens = iter(tokens)
+
+    def get_next_token(self):
+        return next(self.tokens, Token('EOF', None))
+
+
+#########################################
+# STREAMING
+#########################################
+
+def iter_tokens(source, chunk_size=CHUNK_SIZE):
+    # Lazily yields the Tokens of a file, ending with an EOF Token.
+    # source is a path or an open file object. Paths are memory mapped
+    # and file objects are read chunk_size characters at a time, so the
+    # whole file is never held in memory as one string
+    if isinstance(source, (str, bytes, os.PathLike)):
+        with open(source, 'rb') as f:
+            try:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                # Empty files and special files can't be mapped
+                buffer = None
+
+            if buffer is None:
+                chunks = _read_chunks(f, chunk_size)
+            else:
+                chunks = iter([buffer])
+
+            try:
+                for token in _scan_chunks(chunks):
+                    yield token
+            finally:
+                if buffer is not None:
+                    buffer.close()
+        return
+
+    for token in _scan_chunks(_read_chunks(source, chunk_size)):
+        yield token
+
+
+def _read_chunks(f, chunk_size):
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _scan_chunks(chunks):
+    # Tokenizes str or bytes chunks with the master pattern.
+    # A token that touches the end of the buffer might continue
+    # in the next chunk, so it is only emitted once more input
+    # was read or the input is exhausted
+    buf = next(chunks, '')
+    if isinstance(buf, str):
+        pattern = MASTER_PATTERN
+    else:
+        pattern = MASTER_PATTERN_BYTES
+
+    # Position of buf[0] in the whole input
+    offset = 0
+    pos = 0
+    exhausted = len(buf) == 0
+
+    while True:
+        if pos < len(buf):
+            m = pattern.match(buf, pos)
+            if m is None:
+                raise Exception('SyntaxError')
+
+            kind = m.lastgroup
+            unfinished = kind in _UNCLOSED or m.end() == len(buf)
+            if exhausted or not unfinished:
+                if kind in _UNCLOSED:
+                    raise Exception('SyntaxError')
+
+                if kind == 'EOF':
+                    break
+
+                pos = m.end()
+                yield _match_token(m, offset)
+                continue
+
+        if exhausted:
+            break
+
+        # Keep the unfinished part and read some more
+        chunk = next(chunks, buf[:0])
+        exhausted = len(chunk) == 0
+        buf = buf[pos:] + chunk
+        offset += pos
+        pos = 0
+
+    yield Token('EOF', None)
+
+
+def _match_token(m, offset):
+    kind = m.lastgroup
+    start = m.start(kind) + offset
+    end = m.end(kind) + offset
+
+    value = m.group(kind)
+    if not isinstance(value, str):
+        value = value.decode('utf-8')
+
+    if kind == 'INTEGER':
+        return Token('INTEGER', int(value), start, end)
+    if kind == 'STRING':
+        # Without the quotes
+        return Token('STRING', value[1:-1], start + 1, end - 1)
+    if kind == 'NAME':
+        return Lexer.reserved_or_name(value, start, end)
+    if kind == 'DBLEQUAL':
+        return Token('DBLEQUAL', value, start, end)
+    return Token(types[value], value, start, end)
+
+
+
+#########################################
+# COMPACT TOKEN BUFFER
+#########################################
+
+# All tokens of a source text stored in parallel arrays
+# instead of one Token object per lexeme:
+#   kinds      - kind of the token (index into TOKEN_KINDS)
+#   starts     - where the lexeme starts in the text
+#   ends       - where the lexeme ends in the text
+#   value_ids  - index of the value in the values pool
+# Equal values (every 'a', every ';', every 1) share one
+# entry in the pool. Offsets are stored as unsigned 32 bit ints.
+class TokenBuffer(object):
+    def __init__(self):
+        self.kinds = array('B')
+        self.starts = array('I')
+        self.ends = array('I')
+        self.value_ids = array('I')
+        self.values = []
+
+        self._value_index = {}
+        # One shared Token per pooled value, handed out to the Parser
+        self._tokens = []
+        self.pos = 0
+
+    @classmethod
+    def from_text(cls, text):
+        buffer = cls()
+        append = buffer.append
+        pos = 0
+
+        while True:
+            m = MASTER_PATTERN.match(text, pos)
+            if m is None:
+                raise Exception('SyntaxError')
+
+            kind = m.lastgroup
+            if kind == 'EOF':
+                break
+
+            start, end = m.span(kind)
+            pos = end
+            value = m.group(kind)
+
+            if kind == 'NAME':
+                kind = reserved_names.get(value, 'NAME')
+                if value == 'True' or value == 'False':
+                    value = value == 'True'
+            elif kind == 'INTEGER':
+                value = int(value)
+            elif kind == 'STRING':
+                start += 1
+                end -= 1
+                value = value[1:-1]
+            elif kind == 'SINGLE':
+                kind = types[value]
+            elif kind != 'DBLEQUAL':
+                raise Exception('SyntaxError')
+
+            append(KIND[kind], value, start, end)
+
+        return buffer
+
+    @classmethod
+    def from_tokens(cls, tokens):
+        # Packs Tokens from any iterator (like iter_tokens)
+        buffer = cls()
+        for token in tokens:
+            if token.type == 'EOF':
+                break
+            buffer.append(KIND[token.type], token.value, token.start, token.end)
+        return buffer
+
+    def append(self, kind, value, start, end):
+        # (kind, value) so that True and 1 don't share an entry
+        key = (kind, value)
+        value_id = self._value_index.get(key)
+        if value_id is None:
+            value_id = self._value_index[key] = len(self.values)
+            self.values.append(value)
+            self._tokens.append(Token(TOKEN_KINDS[kind], value))
+
+        self.kinds.append(kind)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.value_ids.append(value_id)
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def kind(self, index):
+        return TOKEN_KINDS[self.kinds[index]]
+
+    def value(self, index):
+        return self.values[self.value_ids[index]]
+
+    def token(self, index):
+        return Token(
+            self.kind(index),
+            self.value(index),
+            self.starts[index],
+            self.ends[index]
+        )
+
+    def get_next_token(self):
+        # Lets the Parser read straight from the buffer.
+        # Tokens with the same kind and value are one shared object
+        # (without a position), so no Token is allocated per lexeme
+        pos = self.pos
+        if pos >= len(self.kinds):
+            return Token('EOF', None)
+
+        self.pos = pos + 1
+        return self._tokens[self.value_ids[pos]]
+
+    def nbytes(self):
+        # Memory used by the columns
+        return sum(
+            column.itemsize * len(column)
+            for column in (self.kinds, self.starts, self.ends, self.value_ids)
+        )
@@ -0,0 +1,220 @@
+from interpreter import NodeVisitor
+from lexer import Token
+from parser import AST, Empty, Number, Value
+
+##############################################
+# Optimizer
+##############################################
+#
+# Runs between the SemanticAnalyser and execution.
+# Folds BinOp, UnaryOp and Comparison nodes whose operands are
+# all literals into a single Number or Value node, and replaces
+# if statements whose condition is known with the block that
+# would run. ConstantFolder.removed counts the nodes that are gone.
+
+# Folded strings longer than this stay as expressions,
+# so "a" * 1000000 doesn't end up in the tree
+MAX_FOLDED_STRING = 4096
+
+
+def count_nodes(node):
+    if node is None:
+        return 0
+    if isinstance(node, list):
+        return sum(count_nodes(item) for item in node)
+
+    count = 1
+    for name in type(node).__slots__:
+        child = getattr(node, name, None)
+        if isinstance(child, (AST, list)):
+            count += count_nodes(child)
+    return count
+
+
+def constant_node(value):
+    # Number for ints, Value for everything else,
+    # the same nodes the parser makes for literals
+    if type(value) is int:
+        return Number(Token('INTEGER', value))
+    return Value(value)
+
+
+def is_constant(node):
+    return type(node) in (Number, Value)
+
+
+def folded_string_size(op, left, right):
+    # Length of the string that left op right would make,
+    # worked out from the operands without making it.
+    # None if the result isn't a string
+    if op == 'PLUS' and isinstance(left, str) and isinstance(right, str):
+        return len(left) + len(right)
+    if op == 'MULT':
+        if isinstance(left, str) and type(right) is int:
+            return len(left) * max(right, 0)
+        if type(left) is int and isinstance(right, str):
+            return max(left, 0) * len(right)
+    return None
+
+
+class ConstantFolder(NodeVisitor):
+    def __init__(self):
+        self.removed = 0
+
+    def optimize(self, tree):
+        return self.visit(tree)
+
+    def fold(self, node, compute):
+        # Replaces node with the constant that compute() returns.
+        # Anything that would fail is left for the runtime to raise
+        try:
+            value = compute()
+        except (ArithmeticError, TypeError):
+            return node
+
+        self.removed += count_nodes(node) - 1
+        constant = constant_node(value)
+        # The type the SemanticAnalyser found still holds
+        constant.expr_type = node.expr_type
+        return constant
+
+    def visit_Number(self, node):
+        return node
+
+    def visit_Value(self, node):
+        return node
+
+    def visit_Var(self, node):
+        return node
+
+    def visit_Empty(self, node):
+        return node
+
+    def visit_Param(self, node):
+        return node
+
+    def visit_BinOp(self, node):
+        node.left = left = self.visit(node.left)
+        node.right = right = self.visit(node.right)
+        if not (is_constant(left) and is_constant(right)):
+            return node
+
+        op = node.op.type
+        # Checked before folding, so a long string is never made
+        size = folded_string_size(op, left.value, right.value)
+        if size is not None and size > MAX_FOLDED_STRING:
+            return node
+
+        if op == 'PLUS':
+            return self.fold(node, lambda: left.value + right.value)
+        elif op == 'MINUS':
+            return self.fold(node, lambda: left.value - right.value)
+        elif op == 'MULT':
+            return self.fold(node, lambda: left.value * right.value)
+        elif op == 'DIV':
+            return self.fold(node, lambda: left.value / right.value)
+        return node
+
+    def visit_UnaryOp(self, node):
+        node.expr = expr = self.visit(node.expr)
+        if not is_constant(expr):
+            return node
+
+        op = node.op.type
+        if op == 'PLUS':
+            return self.fold(node, lambda: +expr.value)
+        elif op == 'MINUS':
+            return self.fold(node, lambda: -expr.value)
+        return node
+
+    def visit_Comparison(self, node):
+        node.left = left = self.visit(node.left)
+        node.right = right = self.visit(node.right)
+        if not (is_constant(left) and is_constant(right)):
+            return node
+
+        op = node.op.type
+        if op == 'LSTHAN':
+            return self.fold(node, lambda: left.value < right.value)
+        elif op == 'GRTHAN':
+            return self.fold(node, lambda: left.value > right.value)
+        elif op == 'DBLEQUAL':
+            return self.fold(node, lambda: left.value == right.value)
+        return node
+
+    def visit_Block(self, node):
+        children = []
+        for child in node.children:
+            child = self.visit(child)
+            # Dead if statements come back as the
+            # list of statements that replace them
+            if isinstance(child, list):
+                children.extend(child)
+            else:
+                children.append(child)
+
+        node.children = children
+        return node
+
+    def visit_Assign(self, node):
+        node.value = self.visit(node.value)
+        return node
+
+    def visit_Print(self, node):
+        if node.expr is not None:
+            node.expr = self.visit(node.expr)
+        return node
+
+    def visit_IfStatement(self, node):
+        node.value = self.visit(node.value)
+        node.block = self.visit(node.block)
+        if node.elseblock is not None:
+            node.elseblock = self.visit(node.elseblock)
+
+        if not is_constant(node.value) or type(node.value.value) is not bool:
+            return node
+
+        # The condition is known, keep only the statements that run
+        if node.value.value:
+            statements = node.block.children
+        elif node.elseblock is not None:
+            statements = node.elseblock.children
+        else:
+            statements = []
+        statements = [
+            statement for statement in statements
+            if not isinstance(statement, Empty)
+        ]
+
+        self.removed += count_nodes(node) - count_nodes(statements)
+        return statements
+
+    def visit_WhileLoop(self, node):
+        node.value = self.visit(node.value)
+        node.block = self.visit(node.block)
+
+        # while (False) {} never runs
+        if is_constant(node.value) and node.value.value is False:
+            self.removed += count_nodes(node)
+            return []
+        return node
+
+    def visit_ForLoop(self, node):
+        node.init = self.visit(node.init)
+        node.value = self.visit(node.value)
+        node.step = self.visit(node.step)
+        node.block = self.visit(node.block)
+        return node
+
+    def visit_FuncDecl(self, node):
+        node.block_node = self.visit(node.block_node)
+        return node
+
+    def visit_FuncCall(self, node):
+        node.args = [self.visit(arg) for arg in node.args]
+        return node
+
+    def visit_Return(self, node):
+        if node.expr is not None:
+            node.expr = self.visit(node.expr)
+        return node
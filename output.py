@@ -0,0 +1,69 @@
+import sys
+
+##############################################
+# Output
+##############################################
+#
+# Where the print statements of a program go. Every engine
+# takes an output and calls print_value() for each print.
+#
+#   None          -> BufferedOutput to sys.stdout
+#   a list        -> ListOutput, one string per print
+#   a stream      -> BufferedOutput to the stream (like io.StringIO)
+#   an output     -> used as it is
+
+# Characters that BufferedOutput collects before writing them
+FLUSH_SIZE = 64 * 1024
+
+
+class BufferedOutput(object):
+    # Collects the printed lines and writes them to the stream in
+    # one call, when there are flush_size characters or more,
+    # at the end of the program or when flush() is called
+    def __init__(self, stream=None, flush_size=FLUSH_SIZE):
+        # None means sys.stdout, looked up when writing
+        self.stream = stream
+        self.flush_size = flush_size
+        self.parts = []
+        self.size = 0
+
+    def print_value(self, value):
+        # Same text as print(value)
+        text = str(value) + '\n'
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if not self.parts:
+            return
+        stream = self.stream if self.stream is not None else sys.stdout
+        stream.write(''.join(self.parts))
+        stream.flush()
+        self.parts = []
+        self.size = 0
+
+
+class ListOutput(object):
+    # Keeps the printed values as strings, without newlines
+    def __init__(self, lines=None):
+        self.lines = lines if lines is not None else []
+
+    def print_value(self, value):
+        self.lines.append(str(value))
+
+    def flush(self):
+        pass
+
+
+def get_output(sink=None):
+    if sink is None:
+        return BufferedOutput()
+    if isinstance(sink, list):
+        return ListOutput(sink)
+    if hasattr(sink, 'print_value'):
+        return sink
+    if hasattr(sink, 'write'):
+        return BufferedOutput(sink)
+    raise TypeError('Unsupported output {!r}'.format(sink))
@@ -1,93 +1,203 @@
-from lexer import types, Token
+from lexer import types, Token, TokenStream
 
 
 #########################################
 # AST NODES
 #########################################
 
+# Nodes use __slots__, so they don't carry a per-instance
+# __dict__. Attributes that other phases put on the nodes
+# have to be declared in the slots as well.
+# expr_type on expression nodes is the BuiltinTypeSymbol
+# that the SemanticAnalyser computed for them
+
 class AST(object):
-    pass
+    __slots__ = ()
 
 
 class Number(AST):
+    # Only the value is kept, the token
+    # would keep the source text alive
+    __slots__ = ('value', 'expr_type')
+
     def __init__(self, token):
         self.value = token.value
-        self.token = token
+        self.expr_type = None
 
 
 class BinOp(AST):
+    __slots__ = ('left', 'op', 'right', 'expr_type', 'quick', 'warmup')
+
     def __init__(self, left, op, right):
         self.left = left
         self.op = op
         self.right = right
-        self.token = self.op
+        self.expr_type = None
+        # Runtime type feedback of the Interpreter
+        self.quick = None
+        self.warmup = None
+
+    @property
+    def token(self):
+        return self.op
 
 
 class Comparison(AST):
+    __slots__ = ('left', 'op', 'right', 'expr_type', 'quick', 'warmup')
+
     def __init__(self, left, op, right):
         self.left = left
         self.op = op
         self.right = right
-        self.token = self.op
+        self.expr_type = None
+        # Runtime type feedback of the Interpreter
+        self.quick = None
+        self.warmup = None
+
+    @property
+    def token(self):
+        return self.op
 
 
 class UnaryOp(AST):
+    __slots__ = ('op', 'expr', 'expr_type')
+
     def __init__(self, op, expr):
-        self.token = self.op = op
+        self.op = op
         self.expr = expr
+        self.expr_type = None
+
+    @property
+    def token(self):
+        return self.op
 
 
 class Block(AST):
+    __slots__ = ('children', 'frame_names')
+
     def __init__(self):
         self.children = []
+        # Names of the frame slots of the scope this block
+        # opens, filled in by the SemanticAnalyser
+        self.frame_names = None
 
 
 class Assign(AST):
+    __slots__ = ('name', 'type', 'value')
+
     def __init__(self, name, value, type=None):
         self.name = name
         self.type = type
         self.value = value
 
+
 class Var(AST):
+    __slots__ = ('token', 'value', 'slot', 'is_global', 'expr_type')
+
     def __init__(self, token):
         self.token = token
         self.value = token.value
+        # Frame slot of the variable and whether the slot is in
+        # the global frame or in the frame of the function call.
+        # Filled in by the SemanticAnalyser
+        self.slot = None
+        self.is_global = True
+        self.expr_type = None
 
 
 class Value(AST):
     # Something that has only a value
     # Like a boolean or a string
+    __slots__ = ('value', 'expr_type')
+
     def __init__(self, value):
         self.value = value
+        self.expr_type = None
 
 
 class Print(AST):
+    __slots__ = ('expr',)
+
     def __init__(self, expr):
         self.expr = expr
 
 
 class IfStatement(AST):
+    __slots__ = ('value', 'block', 'elseblock')
+
     def __init__(self, value, block, elseblock=None):
         self.value = value
         self.block = block
         self.elseblock = elseblock
 
 
+class WhileLoop(AST):
+    __slots__ = ('value', 'block')
+
+    def __init__(self, value, block):
+        self.value = value # Condition, like in IfStatement
+        self.block = block
+
+
+# for (init; value; step) { block }
+class ForLoop(AST):
+    __slots__ = ('init', 'value', 'step', 'block', 'counted')
+
+    def __init__(self, init, value, step, block):
+        self.init = init # Assign
+        self.value = value
+        self.step = step # Assign
+        self.block = block
+        # Set by the SemanticAnalyser for loops that count an int
+        # variable up or down to a fixed end (see is_counted)
+        self.counted = False
+
+
 class Param(AST):
+    __slots__ = ('var_node', 'type_node')
+
     def __init__(self, var_node, type_node):
         self.var_node = var_node
         self.type_node = type_node
 
 
 class FuncDecl(AST):
-    def __init__(self, func_name, params, block_node):
+    __slots__ = ('func_name', 'params', 'block_node', 'return_type', 'is_pure')
+
+    def __init__(self, func_name, params, block_node, return_type=None):
         self.func_name = func_name
         self.params = params # This is a list of parameter nodes
         self.block_node = block_node
+        # TYPE token after the parameters, None
+        # if the function doesn't return a value
+        self.return_type = return_type
+        # Set by the SemanticAnalyser, the result of a pure
+        # function only depends on the arguments
+        self.is_pure = False
+
+
+class FuncCall(AST):
+    __slots__ = ('func_name', 'args', 'expr_type')
+
+    def __init__(self, func_name, args):
+        self.func_name = func_name
+        self.args = args # Expressions for the parameters
+        self.expr_type = None
+
+
+class Return(AST):
+    __slots__ = ('expr', 'tail_call')
+
+    def __init__(self, expr):
+        # None for a return without a value
+        self.expr = expr
+        # Set by the SemanticAnalyser when expr is a call,
+        # which can then reuse the frame of the function
+        self.tail_call = False
 
 
 class Empty(AST):
-    pass
+    __slots__ = ()
 
 
 #########################################
@@ -97,6 +207,10 @@ class Empty(AST):
 
 class Parser(object):
     def __init__(self, lexer):
+        # Anything without get_next_token is treated
+        # as an iterator of Tokens (see lexer.iter_tokens)
+        if not hasattr(lexer, 'get_next_token'):
+            lexer = TokenStream(lexer)
         self.lexer = lexer
         self.curr_token = self.lexer.get_next_token()
 
@@ -129,8 +243,8 @@ class Parser(object):
         while True:
             statement = self.statement()
             results.append(statement)
-            if isinstance(statement, IfStatement) or isinstance(statement, FuncDecl):
-                # if-else and function block don't require
+            if isinstance(statement, (IfStatement, FuncDecl, WhileLoop, ForLoop)):
+                # if-else, loop and function blocks don't require
                 # a closing semicolon -> ';'
                 pass
             elif self.curr_token.type != 'SCOLON':
@@ -158,6 +272,15 @@ class Parser(object):
 
         elif token.type == 'FUNCDECL':
             node = self.functiondecl()
+
+        elif token.type == 'RETURN':
+            node = self.return_statement()
+
+        elif token.type == 'WHILE':
+            node = self.whileloop()
+
+        elif token.type == 'FOR':
+            node = self.forloop()
         else:
             node = self.empty()
         
@@ -165,22 +288,20 @@ class Parser(object):
 
     def assignment(self):
         name = self.variable()
+
+        # name(...); is a function call
+        if self.curr_token.type == 'LPAREN':
+            return self.call(name)
+
         # If next token is = 
         # This means (in correct syntax)
         # That variable was already previously defined
         # and that this statement only changes the value and not the type
         if self.curr_token.type == 'EQUAL':
             self.eat('EQUAL')
-
-            if self.curr_token.type == 'BOOL':
-                value = Value(self.curr_token.value)
-                type_token = Token(value='bool', token_type='TYPE')
-                node = Assign(name=name, value=value, type=type_token)
-                self.eat('BOOL')
-            else:
-                node = self.expr()
-
-            return node
+            # No type, the SemanticAnalyser
+            # takes it from the declaration
+            return Assign(name=name, value=self.expr(), type=None)
 
 
         # Type must be declared ->
@@ -223,14 +344,45 @@ class Parser(object):
             return Number(token)
         
         elif token.type == 'LPAREN':
-            node = self.expr()
             self.eat(types['('])
+            node = self.expr()
+            self.eat(types[')'])
             return node  
+
+        elif token.type == 'STRING':
+            self.eat('STRING')
+            return Value(token.value)
+
+        elif token.type == 'BOOL':
+            self.eat('BOOL')
+            return Value(token.value)
         
         else:
             node = self.variable()
+            if self.curr_token.type == 'LPAREN':
+                node = self.call(node)
             return node
 
+    # Arguments of a call, after the function's name
+    def call(self, name):
+        self.eat('LPAREN')
+
+        args = []
+        if self.curr_token.type != 'RPAREN':
+            args.append(self.expr())
+            while self.curr_token.type == 'COMMA':
+                self.eat('COMMA')
+                args.append(self.expr())
+        self.eat('RPAREN')
+
+        return FuncCall(func_name=name.value, args=args)
+
+    def return_statement(self):
+        self.eat('RETURN')
+        if self.curr_token.type in ('SCOLON', 'RBRACE', 'EOF'):
+            return Return(expr=None)
+        return Return(expr=self.expr())
+
     def expr(self):
         node = self.term()
 
@@ -322,6 +474,42 @@ class Parser(object):
         node = IfStatement(value=value, block=block, elseblock=elseblock)
         return node  
 
+    def whileloop(self):
+        self.eat('WHILE')
+        value = self.ifstatement()
+
+        self.eat('LBRACE')
+        block = self.block()
+        self.eat('RBRACE')
+
+        return WhileLoop(value=value, block=block)
+
+    def forloop(self):
+        self.eat('FOR')
+        self.eat('LPAREN')
+        init = self.loop_assignment()
+        self.eat('SCOLON')
+        value = self.comparison()
+        self.eat('SCOLON')
+        step = self.loop_assignment()
+        self.eat('RPAREN')
+
+        self.eat('LBRACE')
+        block = self.block()
+        self.eat('RBRACE')
+
+        return ForLoop(init=init, value=value, step=step, block=block)
+
+    # The first and last part of a for loop
+    # have to be assignments
+    def loop_assignment(self):
+        if self.curr_token.type != 'NAME':
+            self.error()
+        node = self.assignment()
+        if not isinstance(node, Assign):
+            self.error()
+        return node
+
     # Statement wrapped in ()
     # that determines if the if block
     # should run
@@ -333,18 +521,12 @@ class Parser(object):
         return node
 
     def comparison(self):
+        left = self.expr()
 
-        # if (True) {}
-        if self.curr_token.type == 'BOOL':
-            node = Value(value=self.curr_token.value)
-            self.eat('BOOL')
-            return node
-
-        # Left side of comparison is variable
-        if self.curr_token.type == 'NAME':
-            left = self.variable()
-        else:
-            left = self.expr()
+        # if (True) {} -> a condition without comparison,
+        # the SemanticAnalyser makes sure it's a bool
+        if self.curr_token.type == 'RPAREN':
+            return left
 
         if self.curr_token.type == 'LSTHAN':
             op = self.curr_token
@@ -358,10 +540,7 @@ class Parser(object):
         else:
             self.error()
 
-        if self.curr_token.type == 'NAME':
-            right = self.variable()
-        else:
-            right = self.expr()
+        right = self.expr()
 
         node = Comparison(left=left, op=op, right=right)
         return node
@@ -377,6 +556,13 @@ class Parser(object):
         # Function paramters
         params = self.params()
 
+        # Optional return type -> function name(): int {}
+        return_type = None
+        if self.curr_token.type == 'COLON':
+            self.eat('COLON')
+            return_type = self.curr_token
+            self.eat('TYPE')
+
         # Code block
         self.eat('LBRACE')
         block = self.block()
@@ -385,7 +571,8 @@ class Parser(object):
         function = FuncDecl(
             func_name=name,
             params=params,
-            block_node=block 
+            block_node=block,
+            return_type=return_type
         )
 
         return function
@@ -397,14 +584,17 @@ class Parser(object):
         params = []
         while True:
 
-            if self.curr_token.type == 'COMMA':
-                continue
-            elif self.curr_token.type == 'RPAREN':
+            if self.curr_token.type == 'RPAREN':
                 self.eat('RPAREN')
                 break
             elif self.curr_token.type == 'NAME':
                 param = self.param()
                 params.append(param)
+                # Parameters are separated with commas
+                if self.curr_token.type == 'COMMA':
+                    self.eat('COMMA')
+                elif self.curr_token.type != 'RPAREN':
+                    self.error()
             else:
                 self.error()
         
@@ -429,6 +619,12 @@ class Parser(object):
             self.error()
         
         return node
+
+    def parse_arena(self):
+        # Same as parse, but the program is returned as a
+        # flat arena.Arena instead of a tree of nodes
+        from arena import Arena
+        return Arena.from_tree(self.parse())
             
 
 
@@ -0,0 +1,137 @@
+from interpreter import get_engine, optimize
+from lexer import Lexer
+from parser import Parser
+from semantic_analizer import SemanticAnalyser
+
+##############################################
+# Program
+##############################################
+#
+# For running one program many times from Python code ->
+#
+#   program = Program(
+#       'total: int = price * count;',
+#       inputs={'price': 'int', 'count': 'int'}
+#   )
+#   program.run({'price': 3, 'count': 2})   # {'price': 3, 'count': 2, 'total': 6}
+#
+# The source is lexed, parsed, analysed and optimized once, when
+# the Program is made. The inputs are global variables that every
+# run gets a value for, the analyser treats them as declared.
+# Every run starts with a new global scope that only has the inputs.
+#
+# run_columns() runs the program for many rows at once, with an
+# array per input, using vectorized.VectorInterpreter (needs NumPy).
+
+# Python types that the values of inputs can have. Only exact
+# types, True is an int to Python but not to the program
+INPUT_TYPES = {
+    'int': (int,),
+    'float': (float, int),
+    'str': (str,),
+    'bool': (bool,),
+}
+
+# NumPy dtype kinds that the columns of inputs can have
+# (signed and unsigned int, float, bool, str and object)
+COLUMN_KINDS = {
+    'int': 'iu',
+    'float': 'fiu',
+    'str': 'UO',
+    'bool': 'b',
+}
+
+
+class Program(object):
+    def __init__(self, source, inputs=None, engine='tree', optimized=True,
+                 output=None):
+        # inputs is name -> type name ('int', 'float', 'str' or 'bool').
+        # output is where print goes, like for the Interpreter
+        self.inputs = dict(inputs) if inputs is not None else {}
+        for name, type_name in self.inputs.items():
+            if type_name not in INPUT_TYPES:
+                raise ValueError(
+                    'Input "{}" has unsupported type {!r}'.format(name, type_name)
+                )
+
+        tree = Parser(Lexer(source)).parse()
+        SemanticAnalyser(self.inputs).visit(tree)
+        if optimized:
+            tree = optimize(tree)[0]
+        self.tree = tree
+
+        # One engine for all the runs, so the engines that compile
+        # only do it once and the Interpreter keeps its type feedback
+        self.interpreter = get_engine(engine)(tree, output=output)
+        # Made on the first run_columns()
+        self.vector_interpreter = None
+
+    @classmethod
+    def from_file(cls, file_path, **kwargs):
+        with open(file_path) as source_file:
+            return cls(source_file.read(), **kwargs)
+
+    def bind(self, bindings):
+        # Checks the bindings, returns them with floats for
+        # float inputs that got an int
+        bindings = dict(bindings) if bindings is not None else {}
+        for name in bindings:
+            if name not in self.inputs:
+                raise TypeError('Unknown input "{}"'.format(name))
+
+        for name, type_name in self.inputs.items():
+            if name not in bindings:
+                raise TypeError('Missing input "{}"'.format(name))
+            value = bindings[name]
+            if type(value) not in INPUT_TYPES[type_name]:
+                raise TypeError('Input "{}" has to be {}, not {}'.format(
+                    name, type_name, type(value).__name__
+                ))
+            if type_name == 'float':
+                bindings[name] = float(value)
+        return bindings
+
+    def bind_columns(self, columns):
+        # Checks the columns like bind() checks the bindings and
+        # returns them as NumPy arrays of the types' dtypes
+        from vectorized import COLUMN_TYPES, numpy, require_numpy
+        require_numpy()
+
+        columns = dict(columns) if columns is not None else {}
+        for name in columns:
+            if name not in self.inputs:
+                raise TypeError('Unknown input "{}"'.format(name))
+
+        for name, type_name in self.inputs.items():
+            if name not in columns:
+                raise TypeError('Missing input "{}"'.format(name))
+            column = numpy.asarray(columns[name])
+            if column.dtype.kind not in COLUMN_KINDS[type_name]:
+                raise TypeError('Input "{}" has to be {}, not {}'.format(
+                    name, type_name, column.dtype
+                ))
+            column = column.astype(COLUMN_TYPES[type_name][0])
+            # A single value is used as it is for all rows
+            columns[name] = column.item() if column.ndim == 0 else column
+        return columns
+
+    def run_columns(self, columns, rows=None):
+        # Runs the program once for all rows, with every input bound
+        # to a column (or a single value for all rows). Returns the
+        # global variables as columns, see vectorized.VectorInterpreter
+        if self.vector_interpreter is None:
+            from vectorized import VectorInterpreter
+            self.vector_interpreter = VectorInterpreter(self.tree)
+
+        interpreter = self.vector_interpreter
+        interpreter.reset(self.bind_columns(columns), rows)
+        interpreter.interpret()
+        return interpreter.variables()
+
+    def run(self, bindings=None):
+        # Runs the program with the inputs set to bindings
+        # (name -> value) and returns its global variables
+        interpreter = self.interpreter
+        interpreter.reset(self.bind(bindings))
+        interpreter.interpret()
+        return interpreter.variables()
@@ -1,62 +1,152 @@
 from interpreter import NodeVisitor
-import inspect
+from parser import (
+    AST, Assign, BinOp, Comparison, FuncCall, IfStatement, Number, Return, Var
+)
 from symtab_builder import SymbolTable, VarSymbol, FunctionSymbol
-from parser import UnaryOp, BinOp, Var
 
-# Semantic Analyzer traverses the syntax tree 
-# and checks for invalid variable declarations 
-# or invalid use of different types
+##############################################
+# Typing rules
+##############################################
+#
+# The analyser never computes values, only types.
+# Every expression gets the name of its type from these
+# tables, so checking a program takes time linear in the
+# size of the tree, whatever the values in it are.
+
+NUMERIC_TYPES = ('int', 'float')
+
+
+def _numeric_rules(op, result=None):
+    # int with int stays int, anything with a float is a float
+    rules = {}
+    for left in NUMERIC_TYPES:
+        for right in NUMERIC_TYPES:
+            if result is not None:
+                rules[op, left, right] = result
+            elif left == right == 'int':
+                rules[op, left, right] = 'int'
+            else:
+                rules[op, left, right] = 'float'
+    return rules
+
+
+# (operator, left type, right type) -> result type
+BINOP_TYPES = {}
+BINOP_TYPES.update(_numeric_rules('PLUS'))
+BINOP_TYPES.update(_numeric_rules('MINUS'))
+BINOP_TYPES.update(_numeric_rules('MULT'))
+BINOP_TYPES.update(_numeric_rules('DIV', result='float'))
+BINOP_TYPES['PLUS', 'str', 'str'] = 'str'
+BINOP_TYPES['MULT', 'str', 'int'] = 'str'
+BINOP_TYPES['MULT', 'int', 'str'] = 'str'
+
+# Every comparison is a bool
+COMPARISON_TYPES = {}
+COMPARISON_TYPES.update(_numeric_rules('LSTHAN', result='bool'))
+COMPARISON_TYPES.update(_numeric_rules('GRTHAN', result='bool'))
+COMPARISON_TYPES.update(_numeric_rules('DBLEQUAL', result='bool'))
+COMPARISON_TYPES['LSTHAN', 'str', 'str'] = 'bool'
+COMPARISON_TYPES['GRTHAN', 'str', 'str'] = 'bool'
+COMPARISON_TYPES['DBLEQUAL', 'str', 'str'] = 'bool'
+COMPARISON_TYPES['DBLEQUAL', 'bool', 'bool'] = 'bool'
+
+# (operator, operand type) -> result type
+UNARY_TYPES = {
+    ('PLUS', 'int'): 'int',
+    ('PLUS', 'float'): 'float',
+    ('MINUS', 'int'): 'int',
+    ('MINUS', 'float'): 'float',
+}
+
+
+def walk(node):
+    # Every node under node (and node itself)
+    if isinstance(node, list):
+        for item in node:
+            yield from walk(item)
+        return
+
+    yield node
+    for name in type(node).__slots__:
+        child = getattr(node, name, None)
+        if isinstance(child, (AST, list)):
+            yield from walk(child)
+
+
+def same_var(node, var):
+    return (
+        isinstance(node, Var)
+        and node.slot == var.slot
+        and node.is_global == var.is_global
+    )
+
+
+def always_returns(statements):
+    # Whether running the statements always ends in a return.
+    # Loops don't count, their block may not run at all
+    for statement in statements:
+        if isinstance(statement, Return):
+            return True
+        if (
+            isinstance(statement, IfStatement)
+            and statement.elseblock is not None
+            and always_returns(statement.block.children)
+            and always_returns(statement.elseblock.children)
+        ):
+            return True
+    return False
+
+
+# Semantic Analyzer traverses the syntax tree
+# and checks for invalid variable declarations
+# or invalid use of different types.
+# visit_ methods of expressions return the BuiltinTypeSymbol
+# of the expression and store it on the node as expr_type
 class SemanticAnalyser(NodeVisitor):
-    def __init__(self):
+    def __init__(self, inputs=None):
+        # Global variables that the program gets a value for before
+        # it runs, name -> type name. They take the first slots
+        # of the global frame, in the order of inputs
+        self.inputs = inputs if inputs is not None else {}
         self.global_scope = True
         self.current_scope = None
+        # FunctionSymbol of the function being analysed
+        self.current_function = None
 
     # This is the important part for type checking,
     # Other functions are written so that
     # the Analyser can traverse the tree
     def visit_Assign(self, node):
-        # Type which user declared
-        var_type = node.type.value
-
-        # Value stored in the variable
-        try:
-            var_value = node.value.value
+        # Name of the variable
+        var_name = node.name.value
 
-            # You should be able to assign one 
-            # variable to another like so -> a: int = b;
+        # Type of the value stored in the variable
+        value_type = self.value_type(node.value)
 
-        # !! Can also be a BinOp or UnaryOp
-        except AttributeError:
-            var_value = node.value
-            
-            if isinstance(var_value, UnaryOp) or isinstance(var_value, BinOp):
-                var_value = self.visit(node.value)
-            else:
+        # a = 5; for a variable that already exists
+        if node.type is None:
+            var_symbol = self.current_scope.lookup(var_name)
+            if not isinstance(var_symbol, VarSymbol):
+                raise Exception("DeclarationError: Variable not defined.")
+            if value_type.name != var_symbol.type.name:
                 self.type_error()
+            self.annotate_var(node.name, var_symbol)
+            if node.name.is_global:
+                self.impure()
+            return
 
-
-        # Type of value stored in variable
-        var_value_type = type(var_value).__name__
+        # Type which user declared
+        var_type = node.type.value
 
         # Check if type declaration matches the type of the value
-        if var_value_type != var_type:
+        if value_type.name != var_type:
             self.type_error()
 
-
         # Get the matching built-in type
-        if var_type == 'int':
-            type1 = self.current_scope.get_symbol('int')
-        elif var_type == 'str':
-            type1 = self.current_scope.get_symbol('str')
-        elif var_type == 'float':
-            type1 = self.current_scope.get_symbol('float')
-        elif var_type == 'bool':
-            type1 = self.current_scope.get_symbol('bool')
-        else:
+        type1 = self.current_scope.lookup(var_type)
+        if type1 is None:
             raise Exception('Unsupported type declaration.')
-        
-        # Name of the variable
-        var_name = node.name.value
+
         var_symbol = VarSymbol(var_name, type1)
 
         # Check if this variable was previously declared
@@ -65,23 +155,40 @@ class SemanticAnalyser(NodeVisitor):
             raise Exception(
                 'DeclarationError: Duplicate assignment.'
             )
-        
+
         # Insert in symbol table
         self.current_scope.insert(var_symbol)
-
+        self.annotate_var(node.name, var_symbol)
+
+    # The function being analysed has side effects
+    # or depends on more than its arguments
+    def impure(self):
+        if self.current_function is not None:
+            self.current_function.is_pure = False
+
+    def annotate_var(self, node, var_symbol):
+        node.slot = var_symbol.slot
+        # Level 1 is the global scope
+        node.is_global = var_symbol.scope_level == 1
+        node.expr_type = var_symbol.type
+
+    # Type of an expression whose value is used
+    def value_type(self, node):
+        expr_type = self.visit(node)
+        if expr_type is None:
+            raise Exception("TypeError: Expression has no value.")
+        return expr_type
 
     def visit_BinOp(self, node):
-        if node.op.type == 'PLUS':
-            return self.visit(node.left) + self.visit(node.right)
-        elif node.op.type == 'MINUS':
-            return self.visit(node.left) - self.visit(node.right)
-        elif node.op.type == 'MULT':
-            return self.visit(node.left) * self.visit(node.right)
-        elif node.op.type == 'DIV':
-            return self.visit(node.left) / self.visit(node.right)
+        left = self.value_type(node.left)
+        right = self.value_type(node.right)
+        result = BINOP_TYPES.get((node.op.type, left.name, right.name))
+        if result is None:
+            self.operand_error(node.op, left, right)
+        return self.typed(node, result)
 
     def visit_IfStatement(self, node):
-        self.visit(node.value)
+        self.condition(node.value)
 
         for child in node.block.children:
             self.visit(child)
@@ -89,18 +196,114 @@ class SemanticAnalyser(NodeVisitor):
             for child in node.elseblock.children:
                 self.visit(child)
 
-    def visit_Comparison(self, node):
-        left = self.visit(node.left)
-        right = self.visit(node.right)
+    def condition(self, node):
+        if self.value_type(node).name != 'bool':
+            raise Exception("TypeError: Condition has to be a bool.")
+
+    def visit_WhileLoop(self, node):
+        self.condition(node.value)
+
+        for child in node.block.children:
+            self.visit(child)
+
+    def visit_ForLoop(self, node):
+        self.visit(node.init)
+        self.condition(node.value)
+        self.visit(node.step)
 
-        if node.op.type == 'LSTHAN':
-            return left < right
-        elif node.op.type == 'GRTHAN':
-            return left > right
+        for child in node.block.children:
+            self.visit(child)
+
+        node.counted = self.is_counted(node)
+
+    # for (i: int = start; i < end; i = i + step) {}
+    # (or i > end and i = i - step) where step is a positive
+    # number and nothing in the loop changes i or the end.
+    # The Interpreter can run those with a range()
+    def is_counted(self, node):
+        var = node.init.name
+        if var.expr_type.name != 'int':
+            return False
+
+        test = node.value
+        if not isinstance(test, Comparison) or not same_var(test.left, var):
+            return False
+        if test.right.expr_type.name != 'int':
+            return False
+
+        step = node.step
+        change = step.value
+        if not (
+            same_var(step.name, var)
+            and isinstance(change, BinOp)
+            and same_var(change.left, var)
+            and isinstance(change.right, Number)
+            and change.right.value > 0
+        ):
+            return False
+        if (change.op.type, test.op.type) not in (
+            ('PLUS', 'LSTHAN'), ('MINUS', 'GRTHAN')
+        ):
+            return False
+
+        # The end is computed once, before the loop variable is set,
+        # so it can only use variables that the loop doesn't assign
+        end_vars = []
+        for end_node in walk(test.right):
+            if isinstance(end_node, FuncCall):
+                return False
+            if isinstance(end_node, Var):
+                if same_var(end_node, var):
+                    return False
+                end_vars.append(end_node)
+
+        assigned = []
+        calls_impure = False
+        for body_node in walk(node.block):
+            if isinstance(body_node, Assign):
+                assigned.append(body_node.name)
+            elif isinstance(body_node, FuncCall):
+                function = self.current_scope.lookup(body_node.func_name)
+                if function is None or not function.is_pure:
+                    calls_impure = True
+
+        for checked in [var] + end_vars:
+            if any(same_var(name, checked) for name in assigned):
+                return False
+            # Functions can only assign global variables
+            if calls_impure and checked.is_global:
+                return False
+        return True
+
+    def visit_Comparison(self, node):
+        left = self.value_type(node.left)
+        right = self.value_type(node.right)
+        result = COMPARISON_TYPES.get((node.op.type, left.name, right.name))
+        if result is None:
+            self.operand_error(node.op, left, right)
+        return self.typed(node, result)
 
     def visit_FuncDecl(self, node):
+        # Function frames only hold their own variables,
+        # everything else has to be in the global frame
+        if self.current_scope.scope_level != 1:
+            raise Exception(
+                'DeclarationError: Functions can only be declared globally.'
+            )
+
         func_name = node.func_name
+        if self.current_scope.get_symbol(func_name) is not None:
+            raise Exception(
+                'DeclarationError: Duplicate assignment.'
+            )
+
         func_symbol = FunctionSymbol(func_name, block_node=None)
+        if node.return_type is not None:
+            func_symbol.return_type = self.current_scope.lookup(
+                node.return_type.value
+            )
+        # Inserted before the block is analysed,
+        # so the function can call itself
         self.current_scope.insert(func_symbol)
 
         # Enter function's scope
@@ -119,29 +322,91 @@ class SemanticAnalyser(NodeVisitor):
             param_name = param.var_node.value
             var_symbol = VarSymbol(param_name, param_type)
             self.current_scope.insert(var_symbol)
+            self.annotate_var(param.var_node, var_symbol)
             # Add param to function symbol
             func_symbol.params.append(var_symbol)
 
-        #####################
-        # Run block here?
-        #####################
         block_node = node.block_node
         func_symbol.block = block_node
 
-        self.current_scope = self.current_scope.parent_scope
+        # visit_Block gives the block the frame_names of
+        # the function scope and goes back to the parent scope
+        outer_function = self.current_function
+        self.current_function = func_symbol
+        try:
+            self.visit(block_node)
+        finally:
+            self.current_function = outer_function
+
+        if (
+            func_symbol.return_type is not None
+            and not always_returns(block_node.children)
+        ):
+            raise Exception("TypeError: Missing return value.")
+
+        node.is_pure = func_symbol.is_pure
+
+    def visit_FuncCall(self, node):
+        func_symbol = self.current_scope.lookup(node.func_name)
+        if not isinstance(func_symbol, FunctionSymbol):
+            raise Exception("DeclarationError: Function not defined.")
+
+        if len(node.args) != len(func_symbol.params):
+            raise Exception(
+                "TypeError: {} takes {} arguments but {} were given.".format(
+                    node.func_name, len(func_symbol.params), len(node.args)
+                )
+            )
+
+        for arg, param in zip(node.args, func_symbol.params):
+            if self.value_type(arg).name != param.type.name:
+                raise Exception(
+                    "TypeError: Invalid argument for {}.".format(param.name)
+                )
+
+        if not func_symbol.is_pure:
+            self.impure()
+
+        # None for functions that return nothing,
+        # value_type() refuses those in expressions
+        node.expr_type = func_symbol.return_type
+        return func_symbol.return_type
+
+    def visit_Return(self, node):
+        function = self.current_function
+        if function is None:
+            raise Exception("SyntaxError: Return outside of a function.")
+
+        if node.expr is None:
+            if function.return_type is not None:
+                raise Exception("TypeError: Missing return value.")
+            return
+
+        if function.return_type is None:
+            raise Exception("TypeError: Function doesn't return a value.")
+        if self.value_type(node.expr).name != function.return_type.name:
+            raise Exception("TypeError: Invalid return value.")
+
+        # return f(...); -> nothing is left to do in this call
+        # after f returns, so f can run in the same frame
+        node.tail_call = isinstance(node.expr, FuncCall)
 
     def visit_Number(self, node):
-        return node.value
+        return self.typed(node, 'int')
 
     # example:
     # a = 5;
     # b = -a;
     def visit_UnaryOp(self, node):
-        op = node.op.type
-        if op == 'PLUS':
-            return +self.visit(node.expr)
-        elif op == 'MINUS':
-            return -self.visit(node.expr)
+        operand = self.value_type(node.expr)
+        result = UNARY_TYPES.get((node.op.type, operand.name))
+        if result is None:
+            raise Exception(
+                "TypeError: Unsupported operand type for {}: '{}'".format(
+                    node.op.value, operand.name
+                )
+            )
+        return self.typed(node, result)
 
     def visit_Block(self, node):
         if self.global_scope == True:
@@ -151,39 +416,65 @@ class SemanticAnalyser(NodeVisitor):
             )
             self.current_scope = global_symtab
             self.global_scope = False
+            self.declare_inputs()
 
         for child in node.children:
             self.visit(child)
-        
+
+        # The interpreter allocates one slot per variable
+        node.frame_names = tuple(self.current_scope.slot_names)
         self.current_scope = self.current_scope.parent_scope
 
+    def declare_inputs(self):
+        for name, type_name in self.inputs.items():
+            var_type = self.current_scope.lookup(type_name)
+            if var_type is None:
+                raise Exception('Unsupported type declaration.')
+            self.current_scope.insert(VarSymbol(name, var_type))
+
     def visit_Empty(self, node):
         # If statement is empty, do nothing
         pass
 
     def visit_Var(self, node):
         var_name = node.value
-        var_symbol = self.current_scope.get_symbol(var_name)
+        var_symbol = self.current_scope.lookup(var_name)
 
-        if var_symbol is None:
+        if not isinstance(var_symbol, VarSymbol):
             raise Exception("DeclarationError: Variable not defined.")
 
-        # To keep going through the tree
-        var_name = node.value
-        value = self.current_scope.get(var_name)
-        if value is None:
-            raise NameError('Variable "{}" is not defined'.format(var_name))
-        else:
-            return value
+        self.annotate_var(node, var_symbol)
+        # Globals can change between calls
+        if node.is_global:
+            self.impure()
+        return var_symbol.type
 
+    # Strings, booleans and constants from the optimizer
     def visit_Value(self, node):
-        return node.value
+        return self.typed(node, type(node.value).__name__)
 
     def visit_Print(self, node):
+        self.impure()
         if node.expr is not None:
-            self.visit(node.expr)
+            self.value_type(node.expr)
         else:
             pass
 
+    def typed(self, node, type_name):
+        type_symbol = self.current_scope.lookup(type_name)
+        if type_symbol is None:
+            raise Exception(
+                "TypeError: Unsupported type '{}'".format(type_name)
+            )
+        node.expr_type = type_symbol
+        return type_symbol
+
+    def operand_error(self, op, left, right):
+        raise Exception(
+            "TypeError: Unsupported operand types for {}: '{}' and '{}'".format(
+                op.value, left.name, right.name
+            )
+        )
+
     def type_error(self):
-        raise Exception("TypeError: Invalid assignment.")
\ No newline at end of file
+        raise Exception("TypeError: Invalid assignment.")
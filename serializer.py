@@ -0,0 +1,249 @@
+import struct
+import sys
+from array import array
+
+from arena import NODE_KINDS, Arena
+from symtab_builder import BuiltinTypeSymbol
+
+##############################################
+# Serializer
+##############################################
+#
+# Binary format for analysed programs, so a program can be
+# compiled once and run elsewhere without its source. The tree
+# is flattened into an arena.Arena and the arena's columns are
+# written out as they are, followed by its constant pool.
+#
+#   header    MAGIC, FORMAT_VERSION, root index and the
+#             number of kinds, nodes, list items and consts
+#   kinds     names of NODE_KINDS, so the kind numbers of the
+#             file still mean the same after kinds are added
+#   columns   kinds (1 byte per node), a, b, c and expr_types
+#             (4 bytes per node) and lists (4 bytes per item)
+#   consts    one tag byte per value, followed by the value
+#
+# Numbers are little endian. FORMAT_VERSION is bumped whenever
+# the meaning of a, b or c of a kind changes.
+
+# Starts with a byte that is not valid UTF-8 on its own,
+# so no source file can start with it
+MAGIC = b'\x89LTI'
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct('<4sHiIIII')
+
+COLUMNS = ('a', 'b', 'c', 'expr_types')
+
+# Tags of the values in the constant pool
+NONE = ord('N')
+TRUE = ord('T')
+FALSE = ord('F')
+INT = ord('I')          # 8 byte signed int
+BIG_INT = ord('J')      # int that doesn't fit in 8 bytes, as text
+FLOAT = ord('D')
+STR = ord('S')
+TUPLE = ord('U')
+TYPE = ord('Y')         # BuiltinTypeSymbol, by its name
+
+INT64 = struct.Struct('<q')
+DOUBLE = struct.Struct('<d')
+LENGTH = struct.Struct('<I')
+
+
+class SerializationError(Exception):
+    pass
+
+
+def dumps(tree):
+    # The bytes of an analysed tree
+    return encode_arena(Arena.from_tree(tree))
+
+
+def loads(data):
+    # The tree back from the bytes of dumps()
+    arena = decode_arena(data)
+    try:
+        return arena.to_tree()
+    except (IndexError, TypeError, ValueError):
+        # Operands that point at the wrong things
+        raise SerializationError('Damaged serialized program') from None
+
+
+def encode_arena(arena):
+    out = bytearray(HEADER.pack(
+        MAGIC, FORMAT_VERSION, arena.root_index, len(NODE_KINDS),
+        len(arena), len(arena.lists), len(arena.consts)
+    ))
+    for name in NODE_KINDS:
+        _encode_str(out, name)
+
+    out += arena.kinds.tobytes()
+    for column in COLUMNS + ('lists',):
+        out += _little_endian(getattr(arena, column)).tobytes()
+
+    for value in arena.consts:
+        _encode_value(out, value)
+    return bytes(out)
+
+
+def decode_arena(data):
+    data = bytes(data)
+    if len(data) < HEADER.size or data[:len(MAGIC)] != MAGIC:
+        raise SerializationError('Not a serialized program')
+
+    (_, version, root_index, kind_count,
+     node_count, list_count, const_count) = HEADER.unpack_from(data)
+    if version != FORMAT_VERSION:
+        raise SerializationError(
+            'Unsupported format version {} (expected {})'.format(
+                version, FORMAT_VERSION
+            )
+        )
+
+    try:
+        pos = HEADER.size
+        kind_names, pos = _decode_values(data, pos, kind_count, STR)
+        kind_map = bytes(_kind_index(name) for name in kind_names)
+
+        arena = Arena()
+        kinds = data[pos:pos + node_count]
+        pos += node_count
+        if kinds and max(kinds) >= kind_count:
+            raise ValueError('Unknown kind')
+        # Kind numbers of the file to the ones of NODE_KINDS
+        arena.kinds = array('B', kinds.translate(
+            kind_map + bytes(256 - kind_count)
+        ))
+        for column in COLUMNS:
+            column_array, pos = _decode_ints(data, pos, node_count)
+            setattr(arena, column, column_array)
+        arena.lists, pos = _decode_ints(data, pos, list_count)
+        arena.consts, pos = _decode_values(data, pos, const_count)
+        arena.root_index = root_index
+    except (struct.error, IndexError, ValueError, UnicodeDecodeError):
+        raise SerializationError('Damaged serialized program') from None
+
+    if pos != len(data) or not -1 <= root_index < node_count:
+        raise SerializationError('Damaged serialized program')
+    return arena
+
+
+def _kind_index(name):
+    try:
+        return NODE_KINDS.index(name)
+    except ValueError:
+        raise SerializationError('Unknown node kind {}'.format(name)) from None
+
+
+def _little_endian(column):
+    if sys.byteorder == 'little':
+        return column
+    column = array(column.typecode, column)
+    column.byteswap()
+    return column
+
+
+def _encode_str(out, text):
+    encoded = text.encode('utf-8')
+    out += LENGTH.pack(len(encoded))
+    out += encoded
+
+
+def _encode_value(out, value):
+    # Checked in this order because bool is a subclass of int
+    if value is None:
+        out.append(NONE)
+    elif value is True:
+        out.append(TRUE)
+    elif value is False:
+        out.append(FALSE)
+    elif isinstance(value, int):
+        if -2 ** 63 <= value < 2 ** 63:
+            out.append(INT)
+            out += INT64.pack(value)
+        else:
+            out.append(BIG_INT)
+            _encode_str(out, str(value))
+    elif isinstance(value, float):
+        out.append(FLOAT)
+        out += DOUBLE.pack(value)
+    elif isinstance(value, str):
+        out.append(STR)
+        _encode_str(out, value)
+    elif isinstance(value, tuple):
+        out.append(TUPLE)
+        out += LENGTH.pack(len(value))
+        for item in value:
+            _encode_value(out, item)
+    elif isinstance(value, BuiltinTypeSymbol):
+        out.append(TYPE)
+        _encode_str(out, value.name)
+    else:
+        raise SerializationError(
+            'Can not serialize {!r}'.format(value)
+        )
+
+
+def _decode_ints(data, pos, count):
+    column = array('i')
+    end = pos + count * column.itemsize
+    if end > len(data):
+        raise ValueError('Unexpected end of data')
+    column.frombytes(data[pos:end])
+    return _little_endian(column), end
+
+
+def _decode_values(data, pos, count, tag=None, types=None):
+    # Returns the count values at pos and the position after them.
+    # With a tag, the values have no tags and are all of that kind.
+    # Written as one loop with few calls, the constant pool
+    # of a big program has tens of thousands of values
+    if types is None:
+        # One BuiltinTypeSymbol per type name
+        types = {}
+    unpack_length = LENGTH.unpack_from
+    values = []
+    append = values.append
+    for _ in range(count):
+        if tag is None:
+            value_tag = data[pos]
+            pos += 1
+        else:
+            value_tag = tag
+
+        if value_tag == STR or value_tag == TYPE or value_tag == BIG_INT:
+            size = unpack_length(data, pos)[0]
+            pos += 4
+            end = pos + size
+            if end > len(data):
+                raise ValueError('Unexpected end of data')
+            text = data[pos:end].decode('utf-8')
+            pos = end
+            if value_tag == STR:
+                append(text)
+            elif value_tag == TYPE:
+                symbol = types.get(text)
+                if symbol is None:
+                    symbol = types[text] = BuiltinTypeSymbol(text)
+                append(symbol)
+            else:
+                append(int(text))
+        elif value_tag == INT:
+            append(INT64.unpack_from(data, pos)[0])
+            pos += 8
+        elif value_tag == TUPLE:
+            size = unpack_length(data, pos)[0]
+            items, pos = _decode_values(data, pos + 4, size, types=types)
+            append(tuple(items))
+        elif value_tag == FLOAT:
+            append(DOUBLE.unpack_from(data, pos)[0])
+            pos += 8
+        elif value_tag == TRUE:
+            append(True)
+        elif value_tag == FALSE:
+            append(False)
+        elif value_tag == NONE:
+            append(None)
+        else:
+            raise ValueError('Unknown tag {}'.format(value_tag))
+    return values, pos
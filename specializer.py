@@ -0,0 +1,241 @@
+from interpreter import NodeVisitor
+from parser import BinOp, Comparison
+from semantic_analizer import BINOP_TYPES, COMPARISON_TYPES
+
+##############################################
+# Specializer
+##############################################
+#
+# Runs after the SemanticAnalyser. It uses the expr_type that
+# the analyser put on the nodes to replace generic BinOp and
+# Comparison nodes with typed variants like IntAdd or StrConcat.
+# Every variant has its own visit_ method in the Interpreter, so
+# there are no operator checks left when the program runs.
+#
+# The variants subclass the generic nodes, so engines without
+# a handler for a variant still get it as a BinOp/Comparison.
+
+
+class IntAdd(BinOp):
+    __slots__ = ()
+
+
+class IntSub(BinOp):
+    __slots__ = ()
+
+
+class IntMul(BinOp):
+    __slots__ = ()
+
+
+# At least one of the operands is a float
+class FloatAdd(BinOp):
+    __slots__ = ()
+
+
+class FloatSub(BinOp):
+    __slots__ = ()
+
+
+class FloatMul(BinOp):
+    __slots__ = ()
+
+
+# Division of any two numbers is a float
+class NumDiv(BinOp):
+    __slots__ = ()
+
+
+class StrConcat(BinOp):
+    __slots__ = ()
+
+
+# str * int or int * str
+class StrRepeat(BinOp):
+    __slots__ = ()
+
+
+class NumLess(Comparison):
+    __slots__ = ()
+
+
+class NumGreater(Comparison):
+    __slots__ = ()
+
+
+class NumEqual(Comparison):
+    __slots__ = ()
+
+
+class StrLess(Comparison):
+    __slots__ = ()
+
+
+class StrGreater(Comparison):
+    __slots__ = ()
+
+
+class StrEqual(Comparison):
+    __slots__ = ()
+
+
+class BoolEqual(Comparison):
+    __slots__ = ()
+
+
+# (operator, result type) -> variant
+BINOP_VARIANTS = {
+    ('PLUS', 'int'): IntAdd,
+    ('MINUS', 'int'): IntSub,
+    ('MULT', 'int'): IntMul,
+    ('PLUS', 'float'): FloatAdd,
+    ('MINUS', 'float'): FloatSub,
+    ('MULT', 'float'): FloatMul,
+    ('DIV', 'float'): NumDiv,
+    ('PLUS', 'str'): StrConcat,
+    ('MULT', 'str'): StrRepeat,
+}
+
+# (operator, type of the operands) -> variant,
+# with int and float both as 'num'
+COMPARISON_VARIANTS = {
+    ('LSTHAN', 'num'): NumLess,
+    ('GRTHAN', 'num'): NumGreater,
+    ('DBLEQUAL', 'num'): NumEqual,
+    ('LSTHAN', 'str'): StrLess,
+    ('GRTHAN', 'str'): StrGreater,
+    ('DBLEQUAL', 'str'): StrEqual,
+    ('DBLEQUAL', 'bool'): BoolEqual,
+}
+
+
+def operand_kind(type_name):
+    if type_name in ('int', 'float'):
+        return 'num'
+    return type_name
+
+
+def type_name(node):
+    if node.expr_type is None:
+        return None
+    return node.expr_type.name
+
+
+class Specializer(NodeVisitor):
+    def __init__(self):
+        # Number of nodes that got a typed variant
+        self.specialized = 0
+
+    def specialize(self, tree):
+        self.visit(tree)
+        return tree
+
+    def rewrite(self, node, variant):
+        self.specialized += 1
+        typed = variant(node.left, node.op, node.right)
+        typed.expr_type = node.expr_type
+        return typed
+
+    def check(self, node, rules):
+        # The operand types have to be ones the analyser accepts,
+        # otherwise the typed handler would get values it can't use
+        left = type_name(node.left)
+        right = type_name(node.right)
+        if left is None or right is None or node.expr_type is None:
+            # Not analysed, the node stays generic
+            return None
+
+        result = rules.get((node.op.type, left, right))
+        if result is None or result != node.expr_type.name:
+            raise Exception(
+                "TypeError: Unsupported operand types for {}: '{}' and '{}'".format(
+                    node.op.value, left, right
+                )
+            )
+        return left
+
+    def visit_BinOp(self, node):
+        node.left = self.visit(node.left)
+        node.right = self.visit(node.right)
+        if self.check(node, BINOP_TYPES) is None:
+            return node
+
+        variant = BINOP_VARIANTS.get((node.op.type, node.expr_type.name))
+        if variant is None:
+            return node
+        return self.rewrite(node, variant)
+
+    def visit_Comparison(self, node):
+        node.left = self.visit(node.left)
+        node.right = self.visit(node.right)
+        left = self.check(node, COMPARISON_TYPES)
+        if left is None:
+            return node
+
+        variant = COMPARISON_VARIANTS.get(
+            (node.op.type, operand_kind(left))
+        )
+        if variant is None:
+            return node
+        return self.rewrite(node, variant)
+
+    def visit_UnaryOp(self, node):
+        node.expr = self.visit(node.expr)
+        return node
+
+    def visit_Number(self, node):
+        return node
+
+    def visit_Value(self, node):
+        return node
+
+    def visit_Var(self, node):
+        return node
+
+    def visit_Empty(self, node):
+        return node
+
+    def visit_Block(self, node):
+        node.children = [self.visit(child) for child in node.children]
+        return node
+
+    def visit_Assign(self, node):
+        node.value = self.visit(node.value)
+        return node
+
+    def visit_Print(self, node):
+        if node.expr is not None:
+            node.expr = self.visit(node.expr)
+        return node
+
+    def visit_IfStatement(self, node):
+        node.value = self.visit(node.value)
+        node.block = self.visit(node.block)
+        if node.elseblock is not None:
+            node.elseblock = self.visit(node.elseblock)
+        return node
+
+    def visit_WhileLoop(self, node):
+        node.value = self.visit(node.value)
+        node.block = self.visit(node.block)
+        return node
+
+    def visit_ForLoop(self, node):
+        node.init = self.visit(node.init)
+        node.value = self.visit(node.value)
+        node.step = self.visit(node.step)
+        node.block = self.visit(node.block)
+        return node
+
+    def visit_FuncDecl(self, node):
+        node.block_node = self.visit(node.block_node)
+        return node
+
+    def visit_FuncCall(self, node):
+        node.args = [self.visit(arg) for arg in node.args]
+        return node
+
+    def visit_Return(self, node):
+        if node.expr is not None:
+            node.expr = self.visit(node.expr)
+        return node
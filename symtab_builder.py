@@ -32,6 +32,10 @@ class BuiltinTypeSymbol(Symbol):
 class VarSymbol(Symbol):
     def __init__(self, name, type):
         super(VarSymbol, self).__init__(name, type)
+        # Index of the variable in its scope's frame and the level
+        # of that scope, set when the symbol is inserted into a SymbolTable
+        self.slot = None
+        self.scope_level = None
     
     def __str__(self):
         return "<{class_name}(name='{name}', type='{type}')>".format(
@@ -44,10 +48,15 @@ class VarSymbol(Symbol):
 
 
 class FunctionSymbol(Symbol):
-    def __init__(self, name, block_node, params=None):
+    def __init__(self, name, block_node, params=None, return_type=None):
         super(FunctionSymbol, self).__init__(name)
         self.params = params if params is not None else []
         self.block = block_node
+        # BuiltinTypeSymbol, None if the function returns nothing
+        self.return_type = return_type
+        # No prints, no global variables and no calls of
+        # functions that aren't pure (see SemanticAnalyser)
+        self.is_pure = True
 
 
 # Each scope has it's own Symbol Table and each 
@@ -55,6 +64,8 @@ class FunctionSymbol(Symbol):
 class SymbolTable(object):
     def __init__(self, scope_name, scope_level, parent_scope=None):
         self._symbols = {}
+        # Names of the variables by frame slot
+        self.slot_names = []
         self._init_builtin_types()
         self.scope_level = scope_level
         self.scope_name = scope_name
@@ -83,14 +94,23 @@ class SymbolTable(object):
     def insert(self, symbol):
         self._symbols[symbol.name] = symbol
 
+        # Every variable gets the next free slot in this scope's frame
+        if isinstance(symbol, VarSymbol) and symbol.slot is None:
+            symbol.slot = len(self.slot_names)
+            symbol.scope_level = self.scope_level
+            self.slot_names.append(symbol.name)
+
+    # Only looks in this scope
     def get_symbol(self, name):
         symbol = self._symbols.get(name)
         return symbol
 
+    def lookup(self, name):
+        symbol = self._symbols.get(name)
         if symbol is not None:
             return symbol
 
         # recursively go up the chain and lookup the name
-        if self.enclosing_scope is not None:
-            return self.enclosing_scope.lookup(name)
+        if self.parent_scope is not None:
+            return self.parent_scope.lookup(name)
 
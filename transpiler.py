@@ -0,0 +1,326 @@
+import ast
+import re
+import sys
+
+from interpreter import MAX_CALL_DEPTH, NodeVisitor, TailCall
+from output import get_output
+from parser import Assign, Empty, FuncCall, Return
+from semantic_analizer import walk
+
+##############################################
+# Transpiler
+##############################################
+#
+# Fourth execution engine. The tree is lowered into a Python
+# ast.Module and compiled with compile(), so the program runs
+# as regular CPython bytecode.
+#
+# Variables become globals of the compiled code. Their names
+# get VAR_PREFIX, so they can't clash with Python keywords
+# or builtins (like a variable called None or print).
+#
+# print itself is a global of the compiled code too, set to
+# the print_value() of the interpreter's output.
+#
+# Functions become Python functions named with FUNC_PREFIX.
+# Their parameters and local variables are Python locals named
+# with LOCAL_PREFIX, so they never hide a global variable.
+# A tail call returns a TailCall instead of calling, and in
+# programs that have tail calls every other call goes through
+# run_calls(), which makes the calls that were returned.
+
+VAR_PREFIX = 'v_'
+LOCAL_PREFIX = 'l_'
+FUNC_PREFIX = 'f_'
+
+# Python frames a single call of the program can take up,
+# a call through run_calls() takes two
+PYTHON_FRAMES_PER_CALL = 2
+
+BINARY_OPS = {
+    'PLUS': ast.Add,
+    'MINUS': ast.Sub,
+    'MULT': ast.Mult,
+    'DIV': ast.Div,
+}
+
+COMPARE_OPS = {
+    'LSTHAN': ast.Lt,
+    'GRTHAN': ast.Gt,
+    'DBLEQUAL': ast.Eq,
+}
+
+UNARY_OPS = {
+    'PLUS': ast.UAdd,
+    'MINUS': ast.USub,
+}
+
+
+def run_calls(function, *args):
+    # Calls function and every function that it
+    # (and the ones after it) returned as a tail call
+    result = function(*args)
+    while type(result) is TailCall:
+        result = result.function(*result.args)
+    return result
+
+
+class Transpiler(NodeVisitor):
+    def __init__(self):
+        # Whether the code being transpiled is a function's
+        self.in_function = False
+        # Whether calls have to go through run_calls()
+        self.tail_calls = False
+
+    def transpile(self, tree):
+        self.tail_calls = any(
+            isinstance(node, Return) and node.tail_call for node in walk(tree)
+        )
+        module = ast.Module(body=self.statements(tree), type_ignores=[])
+        return ast.fix_missing_locations(module)
+
+    def compile(self, tree):
+        return compile(self.transpile(tree), '<program>', 'exec')
+
+    def statements(self, block):
+        body = []
+        for child in block.children:
+            if isinstance(child, Empty):
+                continue
+            # Some nodes turn into more than one statement
+            statement = self.visit(child)
+            if isinstance(child, FuncCall):
+                body.append(ast.Expr(value=statement))
+            elif isinstance(statement, list):
+                body.extend(statement)
+            else:
+                body.append(statement)
+        if not body:
+            body = [ast.Pass()]
+        return body
+
+    def visit_Number(self, node):
+        return ast.Constant(value=node.value)
+
+    def visit_Value(self, node):
+        return ast.Constant(value=node.value)
+
+    def var_name(self, node):
+        if self.in_function and not node.is_global:
+            return LOCAL_PREFIX + node.value
+        return VAR_PREFIX + node.value
+
+    def visit_Var(self, node):
+        return ast.Name(id=self.var_name(node), ctx=ast.Load())
+
+    def visit_BinOp(self, node):
+        return ast.BinOp(
+            left=self.visit(node.left),
+            op=BINARY_OPS[node.op.type](),
+            right=self.visit(node.right)
+        )
+
+    def visit_Comparison(self, node):
+        return ast.Compare(
+            left=self.visit(node.left),
+            ops=[COMPARE_OPS[node.op.type]()],
+            comparators=[self.visit(node.right)]
+        )
+
+    def visit_UnaryOp(self, node):
+        return ast.UnaryOp(
+            op=UNARY_OPS[node.op.type](),
+            operand=self.visit(node.expr)
+        )
+
+    def visit_Assign(self, node):
+        return ast.Assign(
+            targets=[ast.Name(id=self.var_name(node.name), ctx=ast.Store())],
+            value=self.visit(node.value)
+        )
+
+    def visit_Print(self, node):
+        return ast.Expr(value=ast.Call(
+            func=ast.Name(id='print', ctx=ast.Load()),
+            args=[self.visit(node.expr)],
+            keywords=[]
+        ))
+
+    def visit_IfStatement(self, node):
+        if node.elseblock is None:
+            orelse = []
+        else:
+            orelse = self.statements(node.elseblock)
+
+        return ast.If(
+            test=self.visit(node.value),
+            body=self.statements(node.block),
+            orelse=orelse
+        )
+
+    def visit_WhileLoop(self, node):
+        return ast.While(
+            test=self.visit(node.value),
+            body=self.statements(node.block),
+            orelse=[]
+        )
+
+    def visit_ForLoop(self, node):
+        # init, then a while loop with the step at the end of the body
+        return [
+            self.visit(node.init),
+            ast.While(
+                test=self.visit(node.value),
+                body=self.statements(node.block) + [self.visit(node.step)],
+                orelse=[]
+            ),
+        ]
+
+    def visit_FuncDecl(self, node):
+        if node.block_node.frame_names is None:
+            raise Exception(
+                'Function calls need a tree that went through the SemanticAnalyser'
+            )
+
+        outer = self.in_function
+        self.in_function = True
+        try:
+            body = self.statements(node.block_node)
+        finally:
+            self.in_function = outer
+
+        # Global variables the function assigns
+        assigned = sorted(set(
+            VAR_PREFIX + child.name.value
+            for child in walk(node.block_node)
+            if isinstance(child, Assign) and child.name.is_global
+        ))
+        if assigned:
+            body.insert(0, ast.Global(names=assigned))
+
+        return ast.FunctionDef(
+            name=FUNC_PREFIX + node.func_name,
+            args=ast.arguments(
+                posonlyargs=[],
+                args=[
+                    ast.arg(arg=LOCAL_PREFIX + param.var_node.value)
+                    for param in node.params
+                ],
+                kwonlyargs=[],
+                kw_defaults=[],
+                defaults=[]
+            ),
+            body=body,
+            decorator_list=[],
+            returns=None
+        )
+
+    def visit_FuncCall(self, node):
+        function = ast.Name(id=FUNC_PREFIX + node.func_name, ctx=ast.Load())
+        args = [self.visit(arg) for arg in node.args]
+        if self.tail_calls:
+            return ast.Call(
+                func=ast.Name(id='run_calls', ctx=ast.Load()),
+                args=[function] + args,
+                keywords=[]
+            )
+        return ast.Call(func=function, args=args, keywords=[])
+
+    def visit_Return(self, node):
+        if node.expr is None:
+            return ast.Return(value=None)
+
+        if node.tail_call:
+            call = node.expr
+            return ast.Return(value=ast.Call(
+                func=ast.Name(id='TailCall', ctx=ast.Load()),
+                args=[
+                    ast.Name(id=FUNC_PREFIX + call.func_name, ctx=ast.Load()),
+                    ast.List(
+                        elts=[self.visit(arg) for arg in call.args],
+                        ctx=ast.Load()
+                    ),
+                ],
+                keywords=[]
+            ))
+        return ast.Return(value=self.visit(node.expr))
+
+
+def program_name_error(exc):
+    # The NameError that the other engines raise for
+    # the NameError of the compiled code, exc if there's none
+    name = getattr(exc, 'name', None)
+    if name is None:
+        # An UnboundLocalError only has the name in its message
+        match = re.search(r"'(\w+)'", str(exc))
+        name = match.group(1) if match else ''
+
+    for prefix in (VAR_PREFIX, LOCAL_PREFIX):
+        if name.startswith(prefix):
+            return NameError(
+                'Variable "{}" is not defined'.format(name[len(prefix):])
+            )
+    if name.startswith(FUNC_PREFIX):
+        return NameError(
+            'Function "{}" is not defined'.format(name[len(FUNC_PREFIX):])
+        )
+    return exc
+
+
+def python_source(tree):
+    # The generated Python code, for debugging
+    return ast.unparse(Transpiler().transpile(tree))
+
+
+class TranspiledInterpreter(object):
+    # Same interface as interpreter.Interpreter
+    def __init__(self, tree, output=None):
+        self.tree = tree
+        self.GLOBAL_SCOPE = {}
+        self.output = get_output(output)
+        self.code = None
+
+    def reset(self, bindings=None):
+        # Forgets the variables of the last run and sets the ones
+        # in bindings (name -> value). The compiled code is kept
+        self.GLOBAL_SCOPE.clear()
+        if bindings:
+            self.GLOBAL_SCOPE.update(bindings)
+
+    def variables(self):
+        return dict(self.GLOBAL_SCOPE)
+
+    def interpret(self):
+        if self.tree is None:
+            return None
+
+        if self.code is None:
+            self.code = Transpiler().compile(self.tree)
+
+        namespace = {
+            VAR_PREFIX + name: value
+            for name, value in self.GLOBAL_SCOPE.items()
+        }
+        namespace['print'] = self.output.print_value
+        namespace['run_calls'] = run_calls
+        namespace['TailCall'] = TailCall
+
+        recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(
+            recursion_limit + MAX_CALL_DEPTH * PYTHON_FRAMES_PER_CALL
+        )
+        try:
+            exec(self.code, namespace)
+        except NameError as exc:
+            error = program_name_error(exc)
+            if error is exc:
+                raise
+            raise error from None
+        finally:
+            sys.setrecursionlimit(recursion_limit)
+            self.output.flush()
+            self.GLOBAL_SCOPE.update(
+                (name[len(VAR_PREFIX):], value)
+                for name, value in namespace.items()
+                if name.startswith(VAR_PREFIX)
+            )
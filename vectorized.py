@@ -0,0 +1,401 @@
+import operator
+import sys
+
+from interpreter import (
+    MAX_CALL_DEPTH, PYTHON_FRAMES_PER_CALL, UNDEFINED, Interpreter, NodeVisitor
+)
+from parser import Empty, FuncDecl, Print, Return, Var
+from semantic_analizer import walk
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+##############################################
+# Vectorized Interpreter
+##############################################
+#
+# Runs an analysed program for many rows at once. Every variable
+# holds a NumPy array with a value per row (or a single value that
+# is the same for all rows), so a BinOp is one array operation
+# instead of one tree walk per row.
+#
+# Rows can take different branches of an if. Both branches run, each
+# one under a mask of the rows that take it, and assignments only
+# change the masked rows (numpy.where). Loops run until no row is
+# left whose condition holds.
+#
+# Only pure functions can be called. A function whose only return
+# is its last statement runs for all rows at once, like the rest
+# of the program. The others could return at a different statement
+# in every row, so they run once per row with the Interpreter.
+#
+# Differences to the Interpreter:
+#   - ints are 64 bit, they wrap around instead of growing
+#   - a variable declared for only some rows has the zero value
+#     of its type (0, 0.0, '' or False) in the other rows
+#   - print and functions that aren't pure are not supported,
+#     programs with them are refused when the interpreter is made
+#
+# Needs NumPy, which the rest of the interpreter doesn't.
+
+BINARY_OPS = {
+    'PLUS': operator.add,
+    'MINUS': operator.sub,
+    'MULT': operator.mul,
+    'DIV': operator.truediv,
+}
+
+COMPARE_OPS = {
+    'LSTHAN': operator.lt,
+    'GRTHAN': operator.gt,
+    'DBLEQUAL': operator.eq,
+}
+
+UNARY_OPS = {
+    'PLUS': operator.pos,
+    'MINUS': operator.neg,
+}
+
+# Type of a variable -> (NumPy dtype name, zero value)
+COLUMN_TYPES = {
+    'int': ('int64', 0),
+    'float': ('float64', 0.0),
+    'bool': ('bool', False),
+    # Strings are kept as Python objects, so + and * work on them
+    'str': ('object', ''),
+}
+
+
+def as_python(value):
+    # A NumPy scalar as the Python value the Interpreter uses
+    if isinstance(value, numpy.generic):
+        return value.item()
+    return value
+
+
+def require_numpy():
+    if numpy is None:
+        raise ImportError('The vectorized interpreter needs NumPy')
+
+
+def as_objects(value):
+    if numpy.ndim(value) == 0:
+        return value
+    return numpy.asarray(value, dtype=object)
+
+
+def check_supported(tree):
+    # Raises NotImplementedError for what can't run vectorized
+    for node in walk(tree):
+        if isinstance(node, Print):
+            raise NotImplementedError(
+                'print is not supported by the vectorized interpreter'
+            )
+        if isinstance(node, FuncDecl) and not node.is_pure:
+            raise NotImplementedError(
+                'Function "{}" is not pure, only pure functions are '
+                'supported by the vectorized interpreter'.format(node.func_name)
+            )
+
+
+def returns_at_end(function):
+    # Whether the only return of a function is its last statement
+    returns = [node for node in walk(function.block_node)
+               if isinstance(node, Return)]
+    if not returns:
+        return True
+    statements = [child for child in function.block_node.children
+                  if not isinstance(child, Empty)]
+    return len(returns) == 1 and statements[-1] is returns[0]
+
+
+class VectorInterpreter(NodeVisitor):
+    # Same interface as interpreter.Interpreter, except that reset()
+    # takes columns and variables() returns columns
+    def __init__(self, tree, max_depth=MAX_CALL_DEPTH):
+        require_numpy()
+        self.tree = tree
+        frame_names = getattr(tree, 'frame_names', None)
+        if frame_names is None:
+            raise ValueError(
+                'The vectorized interpreter needs an analysed tree'
+            )
+        check_supported(tree)
+
+        # FuncDecl nodes by name, added when the declaration runs
+        self.functions = {}
+        # Runs the functions that can't run vectorized, row by row
+        self.row_interpreter = Interpreter(tree, max_depth=max_depth)
+        self.row_interpreter.functions = self.functions
+        self.max_depth = max_depth
+        self.depth = 0
+
+        self.global_slots = {
+            name: slot for slot, name in enumerate(frame_names)
+        }
+        # Type name of every global variable by slot
+        self.types = [None] * len(frame_names)
+        for node in walk(tree):
+            # The types of parameters are Vars without a slot
+            if isinstance(node, Var) and node.is_global and node.slot is not None:
+                self.types[node.slot] = node.expr_type.name
+        self.rows = 0
+        self.reset()
+
+    def reset(self, columns=None, rows=None):
+        # Forgets the variables of the last run and sets the ones in
+        # columns (name -> array or single value). The number of rows
+        # comes from the arrays, or from rows if there are none
+        self.frame = [UNDEFINED] * len(self.global_slots)
+        # Rows that the running code is for, None for all of them
+        self.mask = None
+
+        sizes = set()
+        for name, column in (columns or {}).items():
+            slot = self.global_slots.get(name)
+            if slot is None:
+                raise NameError('Variable "{}" is not defined'.format(name))
+            if numpy.ndim(column) != 0:
+                sizes.add(len(column))
+            self.frame[slot] = column
+
+        if rows is not None:
+            sizes.add(rows)
+        if len(sizes) > 1:
+            raise ValueError('Columns have different lengths')
+        self.rows = sizes.pop() if sizes else 1
+
+    def variables(self):
+        # Every variable that has a value, as a column per name
+        variables = {}
+        for name, slot in self.global_slots.items():
+            value = self.frame[slot]
+            if value is not UNDEFINED:
+                variables[name] = self.full_column(value, self.types[slot])
+        return variables
+
+    def interpret(self):
+        if self.tree is None:
+            return None
+
+        # Like in Interpreter.interpret(), calls take a few Python frames
+        recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(
+            recursion_limit + self.max_depth * PYTHON_FRAMES_PER_CALL
+        )
+        try:
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                self.visit(self.tree)
+        finally:
+            sys.setrecursionlimit(recursion_limit)
+
+    def full_column(self, value, type_name):
+        if type_name is None:
+            return numpy.asarray(value)
+        dtype, _ = COLUMN_TYPES[type_name]
+        if numpy.ndim(value) == 0:
+            return numpy.full(self.rows, value, dtype=dtype)
+        return numpy.asarray(value, dtype=dtype)
+
+    def narrow(self, condition):
+        # Mask of the rows for which the running code runs
+        # and condition holds
+        if self.mask is None:
+            return condition
+        return self.mask & condition
+
+    def visit_Block(self, node):
+        for child in node.children:
+            self.visit(child)
+
+    def visit_Empty(self, node):
+        pass
+
+    def visit_Number(self, node):
+        return node.value
+
+    def visit_Value(self, node):
+        return node.value
+
+    def visit_Var(self, node):
+        value = self.frame[node.slot]
+        if value is UNDEFINED:
+            raise NameError('Variable "{}" is not defined'.format(node.value))
+        return value
+
+    def visit_Assign(self, node):
+        slot = node.name.slot
+        if node.name.is_global:
+            type_name = self.types[slot]
+        else:
+            # A local variable of a function
+            type_name = node.name.expr_type.name
+        value = self.visit(node.value)
+
+        if self.mask is not None:
+            old = self.frame[slot]
+            if old is UNDEFINED:
+                old = COLUMN_TYPES[type_name][1]
+            value = self.full_column(
+                numpy.where(self.mask, value, old), type_name
+            )
+        elif type_name == 'str' and numpy.ndim(value) != 0:
+            value = self.full_column(value, type_name)
+        self.frame[slot] = value
+
+    def visit_BinOp(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        op = node.op.type
+        if op == 'DIV':
+            # NumPy divides by zero without an error
+            zero = right == 0
+            if numpy.ndim(zero) != 0:
+                zero = self.narrow(zero)
+            if numpy.any(zero):
+                raise ZeroDivisionError('division by zero')
+        elif node.expr_type.name == 'str':
+            # NumPy has no + and * for str with str or int,
+            # so they run as Python's for every row
+            left = as_objects(left)
+            right = as_objects(right)
+        return BINARY_OPS[op](left, right)
+
+    def visit_Comparison(self, node):
+        result = COMPARE_OPS[node.op.type](
+            self.visit(node.left), self.visit(node.right)
+        )
+        if numpy.ndim(result) != 0:
+            # Comparing str columns gives an array of objects
+            return numpy.asarray(result, dtype=bool)
+        return bool(result)
+
+    def visit_UnaryOp(self, node):
+        return UNARY_OPS[node.op.type](self.visit(node.expr))
+
+    def visit_IfStatement(self, node):
+        condition = self.visit(node.value)
+        if numpy.ndim(condition) == 0:
+            # Same for all rows, like in the Interpreter
+            if condition:
+                self.visit(node.block)
+            elif node.elseblock is not None:
+                self.visit(node.elseblock)
+            return
+
+        self.masked(node.block, self.narrow(condition))
+        if node.elseblock is not None:
+            self.masked(node.elseblock, self.narrow(~condition))
+
+    def masked(self, block, mask):
+        # Runs block for the rows in mask, nothing if there are none
+        if not mask.any():
+            return
+        outer = self.mask
+        self.mask = mask
+        try:
+            self.visit(block)
+        finally:
+            self.mask = outer
+
+    def loop(self, test, block, step=None):
+        outer = self.mask
+        try:
+            while True:
+                condition = self.visit(test)
+                if numpy.ndim(condition) == 0:
+                    if not condition:
+                        break
+                else:
+                    # Rows that left the loop stay out of it
+                    self.mask = self.narrow(condition)
+                    if not self.mask.any():
+                        break
+                self.visit(block)
+                if step is not None:
+                    self.visit(step)
+        finally:
+            self.mask = outer
+
+    def visit_WhileLoop(self, node):
+        self.loop(node.value, node.block)
+
+    def visit_ForLoop(self, node):
+        self.visit(node.init)
+        self.loop(node.value, node.block, node.step)
+
+    def visit_FuncDecl(self, node):
+        self.functions[node.func_name] = node
+
+    def visit_FuncCall(self, node):
+        function = self.functions.get(node.func_name)
+        if function is None:
+            raise NameError(
+                'Function "{}" is not defined'.format(node.func_name)
+            )
+        args = [self.visit(arg) for arg in node.args]
+
+        if self.depth >= self.max_depth:
+            raise RecursionError(
+                'Maximum call depth of {} exceeded in "{}"'.format(
+                    self.max_depth, function.func_name
+                )
+            )
+        self.depth += 1
+        try:
+            if returns_at_end(function):
+                return self.call(function, args)
+            return self.call_rows(function, args)
+        finally:
+            self.depth -= 1
+
+    def call(self, function, args):
+        # Runs the function for all rows (or the ones in the mask)
+        # at once. The function is pure, so it only uses its frame
+        outer_frame = self.frame
+        frame = [UNDEFINED] * len(function.block_node.frame_names)
+        frame[:len(args)] = args
+        self.frame = frame
+        try:
+            for child in function.block_node.children:
+                if isinstance(child, Return):
+                    if child.expr is None:
+                        return None
+                    return self.visit(child.expr)
+                self.visit(child)
+            return None
+        finally:
+            self.frame = outer_frame
+
+    def call_rows(self, function, args):
+        # Runs the function with the Interpreter, once for every
+        # row in the mask and every different set of arguments
+        if function.return_type is None:
+            # Pure and without a value, there's nothing to run
+            return None
+
+        call = self.row_interpreter.call
+        if all(numpy.ndim(arg) == 0 for arg in args):
+            return call(function, [as_python(arg) for arg in args])
+
+        if self.mask is None:
+            rows = range(self.rows)
+        else:
+            rows = numpy.flatnonzero(self.mask).tolist()
+        columns = [
+            numpy.broadcast_to(arg, self.rows).tolist() for arg in args
+        ]
+
+        type_name = function.return_type.value
+        dtype, zero = COLUMN_TYPES[type_name]
+        result = numpy.full(self.rows, zero, dtype=dtype)
+        results = {}
+        for row in rows:
+            row_args = tuple(column[row] for column in columns)
+            value = results.get(row_args, UNDEFINED)
+            if value is UNDEFINED:
+                value = results[row_args] = call(function, list(row_args))
+            result[row] = value
+        return result